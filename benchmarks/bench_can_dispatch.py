@@ -0,0 +1,120 @@
+"""Microbenchmark for the CAN → MQTT hot path.
+
+Compares the original if-chain / tuple-keyed handle_can_message ("before")
+against the RelayTable + CAN_HANDLERS dispatch ("after") on a realistic
+frame mix built from config.yaml, then times the same dispatch with every
+light switched to each payload schema.
+
+Run with:  python3 benchmarks/bench_can_dispatch.py [frames]
+"""
+import os
+import sys
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import can
+
+from can2mqtt import (
+    ARBIT_GET_REPLY,
+    ARBIT_GET_REQUEST,
+    ARBIT_SET_REPLY,
+    PAYLOAD_SCHEMAS,
+    RelayTable,
+    apply_payload_schemas,
+    build_lookup_tables,
+    handle_can_message,
+    load_config,
+    logger,
+    parse_address,
+)
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.yaml")
+
+
+class NullClient:
+    """MQTT client stand-in whose publish() does nothing."""
+
+    def publish(self, topic, payload, retain=False):
+        pass
+
+
+def legacy_handle_can_message(message, can_to_mqtt, client, pending_gets=None):
+    """handle_can_message as it was before the RelayTable rewrite."""
+    arb = message.arbitration_id
+
+    if arb == ARBIT_GET_REQUEST:
+        if pending_gets is not None:
+            pending_gets.append((message.data[0], message.data[1]))
+        return
+
+    if arb == ARBIT_SET_REPLY:
+        topic = can_to_mqtt.get((message.data[0], message.data[1]))
+        if topic is not None:
+            state_str = "ON" if message.data[2] == 1 else "OFF"
+            client.publish(topic, state_str, retain=True)
+            logger.debug("Published MQTT message: %s", message)
+        return
+
+    if arb == ARBIT_GET_REPLY and pending_gets:
+        req_module, req_relay = pending_gets.popleft()
+        topic = can_to_mqtt.get((req_module, req_relay))
+        if topic is not None:
+            state_str = "ON" if message.data[0] == 1 else "OFF"
+            client.publish(topic, state_str, retain=True)
+            logger.debug("Updated light state based on GET reply: %s", message)
+
+
+def build_frames(config):
+    """Return one SET reply and one GET request/reply pair per configured light."""
+    frames = []
+    for i, light in enumerate(config):
+        module, relay = parse_address(light["address"])
+        state = i & 1
+        frames.append(can.Message(arbitration_id=ARBIT_SET_REPLY, data=[module, relay, state], is_extended_id=True,
+                                  timestamp=time.time()))
+        frames.append(can.Message(arbitration_id=ARBIT_GET_REQUEST, data=[module, relay], is_extended_id=True))
+        frames.append(can.Message(arbitration_id=ARBIT_GET_REPLY, data=[state], is_extended_id=True))
+    return frames
+
+
+def run_once(handler, table, frames, rounds):
+    """Feed rounds x frames through handler and return the elapsed seconds."""
+    client = NullClient()
+    pending_gets = deque()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for message in frames:
+            handler(message, table, client, pending_gets)
+    return time.perf_counter() - start
+
+
+def main(total=300_000, repeat=7):
+    config = load_config(CONFIG_PATH)
+    can_to_mqtt, _ = build_lookup_tables(config)
+    relays = RelayTable(can_to_mqtt)
+    frames = build_frames(config)
+    rounds = max(1, total // len(frames))
+
+    # Interleave the runs and keep the best of each so that background noise
+    # affects both variants alike.
+    before = after = float("inf")
+    for _ in range(repeat):
+        before = min(before, run_once(legacy_handle_can_message, can_to_mqtt, frames, rounds))
+        after = min(after, run_once(handle_can_message, relays, frames, rounds))
+
+    count = rounds * len(frames)
+    print(f"before (if-chain, tuple keys): {count / before:12,.0f} frames/s")
+    print(f"after  (dispatch, flat index): {count / after:12,.0f} frames/s")
+    print(f"speed-up: {before / after:.2f}x")
+
+    for schema in PAYLOAD_SCHEMAS:
+        relays = RelayTable(can_to_mqtt)
+        apply_payload_schemas(relays, config, default=schema)
+        best = min(run_once(handle_can_message, relays, frames, rounds) for _ in range(repeat))
+        print(f"schema {schema:<12}           {count / best:12,.0f} frames/s")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 300_000)
@@ -0,0 +1,133 @@
+"""Benchmark of the raw SocketCAN receive path against per-frame can.Message objects.
+
+"message" decodes each 16-byte can_frame into a can.Message (as python-can's
+socketcan backend does) and calls handle_can_message; "raw" walks the same
+buffer with rawcan.iter_frames and calls dispatch_can_frame. "socketpair"
+runs RawCanBus.recv_batch end to end over a SOCK_SEQPACKET socketpair, so no
+vcan device is needed.
+
+Run with:  python3 benchmarks/bench_rawcan.py [frames]
+"""
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import can
+
+from can2mqtt import (
+    ARBIT_GET_REPLY,
+    ARBIT_GET_REQUEST,
+    ARBIT_SET_REPLY,
+    RelayTable,
+    build_lookup_tables,
+    dispatch_can_frame,
+    handle_can_message,
+    load_config,
+    parse_address,
+)
+from rawcan import CAN_EFF_MASK, CAN_FRAME_SIZE, RawCanBus, iter_frames, pack_frame
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.yaml")
+
+_FRAME = struct.Struct("=IB3x8s")
+
+
+class NullClient:
+    """MQTT client stand-in whose publish() does nothing."""
+
+    def publish(self, topic, payload, retain=False):
+        pass
+
+
+def build_buffer(config):
+    """Return a bytearray with a SET reply and a GET request/reply per light."""
+    buf = bytearray()
+    for i, light in enumerate(config):
+        module, relay = parse_address(light["address"])
+        state = i & 1
+        buf += pack_frame(ARBIT_SET_REPLY, [module, relay, state])
+        buf += pack_frame(ARBIT_GET_REQUEST, [module, relay])
+        buf += pack_frame(ARBIT_GET_REPLY, [state])
+    return buf
+
+
+def run_message(buf, relays, rounds):
+    client = NullClient()
+    pending_gets = deque()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for can_id, length, data in _FRAME.iter_unpack(buf):
+            message = can.Message(
+                arbitration_id=can_id & CAN_EFF_MASK, data=data[:length], is_extended_id=True
+            )
+            handle_can_message(message, relays, client, pending_gets)
+    return time.perf_counter() - start
+
+
+def run_raw(buf, relays, rounds):
+    client = NullClient()
+    pending_gets = deque()
+    nbytes = len(buf)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for arbitration_id, data in iter_frames(buf, nbytes):
+            dispatch_can_frame(arbitration_id, data, relays, client, pending_gets)
+    return time.perf_counter() - start
+
+
+def run_socketpair(buf, relays, count):
+    """Push count frames through a socketpair and time the receiving side."""
+    left, right = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    bus = RawCanBus(right)
+    frames = [bytes(buf[i:i + CAN_FRAME_SIZE]) for i in range(0, len(buf), CAN_FRAME_SIZE)]
+
+    def produce():
+        for i in range(count):
+            left.send(frames[i % len(frames)])
+
+    client = NullClient()
+    pending_gets = deque()
+    producer = threading.Thread(target=produce)
+    received = 0
+    start = time.perf_counter()
+    producer.start()
+    while received < count:
+        for arbitration_id, data in bus.recv_batch(timeout=1.0):
+            dispatch_can_frame(arbitration_id, data, relays, client, pending_gets)
+            received += 1
+    elapsed = time.perf_counter() - start
+    producer.join()
+    left.close()
+    bus.shutdown()
+    return elapsed
+
+
+def main(total=300_000, repeat=5):
+    config = load_config(CONFIG_PATH)
+    can_to_mqtt, _ = build_lookup_tables(config)
+    relays = RelayTable(can_to_mqtt)
+    buf = build_buffer(config)
+    frames_per_round = len(buf) // CAN_FRAME_SIZE
+    rounds = max(1, total // frames_per_round)
+    count = rounds * frames_per_round
+
+    message = raw = float("inf")
+    for _ in range(repeat):
+        message = min(message, run_message(buf, relays, rounds))
+        raw = min(raw, run_raw(buf, relays, rounds))
+    pair = run_socketpair(buf, relays, min(count, 100_000))
+
+    print(f"can.Message + handle_can_message: {count / message:12,.0f} frames/s")
+    print(f"iter_frames + dispatch_can_frame: {count / raw:12,.0f} frames/s")
+    print(f"speed-up: {message / raw:.2f}x")
+    print(f"socketpair recv_batch end to end: {min(count, 100_000) / pair:12,.0f} frames/s")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 300_000)
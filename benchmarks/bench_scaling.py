@@ -0,0 +1,140 @@
+"""Scaling benchmark over synthetic installations of increasing size.
+
+For each size a fresh process loads a generated config.yaml and measures
+config load time, lookup-table build time (build_lookup_tables plus
+RelayTable), subscription time (the on_connect callback against a client
+stand-in), per-frame cost of dispatch_can_frame for SET replies spread
+over every light, per-message cost of handle_mqtt_message, and the
+resident memory the loaded config and tables add.
+
+Run with:  python3 benchmarks/bench_scaling.py [size ...]   (default 18 1000 10000 65536)
+"""
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from can2mqtt import (
+    ARBIT_SET_REPLY,
+    REFRESH_GET_TOPICS,
+    REFRESH_TOPIC,
+    RelayTable,
+    build_lookup_tables,
+    dispatch_can_frame,
+    handle_mqtt_message,
+    load_config,
+    make_on_connect,
+    parse_address,
+)
+from gen_config import write_config
+
+MESSAGES = 200_000
+
+
+class NullClient:
+    """MQTT client stand-in: counts SUBSCRIBE calls, drops publishes."""
+
+    def __init__(self):
+        self.subscriptions = 0
+
+    def subscribe(self, topic):
+        self.subscriptions += 1
+
+    def publish(self, topic, payload, retain=False):
+        pass
+
+
+class NullBus:
+    def send(self, message):
+        pass
+
+
+def rss_kib():
+    with open("/proc/self/statm") as file:
+        return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+
+
+def measure(path, results):
+    clock = time.perf_counter
+    rss_before = rss_kib()
+
+    start = clock()
+    config = load_config(path)
+    load_s = clock() - start
+
+    start = clock()
+    can_to_mqtt, mqtt_to_can = build_lookup_tables(config)
+    relays = RelayTable(can_to_mqtt)
+    build_s = clock() - start
+    rss_after = rss_kib()
+
+    client = NullClient()
+    on_connect = make_on_connect(config, extra_topics=(REFRESH_GET_TOPICS, REFRESH_TOPIC))
+    start = clock()
+    on_connect(client, None, None, 0)
+    subscribe_s = clock() - start
+
+    addresses = [parse_address(light["address"]) for light in config]
+    frames = [bytes([module, relay, i & 1]) for i, (module, relay) in enumerate(addresses)]
+    rounds = max(1, MESSAGES // len(frames))
+    start = clock()
+    for _ in range(rounds):
+        for data in frames:
+            dispatch_can_frame(ARBIT_SET_REPLY, data, relays, client)
+    can_ns = (clock() - start) / (rounds * len(frames)) * 1e9
+
+    topics = [f"dobiss/light/{light['address']}/state/set" for light in config]
+    bus = NullBus()
+    rounds = max(1, (MESSAGES // 4) // len(topics))
+    start = clock()
+    for _ in range(rounds):
+        for topic in topics:
+            handle_mqtt_message(topic, b"ON", mqtt_to_can, bus)
+    mqtt_ns = (clock() - start) / (rounds * len(topics)) * 1e9
+
+    results.put({
+        "lights": len(config),
+        "load_s": load_s,
+        "build_s": build_s,
+        "subscribe_s": subscribe_s,
+        "subscriptions": client.subscriptions,
+        "can_ns": can_ns,
+        "mqtt_ns": mqtt_ns,
+        "rss_mib": (rss_after - rss_before) / 1024,
+    })
+
+
+def main(sizes):
+    rows = []
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            path = os.path.join(directory, f"config-{size}.yaml")
+            with open(path, "w") as file:
+                write_config(size, file)
+            results = multiprocessing.Queue()
+            process = multiprocessing.Process(target=measure, args=(path, results))
+            process.start()
+            rows.append(results.get())
+            process.join()
+
+    print(f"{'lights':>7} {'load s':>8} {'build s':>8} {'subscribe s':>12} {'SUBSCRIBEs':>11}"
+          f" {'CAN ns/frame':>13} {'MQTT ns/msg':>12} {'RSS MiB':>8}")
+    for row in rows:
+        print(f"{row['lights']:>7} {row['load_s']:>8.3f} {row['build_s']:>8.3f} {row['subscribe_s']:>12.4f}"
+              f" {row['subscriptions']:>11} {row['can_ns']:>13.0f} {row['mqtt_ns']:>12.0f} {row['rss_mib']:>8.1f}")
+    # Per-light cost relative to the smallest run shows where growth is not linear.
+    base = rows[0]
+    print("\nper-light cost relative to %d lights:" % base["lights"])
+    for row in rows[1:]:
+        ratio = base["lights"] / row["lights"]
+        print(f"{row['lights']:>7}  load x{row['load_s'] * ratio / base['load_s']:.2f}"
+              f"  build x{row['build_s'] * ratio / base['build_s']:.2f}"
+              f"  CAN x{row['can_ns'] / base['can_ns']:.2f}  MQTT x{row['mqtt_ns'] / base['mqtt_ns']:.2f}")
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or [18, 1000, 10000, 65536])
@@ -0,0 +1,95 @@
+"""Read-rate benchmark for the shared-memory relay state export.
+
+A reader process attaches to a StateExport block while the parent keeps
+writing state changes, and measures single-relay reads, consistent
+multi-relay reads of every configured light and full-table snapshots. A
+plain in-process bytearray lookup is shown as the ceiling.
+
+Run with:  python3 benchmarks/bench_shmstate.py [reads]
+"""
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from can2mqtt import load_config, parse_address, relay_key
+from shmstate import SLOTS, StateExport, StateReader
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.yaml")
+
+
+def measure(label, func, count, results):
+    start = time.perf_counter()
+    func(count)
+    elapsed = time.perf_counter() - start
+    results.put(f"{label:<38}{count / elapsed:14,.0f} reads/s")
+
+
+def reader_main(name, keys, count, results):
+    reader = StateReader.attach(name)
+    local = bytearray(SLOTS)
+    key = keys[0]
+
+    def baseline(n):
+        for _ in range(n):
+            local[key]
+
+    def single(n):
+        state = reader.state
+        for _ in range(n):
+            state(key)
+
+    def direct(n):
+        states = reader.states
+        for _ in range(n):
+            states[key]
+
+    def consistent(n):
+        for _ in range(n):
+            reader.read(keys)
+
+    def snapshot(n):
+        for _ in range(n):
+            reader.snapshot()
+
+    measure("bytearray (in-process baseline)", baseline, count, results)
+    measure("reader.states[key] (zero-copy view)", direct, count, results)
+    measure("reader.state(key)", single, count, results)
+    measure(f"reader.read({len(keys)} lights), seqlock", consistent, count // 10, results)
+    measure("reader.snapshot() (64 KiB)", snapshot, count // 100, results)
+    results.put(None)
+    reader.close()
+
+
+def main(count=2_000_000):
+    keys = [relay_key(*parse_address(light["address"])) for light in load_config(CONFIG_PATH)]
+    export = StateExport.create()
+    stop = threading.Event()
+    writes = [0]
+
+    def writer():
+        # Toggle lights at ~1 kHz, far above what the bus can carry.
+        while not stop.is_set():
+            export.set(keys[writes[0] % len(keys)], writes[0] & 1)
+            writes[0] += 1
+            time.sleep(0.001)
+
+    thread = threading.Thread(target=writer, daemon=True)
+    thread.start()
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=reader_main, args=(export.name, keys, count, results))
+    process.start()
+    for line in iter(results.get, None):
+        print(line)
+    process.join()
+    stop.set()
+    thread.join()
+    print(f"concurrent writes during the run: {writes[0]:,}")
+    export.close()
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2_000_000)
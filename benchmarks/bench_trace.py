@@ -0,0 +1,79 @@
+"""Overhead of the always-on trace ring on the CAN receive path.
+
+Feeds the same frame mix through dispatch_can_frame() the way run_can_loop()
+does, once without a TraceRing and once recording every frame into one.
+
+Run with:  python3 benchmarks/bench_trace.py [frames]
+"""
+import os
+import sys
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from can2mqtt import (
+    ARBIT_GET_REPLY,
+    ARBIT_GET_REQUEST,
+    ARBIT_SET_REPLY,
+    RelayTable,
+    build_lookup_tables,
+    dispatch_can_frame,
+    load_config,
+    parse_address,
+)
+from profiling import TraceRing
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.yaml")
+
+
+class NullClient:
+    def publish(self, topic, payload, retain=False):
+        pass
+
+
+def build_frames(config):
+    frames = []
+    for i, light in enumerate(config):
+        module, relay = parse_address(light["address"])
+        frames.append((ARBIT_SET_REPLY, bytes([module, relay, i & 1])))
+        frames.append((ARBIT_GET_REQUEST, bytes([module, relay])))
+        frames.append((ARBIT_GET_REPLY, bytes([i & 1])))
+    return frames
+
+
+def run_once(relays, frames, rounds, trace):
+    client = NullClient()
+    pending_gets = deque()
+    clock = time.perf_counter
+    start = clock()
+    for _ in range(rounds):
+        for arbitration_id, data in frames:
+            started = clock()
+            dispatch_can_frame(arbitration_id, data, relays, client, pending_gets)
+            if trace is not None:
+                trace.record(arbitration_id, started)
+    return clock() - start
+
+
+def main(total=300_000, repeat=7):
+    config = load_config(CONFIG_PATH)
+    can_to_mqtt, _ = build_lookup_tables(config)
+    relays = RelayTable(can_to_mqtt)
+    frames = build_frames(config)
+    rounds = max(1, total // len(frames))
+    trace = TraceRing()
+
+    plain = traced = float("inf")
+    for _ in range(repeat):
+        plain = min(plain, run_once(relays, frames, rounds, None))
+        traced = min(traced, run_once(relays, frames, rounds, trace))
+
+    count = rounds * len(frames)
+    print(f"without trace ring: {count / plain:12,.0f} frames/s")
+    print(f"with trace ring:    {count / traced:12,.0f} frames/s")
+    print(f"cost per frame: {(traced - plain) / count * 1e9:.0f} ns")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 300_000)
@@ -0,0 +1,37 @@
+"""Generate synthetic config.yaml files for large installations.
+
+Lights are spread over modules the way a real installation fills them:
+relay 0-255 on module 1, then module 2 and so on; a full 65,536-relay
+config also uses module 0. Every tenth light gets an auto_off.
+
+Run with:  python3 benchmarks/gen_config.py <lights> > config-big.yaml
+"""
+import sys
+
+import yaml
+
+MAX_LIGHTS = 1 << 16
+
+
+def generate_config(count):
+    """Return a config list with count lights at distinct addresses."""
+    if not 0 < count <= MAX_LIGHTS:
+        raise ValueError(f"count must be between 1 and {MAX_LIGHTS}")
+    config = []
+    for index in range(count):
+        # Module 0 comes last so that smaller configs look like real ones.
+        module = ((index >> 8) + 1) & 0xFF
+        relay = index & 0xFF
+        light = {"name": f"Module {module} Relay {relay}", "address": f"{module:02X}{relay:02X}"}
+        if index % 10 == 9:
+            light["auto_off"] = 600
+        config.append(light)
+    return config
+
+
+def write_config(count, file):
+    yaml.safe_dump(generate_config(count), file, sort_keys=False)
+
+
+if __name__ == "__main__":
+    write_config(int(sys.argv[1]), sys.stdout)
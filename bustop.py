@@ -0,0 +1,335 @@
+"""Live "top"-style console view of the Dobiss CAN bus.
+
+Attaches either to a CAN interface (every frame, no filters) or to a
+running bridge's HTTP stats, and redraws a table every interval seconds:
+
+- frames per second and bus utilisation, overall and per arbitration ID;
+- GET requests against GET replies, and GETs still waiting for a reply;
+- SET request to SET reply latency percentiles per module;
+- the relays that toggled most often, named from config.yaml.
+
+Frames are decoded with the protocol constants and handlers of can2mqtt
+(dispatch_can_frame() into a RelayTable), so the view agrees with what the
+bridge sees. Per frame BusTop.add() only bumps a few counters; rates and
+percentiles are computed when the table is drawn. Receiving and drawing
+happen on one thread, and frames that arrive while the table is drawn wait
+in the socket's receive queue.
+
+Utilisation counts 67 bits of an extended frame plus its data bytes and
+ignores stuff bits, so it is a lower bound.
+
+In bridge mode (--bridge http://host:8000) the frame counts come from the
+bridge's "can" trace ring (/debug/trace), so they only cover the frames that
+pass its CAN filters, toggles come from /history and latencies from
+/snoop.json (when SNOOP_SET_REQUESTS is on).
+
+Run with:  python3 bustop.py [--channel can0] [--backend raw] [--interval 1]
+           python3 bustop.py --bridge http://localhost:8000
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import urllib.request
+from collections import Counter, deque
+
+import can
+
+from can2mqtt import (
+    ARBIT_GET_REPLY,
+    ARBIT_GET_REQUEST,
+    ARBIT_SET_REPLY,
+    ARBIT_SET_REQUEST,
+    CAN_BACKEND,
+    CAN_CHANNEL,
+    CAN_INTERFACE,
+    SET_REQUEST_MASK,
+    PassiveClient,
+    RelayTable,
+    dispatch_can_frame,
+    load_config,
+    parse_address,
+    relay_key,
+)
+
+BITRATE = 125000
+FRAME_OVERHEAD_BITS = 67   # extended data frame without data bytes and stuff bits
+LATENCY_SAMPLES = 256      # SET latencies kept per module
+PENDING_LIMIT = 256        # GET requests and SET requests remembered while awaiting replies
+TOP_IDS = 12               # arbitration IDs shown
+TOP_RELAYS = 10            # relays shown
+
+# Data length of each frame type, for the bridge feed that only sees IDs.
+_DLC = {ARBIT_GET_REQUEST: 2, ARBIT_GET_REPLY: 1, ARBIT_SET_REPLY: 3}
+_SET_REQUEST_DLC = 5
+
+
+def describe(arbitration_id):
+    """Name the Dobiss frame type of arbitration_id."""
+    if arbitration_id == ARBIT_GET_REQUEST:
+        return "GET request"
+    if arbitration_id == ARBIT_GET_REPLY:
+        return "GET reply"
+    if arbitration_id == ARBIT_SET_REPLY:
+        return "SET reply"
+    if arbitration_id & SET_REQUEST_MASK == ARBIT_SET_REQUEST:
+        return "SET request %02X" % (arbitration_id >> 8 & 0xFF)
+    return ""
+
+
+def _percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class BusTop:
+    """Incremental frame statistics for the console view.
+
+    Usage::
+
+        top = BusTop(names)
+        for arbitration_id, data in bus.recv_batch():
+            top.add(arbitration_id, data, now)
+        print(render(top.snapshot()))
+    """
+
+    def __init__(self, names=None, bitrate=BITRATE, samples=LATENCY_SAMPLES):
+        self.names = names or {}
+        self.bitrate = bitrate
+        self.samples = samples
+        self.frames = 0
+        self.totals = Counter()     # arbitration ID -> frames since start
+        self._counts = Counter()    # arbitration ID -> frames since the last snapshot
+        self._bits = 0              # bits since the last snapshot
+        self._since = time.monotonic()
+        # relay key -> timestamp of the SET request awaiting its reply
+        self._requested = {}
+        self.latencies = {}         # module -> deque of SET latencies (s)
+        self.toggles = Counter()    # relay key -> state changes
+        self._seen = set()          # relays whose first state was seen
+        self.pending_gets = deque(maxlen=PENDING_LIMIT)
+        self.relays = RelayTable({})
+        self.relays.listeners.append(self._on_transition)
+        self._client = PassiveClient()
+
+    def _on_transition(self, key, state):
+        # The first state seen of a relay is not a toggle.
+        if key in self._seen:
+            self.toggles[key] += 1
+        else:
+            self._seen.add(key)
+
+    def add(self, arbitration_id, data, timestamp):
+        """Count and decode one frame received at wall-clock time timestamp."""
+        self._counts[arbitration_id] += 1
+        self._bits += FRAME_OVERHEAD_BITS + 8 * len(data)
+        if arbitration_id & SET_REQUEST_MASK == ARBIT_SET_REQUEST:
+            requested = self._requested
+            if len(requested) >= PENDING_LIMIT:
+                requested.clear()  # replies that never came
+            requested[data[0] << 8 | data[1]] = timestamp
+        elif arbitration_id == ARBIT_SET_REPLY:
+            requested = self._requested.pop(data[0] << 8 | data[1], None)
+            if requested is not None:
+                module = data[0]
+                latencies = self.latencies.get(module)
+                if latencies is None:
+                    latencies = self.latencies[module] = deque(maxlen=self.samples)
+                latencies.append(timestamp - requested)
+        self.relays.received = timestamp
+        dispatch_can_frame(arbitration_id, data, self.relays, self._client, self.pending_gets)
+
+    def add_id(self, arbitration_id):
+        """Count one frame of which only the arbitration ID is known."""
+        self._counts[arbitration_id] += 1
+        dlc = _DLC.get(arbitration_id, _SET_REQUEST_DLC)
+        self._bits += FRAME_OVERHEAD_BITS + 8 * dlc
+
+    def snapshot(self, now=None):
+        """Return the table contents; rates cover the time since the previous snapshot."""
+        now = time.monotonic() if now is None else now
+        elapsed = max(now - self._since, 1e-9)
+        counts, self._counts = self._counts, Counter()
+        bits, self._bits = self._bits, 0
+        self._since = now
+        self.totals.update(counts)
+        frames = sum(counts.values())
+        self.frames += frames
+        ids = sorted(set(self.totals), key=lambda i: (-counts[i], -self.totals[i], i))[:TOP_IDS]
+        latency = {}
+        for module, samples in sorted(self.latencies.items()):
+            ordered = sorted(samples)
+            latency[module] = {
+                "count": len(ordered),
+                "p50_ms": _percentile(ordered, 0.5) * 1000,
+                "p99_ms": _percentile(ordered, 0.99) * 1000,
+                "max_ms": ordered[-1] * 1000,
+            }
+        return {
+            "elapsed": elapsed,
+            "fps": frames / elapsed,
+            "utilisation": bits / elapsed / self.bitrate,
+            "frames": self.frames,
+            "ids": [(i, describe(i), counts[i] / elapsed, self.totals[i]) for i in ids],
+            "get": {
+                "requests": self.totals[ARBIT_GET_REQUEST],
+                "replies": self.totals[ARBIT_GET_REPLY],
+                "waiting": len(self.pending_gets),
+            },
+            "latency": latency,
+            "hot": [(key, self.names.get(key, ""), count) for key, count in self.toggles.most_common(TOP_RELAYS)],
+        }
+
+
+def render(snapshot):
+    """Format a BusTop.snapshot() as the console table."""
+    lines = [
+        "bus top  %7.1f frames/s  %5.1f%% utilisation  %d frames" % (
+            snapshot["fps"], snapshot["utilisation"] * 100, snapshot["frames"]),
+        "",
+        "%-10s %-16s %10s %10s" % ("ID", "frame", "frames/s", "total"),
+    ]
+    for arbitration_id, label, rate, total in snapshot["ids"]:
+        lines.append("%08X   %-16s %10.1f %10d" % (arbitration_id, label, rate, total))
+    get = snapshot["get"]
+    lines += ["", "GET  %d requests  %d replies  %d waiting" % (get["requests"], get["replies"], get["waiting"]),
+              "", "%-8s %8s %9s %9s %9s" % ("module", "SETs", "p50 ms", "p99 ms", "max ms")]
+    for module, stats in snapshot["latency"].items():
+        lines.append("%-8s %8d %9.1f %9.1f %9.1f" % (
+            "%02X" % module, stats["count"], stats["p50_ms"], stats["p99_ms"], stats["max_ms"]))
+    lines += ["", "%-8s %8s  %s" % ("relay", "toggles", "name")]
+    for key, name, count in snapshot["hot"]:
+        lines.append("%-8s %8d  %s" % ("%04X" % key, count, name))
+    return "\n".join(lines)
+
+
+def load_names(path):
+    """Map relay_key() to light name for the lights in config.yaml at path."""
+    if not path or not os.path.exists(path):
+        return {}
+    return {relay_key(*parse_address(light["address"])): light["name"] for light in load_config(path)}
+
+
+def open_bus(interface=CAN_INTERFACE, channel=CAN_CHANNEL, backend=CAN_BACKEND):
+    """Open the bus without filters, so that every frame is seen."""
+    if backend == "raw":
+        from rawcan import RawCanBus
+        return RawCanBus.open(channel, receive_own_messages=False)
+    return can.Bus(interface=interface, channel=channel, bitrate=BITRATE)
+
+
+def receive(bus, top, until):
+    """Feed top with frames from bus until time.monotonic() reaches until."""
+    if hasattr(bus, "recv_batch"):
+        while True:
+            remaining = until - time.monotonic()
+            if remaining <= 0:
+                return
+            batch = bus.recv_batch(timeout=remaining)
+            if batch:
+                now = time.time()
+                for arbitration_id, data in batch:
+                    top.add(arbitration_id, data, now)
+    else:
+        while True:
+            remaining = until - time.monotonic()
+            if remaining <= 0:
+                return
+            message = bus.recv(timeout=remaining)
+            if message is not None and not message.is_error_frame:
+                top.add(message.arbitration_id, message.data, message.timestamp)
+
+
+class BridgeFeed:
+    """Feed a BusTop from a running bridge's HTTP endpoints."""
+
+    def __init__(self, url, top, timeout=2.0):
+        self.url = url.rstrip("/")
+        self.top = top
+        self.timeout = timeout
+        self.started = time.time()
+        self._last = self.started  # timestamp of the newest trace entry counted
+
+    def _get(self, path):
+        try:
+            with urllib.request.urlopen(self.url + path, timeout=self.timeout) as response:
+                return json.load(response)
+        except (OSError, ValueError):
+            return None
+
+    def poll(self):
+        """Count the trace entries recorded since the last poll and fetch toggles and latencies."""
+        top = self.top
+        traces = self._get("/debug/trace")
+        if traces and "can" in traces:
+            newest = self._last
+            for entry in traces["can"]["entries"]:
+                if entry["timestamp"] > self._last:
+                    top.add_id(int(entry["label"], 16))
+                    newest = max(newest, entry["timestamp"])
+            self._last = newest
+        history = self._get(f"/history?from={self.started}")
+        if history:
+            for summary in history:
+                key = relay_key(*parse_address(summary["address"]))
+                if summary["toggles"]:
+                    top.toggles[key] = summary["toggles"]
+        snoop = self._get("/snoop.json")
+        self.latency = {}
+        if snoop:
+            for module, stats in snoop["modules"].items():
+                if stats["latency_ms"] is not None:
+                    self.latency[int(module, 16)] = {
+                        "count": stats["panel"] + stats["bridge"],
+                        "p50_ms": stats["latency_ms"]["p50"],
+                        "p99_ms": stats["latency_ms"]["p99"],
+                        "max_ms": stats["latency_ms"]["max"],
+                    }
+
+
+def main(argv=None, out=sys.stdout):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--interface", default=CAN_INTERFACE, help="python-can interface (default %(default)s)")
+    parser.add_argument("--channel", default=CAN_CHANNEL, help="CAN channel (default %(default)s)")
+    parser.add_argument("--backend", default=CAN_BACKEND, choices=("python-can", "raw"))
+    parser.add_argument("--bridge", help="read a running bridge's HTTP stats at this URL instead")
+    parser.add_argument("--config", default="config.yaml", help="light names (default %(default)s)")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between redraws")
+    parser.add_argument("--iterations", type=int, help="stop after this many redraws")
+    args = parser.parse_args(argv)
+
+    top = BusTop(load_names(args.config))
+    feed = bus = None
+    if args.bridge:
+        feed = BridgeFeed(args.bridge, top)
+    else:
+        bus = open_bus(args.interface, args.channel, args.backend)
+    clear = "\x1b[H\x1b[2J" if out.isatty() else ""
+    redraws = 0
+    next_at = time.monotonic() + args.interval
+    try:
+        while args.iterations is None or redraws < args.iterations:
+            if feed is not None:
+                time.sleep(max(0.0, next_at - time.monotonic()))
+                feed.poll()
+                snapshot = top.snapshot()
+                snapshot["latency"] = feed.latency
+            else:
+                receive(bus, top, next_at)
+                snapshot = top.snapshot()
+            out.write(clear + render(snapshot) + "\n")
+            out.flush()
+            redraws += 1
+            # Skip redraws rather than queue them when drawing fell behind.
+            next_at = max(next_at + args.interval, time.monotonic())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if bus is not None:
+            bus.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
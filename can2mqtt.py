@@ -1,25 +1,162 @@
+from array import array
 from collections import deque
 import can
 import paho.mqtt.client as mqtt
 import yaml
+import bisect
+import functools
+import gzip
+import hashlib
+import json
 import logging
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import math
+import multiprocessing
+import os
+import queue
+import signal
+import socket
+import struct
+import time
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 import threading
 
+from profiling import SamplingProfiler, TraceRing
+from timerwheel import TimerWheel
+
 logger = logging.getLogger(__name__)
 
 # MQTT settings
 MQTT_BROKER = "localhost"
 MQTT_PORT = 1883
+AVAILABILITY_TOPIC = "dobiss/availability"  # retained "online"/"offline"; "offline" is also the last will
 
 # CAN settings
 CAN_INTERFACE = "socketcan"
 CAN_CHANNEL = "can0"
+CAN_BACKEND = "python-can"  # or "raw" for the batched AF_CAN receiver in rawcan.py
+
+# HTTP settings
+HTTP_PORT = 8000
+SSE_BACKLOG = 1024         # events a /events client may fall behind before it is dropped
+SSE_KEEPALIVE = 15.0       # seconds between keepalive comments on an idle stream
+SSE_WRITE_TIMEOUT = 5.0    # seconds a /events client may block a write
+BULK_REPLY_TIMEOUT = 2.0   # seconds POST /lights waits for SET replies
+BULK_POLL_INTERVAL = 0.005  # seconds between checks for those replies
+HISTORY_DEPTH = 256        # transitions kept per relay (power of two)
+HISTORY_RELAYS = 1024      # relays that get a history; memory is fixed at ~9 bytes x depth x relays
+HISTORY_DEFAULT_RANGE = 86400.0  # seconds /history covers when no range is given
+
+# Deployment settings
+SPLIT_PROCESSES = False    # run CAN I/O and MQTT I/O in separate processes
+RING_CAPACITY = 4096       # frames buffered per direction in split mode
+RING_POLL_INTERVAL = 0.001  # seconds an idle ring consumer sleeps
+RESTART_BACKOFF = 1.0      # seconds between supervisor liveness checks
+STATE_EXPORT_NAME = None   # shared memory block name (e.g. "dobiss_states") to mirror relay states into
+SHUTDOWN_TIMEOUT = 5.0     # seconds SIGTERM handling may spend draining queues
+RELAY_STATE_PATH = "states.json"  # relay states saved on shutdown and loaded at startup
+
+# On-demand refresh settings
+REFRESH_TOPIC = "dobiss/refresh"
+REFRESH_GET_TOPICS = "dobiss/light/+/state/get"
+REFRESH_MAX_AGE = 2.0      # seconds a reported state is served from cache
+GET_TIMEOUT = 1.0          # seconds before an unanswered GET may be re-sent
+
+# CAN transmit scheduling
+CAN_TX_FRAME_TIME = 0.0012  # seconds one extended 8-byte frame occupies the bus at 125 kbit/s
+TX_STARVATION_LIMIT = 0.5  # seconds a lower-class frame may wait before it is sent out of turn
+TX_WAIT_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)  # histogram bounds (s)
+TX_COLLAPSE_SETS = True    # a newer SET request replaces a queued one for the same relay
+
+# Dimmers (lights with "dimmer: true" in config.yaml)
+BRIGHTNESS_SET_TOPICS = "dobiss/light/+/brightness/set"
+DIMMER_MIN_INTERVAL = 0.05  # seconds between brightness frames to one dimmer
+DIMMER_REPLY_TIMEOUT = 0.5  # seconds a brightness frame may go unanswered before the next is sent
+
+# Command freshness
+COMMAND_MAX_AGE = 5.0      # seconds a SET may wait to be sent, and oldest "ts" accepted (None: no limit)
+
+# Wall-panel snooping
+SNOOP_SET_REQUESTS = False  # also receive other participants' SET requests (see SetSnooper)
+SNOOP_ECHO_WINDOW = 1.0    # seconds within which a SET request matching one we sent is our echo
+SNOOP_LATENCY_SAMPLES = 256  # request-to-reply latencies kept per module
+
+# Liveness watchdog
+WATCHDOG_INTERVAL = 2.0    # seconds between checks; shortened to half of systemd's WatchdogSec
+WATCHDOG_CAN_TIMEOUT = 10.0  # seconds without a received frame before the CAN side is stalled
+WATCHDOG_REOPEN_BACKOFF = 1.0  # first delay between bus reopen attempts, doubled per failure
+WATCHDOG_REOPEN_MAX_BACKOFF = 60.0
+
+# Hot standby (single-process mode)
+STANDBY_ENABLED = False    # start passive and take over when the active instance's heartbeat stops
+INSTANCE_ID = socket.gethostname()  # unique per instance; of two active instances the lowest id stays
+LEADER_TOPIC = "dobiss/leader"  # retained "<instance id>" heartbeat of the active instance
+LEADER_HEARTBEAT = 1.0     # seconds between heartbeats
+LEADER_TIMEOUT = 5.0       # seconds without a heartbeat before a standby takes over
+
+# Home Assistant MQTT discovery
+DISCOVERY_ENABLED = False  # publish discovery documents for every configured light
+DISCOVERY_PREFIX = "homeassistant"
+DISCOVERY_CACHE_PATH = "discovery.json"  # hashes of what was published; delete to republish all
+DISCOVERY_RATE = 20.0      # discovery messages per second
+DISCOVERY_CHECK_INTERVAL = 5.0  # seconds between config.yaml change checks
+
+# Diagnostics
+TRACE_CAPACITY = 4096      # messages per stage kept in the always-on trace rings
+PROFILE_SECONDS = 10.0     # length of a capture triggered by SIGUSR1
+PROFILE_MAX_SECONDS = 120.0  # longest capture POST /debug/profile accepts
+PROFILE_INTERVAL = 0.005   # seconds between stack samples while profiling
+PROFILE_DIR = "."          # where profile-*.folded and trace-*.json dumps are written
+
+# Timer settings (auto-off and delayed commands)
+TIMER_TICK = 0.1           # seconds per timer wheel tick
+TIMER_STATE_PATH = "timers.json"
+TIMER_SAVE_INTERVAL = 1.0  # minimum seconds between timer snapshots
+TIMER_MAX_DELAY = 30 * 86400.0  # longest "delay" or "auto_off" accepted, in seconds
 
 # CAN protocol arbitration IDs (Dobiss, reverse-engineered by dries007)
 ARBIT_GET_REQUEST = 0x01FCFF01  # GET state request:  [module, relay]
 ARBIT_GET_REPLY   = 0x01FDFF01  # GET state reply:    [state]
 ARBIT_SET_REPLY   = 0x0002FF01  # SET state reply:    [module, relay, state]
+ARBIT_SET_REQUEST = 0x01FC0002  # SET state request:  [module, relay, state, FF, FF], | module << 8
+SET_REQUEST_MASK  = 0x1FFF00FF  # matches a SET request of any module
+
+# CAN transmit classes, highest priority first
+TX_INTERACTIVE = 0  # MQTT commands and rule reactions
+TX_BATCH = 1        # POST /lights batches and timers
+TX_BACKGROUND = 2   # GET polls
+TX_CLASSES = ("interactive", "batch", "background")
+
+# Relay state values kept in RelayTable.states
+STATE_OFF = 0
+STATE_ON = 1
+STATE_UNKNOWN = 0xFF
+
+# State byte of a SET request that flips the relay (sent by wall panels)
+SET_TOGGLE = 2
+
+# Module and relay are single bytes, so every address fits in 16 bits.
+RELAY_SPACE = 1 << 16
+
+STATE_PAYLOADS = ("OFF", "ON")
+
+# Where a published state came from, reported by the json and timestamped
+# payload schemas.
+SOURCE_SET = 0    # SET reply frame
+SOURCE_GET = 1    # GET reply frame
+SOURCE_CACHE = 2  # RefreshCoordinator answered from the RelayTable
+PAYLOAD_SOURCES = ("set", "get", "cache")
+
+# State payload schema of lights without a "schema" key in config.yaml
+PAYLOAD_SCHEMA = "plain"
+
+_monotonic = time.monotonic
+
+CAN_FILTERS = [
+    {"can_id": ARBIT_GET_REQUEST, "can_mask": 0x1FFFFFFF, "extended": True},  # GET request (snoop)
+    {"can_id": ARBIT_SET_REPLY,   "can_mask": 0x1FFFFFFF, "extended": True},  # Reply to SET
+    {"can_id": ARBIT_GET_REPLY,   "can_mask": 0x1FFFFFFF, "extended": True},  # Reply to GET
+]
 
 
 def load_config(path="config.yaml"):
@@ -66,138 +203,2675 @@ def parse_state(payload):
     return None
 
 
-def build_set_message(module, relay, state):
-    """Build a CAN message that sets a relay to a given state."""
-    arbitration_id = 0x01FC0002 | (module << 8)
-    data = [module, relay, state, 0xFF, 0xFF]
+def parse_command(payload):
+    """Parse a state/set payload into (state, options).
+
+    Besides the plain payloads understood by parse_state(), a JSON object is
+    accepted: {"state": "ON", "auto_off": 300} turns the light off again
+    after 300 seconds, {"state": "ON", "delay": 5} sets the state in 5
+    seconds instead of now, and {"state": "ON", "ts": 1700000000.5} carries
+    the wall-clock time the sender issued the command at (see
+    CommandFreshness). {"state": "ON", "brightness": 40} sets a dimmer to
+    40%. options holds the recognised positive numbers.
+
+    Returns (None, {}) for unrecognised payloads, and for commands with an
+    option that is not finite (JSON allows Infinity and NaN) or a "delay" or
+    "auto_off" longer than TIMER_MAX_DELAY.
+    """
+    state = parse_state(payload)
+    if state is not None or not payload.startswith(b"{"):
+        return state, {}
+    try:
+        command = json.loads(payload)
+    except ValueError:
+        return None, {}
+    if not isinstance(command, dict):
+        return None, {}
+    options = {
+        name: float(command[name])
+        for name in ("delay", "auto_off", "ts", "brightness")
+        if isinstance(command.get(name), (int, float)) and command[name] > 0
+    }
+    if not all(map(math.isfinite, options.values())) \
+            or max(options.get("delay", 0.0), options.get("auto_off", 0.0)) > TIMER_MAX_DELAY:
+        return None, {}
+    return parse_state(str(command.get("state")).encode()), options
+
+
+def build_set_message(module, relay, state, level=None):
+    """Build a CAN message that sets a relay to a given state.
+
+    With a level (0-100), the dimmer form of the frame is built, which
+    carries the brightness in byte 5.
+    """
+    arbitration_id = ARBIT_SET_REQUEST | (module << 8)
+    if level is None:
+        data = [module, relay, state, 0xFF, 0xFF]
+    else:
+        data = [module, relay, state, 0xFF, 0xFF, level, 0xFF, 0xFF]
     return can.Message(arbitration_id=arbitration_id, data=data, is_extended_id=True)
 
 
-def handle_mqtt_message(topic, payload, mqtt_to_can, bus):
+def build_get_message(module, relay):
+    """Build a CAN message that requests the state of a relay."""
+    return can.Message(arbitration_id=ARBIT_GET_REQUEST, data=[module, relay], is_extended_id=True)
+
+
+def handle_mqtt_message(topic, payload, mqtt_to_can, bus, timers=None, freshness=None, dimmers=None):
     """Process an incoming MQTT message and send the corresponding CAN command.
 
     mqtt_to_can is a {set_topic: (module, relay)} dict built by build_lookup_tables().
 
+    With a TimerScheduler, every command resets the relay's pending timer,
+    "delay" commands are scheduled instead of sent and ON commands arm the
+    auto-off timer ("auto_off" option or the light's config).
+
+    With a CommandFreshness, a command whose "ts" is too old is dropped.
+    With a DimmerStreamer, a "brightness" for one of its dimmers is handed
+    to it instead of being sent directly.
+
     Returns True if a matching light was found, False otherwise.
     """
     key = mqtt_to_can.get(topic)
     if key is None:
         return False
     module, relay = key
-    state = parse_state(payload)
-    if state is not None:
-        message = build_set_message(module, relay, state)
-        bus.send(message)
-        logger.debug("Sent CAN message: %s", message)
+    state, options = parse_command(payload)
+    if state is None:
+        return True
+    if freshness is not None and "ts" in options and not freshness.issued_at(options["ts"], topic):
+        return True
+    if timers is not None:
+        if "delay" in options:
+            timers.schedule(module << 8 | relay, state, options["delay"])
+            return True
+        timers.manual(module << 8 | relay, state, options.get("auto_off"))
+    if dimmers is not None and "brightness" in options and state == STATE_ON \
+            and dimmers.set(module << 8 | relay, options["brightness"]):
+        return True
+    message = build_set_message(module, relay, state)
+    bus.send(message)
+    logger.debug("Sent CAN message: %s", message)
     return True
 
 
-def handle_can_message(message, can_to_mqtt, client, pending_gets=None):
+def relay_key(module, relay):
+    """Return the flat index of a (module, relay) address: module << 8 | relay."""
+    return module << 8 | relay
+
+
+class RelayTable:
+    """Flat CAN-side view of the whole 256 x 256 relay address space.
+
+    topics[key] holds the MQTT state topic of a configured relay (None for
+    unconfigured addresses), states[key] the last state seen on the bus
+    (STATE_UNKNOWN until a reply arrives) and updated[key] when it was seen,
+    with key = module << 8 | relay.
+    Indexing a list avoids building a (module, relay) tuple for every frame.
+
+    listeners are called as listener(key, state) on the CAN thread whenever
+    a relay's state changes; they must return quickly.
+
+    Relays with a payload schema other than plain (see apply_payload_schemas())
+    are moved from topics to encoded[key] = (topic, encoder), so the plain
+    path is untouched. received is the wall-clock timestamp of the frame
+    being dispatched, set by the receive loops before each frame.
+
+    snoop is the SetSnooper that SET requests and replies are reported to,
+    if any, and dimmers the DimmerStreamer that SET replies are reported to.
+    """
+
+    __slots__ = ("topics", "states", "updated", "listeners", "encoded", "received", "snoop", "dimmers")
+
+    def __init__(self, can_to_mqtt):
+        self.topics = [None] * RELAY_SPACE
+        self.states = bytearray([STATE_UNKNOWN]) * RELAY_SPACE
+        # time.monotonic() of the last state report per relay, 0.0 = never
+        self.updated = array("d", bytes(8 * RELAY_SPACE))
+        self.listeners = []
+        self.encoded = {}
+        self.received = 0.0
+        self.snoop = None  # SetSnooper, when SET requests are snooped
+        self.dimmers = None  # DimmerStreamer, when dimmers are configured
+        for (module, relay), topic in can_to_mqtt.items():
+            self.topics[module << 8 | relay] = topic
+
+
+def _on_get_request(data, relays, client, pending_gets):
+    # Snoop the GET request so we can correlate the reply later.
+    if pending_gets is not None:
+        pending_gets.append(data[0] << 8 | data[1])
+
+
+def _on_set_request(data, relays, client, pending_gets):
+    if relays.snoop is not None:
+        relays.snoop.on_request(data[0] << 8 | data[1], data[2], client)
+
+
+def _on_set_reply(data, relays, client, pending_gets):
+    key = data[0] << 8 | data[1]
+    state = 1 if data[2] == 1 else 0
+    if relays.snoop is not None:
+        relays.snoop.on_reply(key, state, client)
+    if relays.dimmers is not None:
+        relays.dimmers.on_reply(key, state, client)
+    previous = relays.states[key]
+    relays.states[key] = state
+    relays.updated[key] = _monotonic()
+    topic = relays.topics[key]
+    if topic is not None:
+        client.publish(topic, STATE_PAYLOADS[state], retain=True)
+        logger.debug("Published MQTT message: %s %s", topic, STATE_PAYLOADS[state])
+    elif key in relays.encoded:
+        topic, encoder = relays.encoded[key]
+        client.publish(topic, encoder(state, SOURCE_SET, relays.received), retain=True)
+    if previous != state:
+        for listener in relays.listeners:
+            listener(key, state)
+
+
+def _on_get_reply(data, relays, client, pending_gets):
+    if pending_gets:
+        key = pending_gets.popleft()
+        state = 1 if data[0] == 1 else 0
+        previous = relays.states[key]
+        relays.states[key] = state
+        relays.updated[key] = _monotonic()
+        topic = relays.topics[key]
+        if topic is not None:
+            client.publish(topic, STATE_PAYLOADS[state], retain=True)
+            logger.debug("Updated light state based on GET reply: %s %s", topic, STATE_PAYLOADS[state])
+        elif key in relays.encoded:
+            topic, encoder = relays.encoded[key]
+            client.publish(topic, encoder(state, SOURCE_GET, relays.received), retain=True)
+        if previous != state:
+            for listener in relays.listeners:
+                listener(key, state)
+
+
+# Arbitration ID -> handler(data, relays, client, pending_gets)
+CAN_HANDLERS = {
+    ARBIT_GET_REQUEST: _on_get_request,
+    ARBIT_SET_REPLY: _on_set_reply,
+    ARBIT_GET_REPLY: _on_get_reply,
+}
+# SET requests only pass the CAN filters when SNOOP_SET_REQUESTS is on.
+CAN_HANDLERS.update((ARBIT_SET_REQUEST | module << 8, _on_set_request) for module in range(256))
+
+
+def dispatch_can_frame(arbitration_id, data, relays, client, pending_gets=None):
+    """Route a raw CAN frame (arbitration ID plus data bytes) to its handler.
+
+    Frames with an arbitration ID not in CAN_HANDLERS are ignored.
+    """
+    handler = CAN_HANDLERS.get(arbitration_id)
+    if handler is not None:
+        handler(data, relays, client, pending_gets)
+
+
+def handle_can_message(message, relays, client, pending_gets=None):
     """Process an incoming CAN message and publish the corresponding MQTT state.
 
-    can_to_mqtt is a {(module, relay): state_topic} dict built by build_lookup_tables().
+    relays is a RelayTable built from the can_to_mqtt dict returned by
+    build_lookup_tables().
 
     pending_gets is a collections.deque used to pair GET requests with their
     replies. Pass the same instance on every call within a bus session; the
-    queue is populated when a GET request is snooped and consumed when the
-    matching GET reply arrives. When omitted (or None) GET replies are silently
-    ignored.
+    queue is populated with relay_key() values when a GET request is snooped
+    and consumed when the matching GET reply arrives. When omitted (or None)
+    GET replies are silently ignored.
 
     Background: the GET reply frame (0x01FDFF01) carries only a state byte — it
     contains no module/relay address. Without tracking which GET request was
     issued, it is impossible to determine which light the reply refers to.
     """
-    arb = message.arbitration_id
+    handler = CAN_HANDLERS.get(message.arbitration_id)
+    if handler is not None:
+        relays.received = message.timestamp
+        handler(message.data, relays, client, pending_gets)
+
+
+def _compile_json():
+    # Every (source, state) payload is a constant; index with source << 1 | state.
+    payloads = [
+        json.dumps({"state": STATE_PAYLOADS[state], "source": source}, separators=(",", ":"))
+        for source in PAYLOAD_SOURCES for state in (STATE_OFF, STATE_ON)
+    ]
+
+    def encode(state, source, timestamp):
+        return payloads[source << 1 | state]
+    return encode
+
+
+def _compile_timestamped():
+    # Only the timestamp is formatted per message.
+    prefixes = [
+        json.dumps({"state": STATE_PAYLOADS[state], "source": source}, separators=(",", ":"))[:-1] + ',"timestamp":'
+        for source in PAYLOAD_SOURCES for state in (STATE_OFF, STATE_ON)
+    ]
+
+    def encode(state, source, timestamp):
+        return f"{prefixes[source << 1 | state]}{timestamp:.6f}}}"
+    return encode
+
+
+# Schema name -> factory of encoder(state, source, timestamp); None is plain.
+PAYLOAD_SCHEMAS = {
+    "plain": lambda: None,
+    "json": _compile_json,
+    "timestamped": _compile_timestamped,
+}
+
+
+def apply_payload_schemas(relays, config, default=PAYLOAD_SCHEMA):
+    """Compile each light's "schema" and install the encoders in relays.encoded.
+
+    Each schema is compiled once and shared by all its lights; plain lights
+    stay in relays.topics. Raises ValueError for an unknown schema name.
+    """
+    compiled = {}
+    for light in config:
+        name = light.get("schema", default)
+        if name not in PAYLOAD_SCHEMAS:
+            raise ValueError(f"light {light['address']}: unknown payload schema {name!r} "
+                             f"(expected one of {', '.join(PAYLOAD_SCHEMAS)})")
+        if name not in compiled:
+            compiled[name] = PAYLOAD_SCHEMAS[name]()
+        module, relay = parse_address(light["address"])
+        key = module << 8 | relay
+        topic = relays.topics[key] or relays.encoded.get(key, (None,))[0]
+        if compiled[name] is None:
+            relays.topics[key] = topic
+            relays.encoded.pop(key, None)
+        else:
+            relays.topics[key] = None
+            relays.encoded[key] = (topic, compiled[name])
+
+
+def build_refresh_table(config):
+    """Map every light's state/get topic to its relay_key()."""
+    refresh_table = {}
+    for light in config:
+        module, relay = parse_address(light["address"])
+        refresh_table[f"dobiss/light/{light['address']}/state/get"] = module << 8 | relay
+    return refresh_table
+
+
+class RefreshCoordinator:
+    """Single-flight GET requests for on-demand state refreshes.
+
+    request() answers from the RelayTable when the relay's state is younger
+    than max_age, joins the GET already in flight for that relay, or else
+    sends one GET request. The reply travels the normal pending_gets path in
+    handle_can_message, which publishes the fresh state for every waiter at
+    once. A GET that stays unanswered for timeout seconds may be re-sent.
+    """
+
+    def __init__(self, relays, bus, client, max_age=REFRESH_MAX_AGE, timeout=GET_TIMEOUT):
+        self.relays = relays
+        self.bus = bus
+        self.client = client
+        self.max_age = max_age
+        self.timeout = timeout
+        # time.monotonic() each relay's outstanding GET was sent, 0.0 = none
+        self.in_flight = array("d", bytes(8 * RELAY_SPACE))
+
+    def request(self, key):
+        """Refresh one relay; returns "cached", "joined" or "sent"."""
+        relays = self.relays
+        now = time.monotonic()
+        updated = relays.updated[key]
+        state = relays.states[key]
+        if state != STATE_UNKNOWN and now - updated <= self.max_age:
+            topic = relays.topics[key]
+            if topic is not None:
+                self.client.publish(topic, STATE_PAYLOADS[state], retain=True)
+            elif key in relays.encoded:
+                topic, encoder = relays.encoded[key]
+                # Wall-clock time of the frame that reported the cached state
+                self.client.publish(topic, encoder(state, SOURCE_CACHE, time.time() - (now - updated)), retain=True)
+            return "cached"
+        sent_at = self.in_flight[key]
+        if sent_at > updated and now - sent_at < self.timeout:
+            return "joined"
+        self.in_flight[key] = now
+        self.bus.send(build_get_message(key >> 8, key & 0xFF))
+        return "sent"
+
+
+def handle_refresh_message(topic, payload, refresh_table, refresher):
+    """Process a refresh request received over MQTT.
+
+    dobiss/light/<addr>/state/get refreshes one light; dobiss/refresh
+    refreshes the comma-separated addresses in its payload, or every
+    configured light when the payload is empty.
+
+    Returns True if the topic was a refresh topic, False otherwise.
+    """
+    if topic == REFRESH_TOPIC:
+        if payload.strip():
+            keys = []
+            for address in payload.decode(errors="replace").split(","):
+                key = refresh_table.get(f"dobiss/light/{address.strip()}/state/get")
+                if key is None:
+                    logger.debug("Ignoring refresh of unknown light %r", address)
+                else:
+                    keys.append(key)
+        else:
+            keys = refresh_table.values()
+        for key in keys:
+            refresher.request(key)
+        return True
+    key = refresh_table.get(topic)
+    if key is None:
+        return False
+    refresher.request(key)
+    return True
+
+
+def build_can_filters(config, snoop=False):
+    """Return CAN_FILTERS, plus with snoop one masked filter for SET requests.
+
+    The filter fixes the module bits that all configured modules share, so
+    the kernel drops SET requests of most other modules; the few that still
+    match are ignored by SetSnooper.
+    """
+    modules = {parse_address(light["address"])[0] for light in config}
+    if not snoop or not modules:
+        return CAN_FILTERS
+    first = min(modules)
+    common = 0xFF
+    for module in modules:
+        common &= ~(module ^ first)
+    return CAN_FILTERS + [{
+        "can_id": ARBIT_SET_REQUEST | (first & common) << 8,
+        "can_mask": SET_REQUEST_MASK | common << 8,
+        "extended": True,
+    }]
 
-    if arb == ARBIT_GET_REQUEST:
-        # Snoop the GET request so we can correlate the reply later.
-        if pending_gets is not None:
-            pending_gets.append((message.data[0], message.data[1]))
-        return
 
-    if arb == ARBIT_SET_REPLY:
-        topic = can_to_mqtt.get((message.data[0], message.data[1]))
+class SetSnooper:
+    """Attribute relay changes to wall panels or to the bridge itself.
+
+    SET requests reach on_request() when SNOOP_SET_REQUESTS lets them through
+    the CAN filters. Ours come back too (receive_own_messages=True), so
+    on_sent(), a TxScheduler listener, remembers each SET we transmit; a
+    request matching one sent within echo_window seconds is our echo, any
+    other is a panel. For a panel request the requested state is published
+    to <state topic>/pending before the module has switched; a TOGGLE
+    request is resolved against the relay's known state and is not
+    published while that state is unknown. on_reply()
+    pairs the module's SET reply with the request, publishes the origin
+    ("panel" or "bridge") retained to <state topic>/source and records the
+    request-to-reply latency of the module from the frame timestamps.
+    """
+
+    def __init__(self, config, relays, echo_window=SNOOP_ECHO_WINDOW, samples=SNOOP_LATENCY_SAMPLES):
+        self.relays = relays
+        self.echo_window = echo_window
+        # relay key -> (requested state byte, time.monotonic()) of SET requests we sent
+        self._sent = {}
+        # relay key -> (requested state byte, origin, frame timestamp) awaiting the reply
+        self._requests = {}
+        self.modules = {
+            parse_address(light["address"])[0]: {"panel": 0, "bridge": 0, "latencies": deque(maxlen=samples)}
+            for light in config
+        }
+        self.unpaired_replies = 0
+        relays.snoop = self
+
+    def on_sent(self, message, priority):
+        """TxScheduler listener: remember the SET requests we transmit."""
+        if message.arbitration_id & SET_REQUEST_MASK == ARBIT_SET_REQUEST:
+            data = message.data
+            self._sent[data[0] << 8 | data[1]] = (data[2], _monotonic())
+
+    def on_request(self, key, requested, client):
+        """Called with the raw state byte of every SET request on the CAN thread."""
+        if key >> 8 not in self.modules:
+            return
+        sent = self._sent.pop(key, None)
+        own = sent is not None and sent[0] == requested and _monotonic() - sent[1] <= self.echo_window
+        origin = "bridge" if own else "panel"
+        self._requests[key] = (requested, origin, self.relays.received)
+        if own:
+            return
+        if requested == SET_TOGGLE:
+            current = self.relays.states[key]
+            if current == STATE_UNKNOWN:
+                return
+            state = 1 - current
+        else:
+            state = 1 if requested == 1 else 0
+        topic = self._topic(key)
         if topic is not None:
-            state_str = "ON" if message.data[2] == 1 else "OFF"
-            client.publish(topic, state_str, retain=True)
-            logger.debug("Published MQTT message: %s", message)
-        return
-
-    if arb == ARBIT_GET_REPLY and pending_gets:
-        req_module, req_relay = pending_gets.popleft()
-        topic = can_to_mqtt.get((req_module, req_relay))
+            client.publish(topic + "/pending", STATE_PAYLOADS[state])
+
+    def on_reply(self, key, state, client):
+        request = self._requests.pop(key, None)
+        if request is None:
+            self.unpaired_replies += 1
+            return
+        _, origin, requested = request
+        module = self.modules[key >> 8]
+        module[origin] += 1
+        module["latencies"].append(self.relays.received - requested)
+        topic = self._topic(key)
         if topic is not None:
-            state_str = "ON" if message.data[0] == 1 else "OFF"
-            client.publish(topic, state_str, retain=True)
-            logger.debug("Updated light state based on GET reply: %s", message)
+            client.publish(topic + "/source", origin, retain=True)
+
+    def _topic(self, key):
+        topic = self.relays.topics[key]
+        if topic is None and key in self.relays.encoded:
+            topic = self.relays.encoded[key][0]
+        return topic
+
+    def stats(self):
+        """Per-module request counts by origin and reply latency in milliseconds."""
+        modules = {}
+        for module, counters in self.modules.items():
+            latencies = sorted(counters["latencies"])
+            modules[f"{module:02X}"] = {
+                "panel": counters["panel"],
+                "bridge": counters["bridge"],
+                "latency_ms": {
+                    "p50": latencies[len(latencies) // 2] * 1000,
+                    "p99": latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)] * 1000,
+                    "max": latencies[-1] * 1000,
+                } if latencies else None,
+            }
+        return {"modules": modules, "unpaired_replies": self.unpaired_replies}
+
+
+class DimmerStreamer:
+    """Brightness commands for dimmers, downsampled to what the bus carries.
+
+    A UI slider emits far more brightness updates than a dimmer module can
+    answer, so only the newest level per dimmer is kept. It is sent once
+    the previous frame to that dimmer was answered by its SET reply (or
+    timeout seconds passed), and no sooner than min_interval seconds after
+    it. The update rate thus follows the round trip through the TxScheduler
+    queue, the bus and the module, and the last level set is always sent;
+    levels replaced before they were sent are counted in coalesced.
+
+    Levels come from set() (JSON "brightness" commands, see
+    handle_mqtt_message()) and handle() (brightness/set topics). A level
+    confirmed by a SET reply while the dimmer is on is published retained
+    to dobiss/light/<address>/brightness.
+    """
+
+    def __init__(self, config, relays, bus, min_interval=DIMMER_MIN_INTERVAL, timeout=DIMMER_REPLY_TIMEOUT):
+        self.bus = bus
+        self.min_interval = min_interval
+        self.timeout = timeout
+        # brightness/set topic -> relay key, and relay key -> brightness state topic
+        self.commands = {}
+        self.topics = {}
+        for light in config:
+            if light.get("dimmer"):
+                module, relay = parse_address(light["address"])
+                self.commands[f"dobiss/light/{light['address']}/brightness/set"] = module << 8 | relay
+                self.topics[module << 8 | relay] = f"dobiss/light/{light['address']}/brightness"
+        self.levels = {}     # relay key -> last confirmed level
+        self._pending = {}   # relay key -> newest level not sent yet
+        self._inflight = {}  # relay key -> level sent and not answered yet
+        self._sent_at = {}   # relay key -> time.monotonic() of its last frame
+        self.sent = 0
+        self.coalesced = 0
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = None
+        relays.dimmers = self
+
+    def set(self, key, level):
+        """Queue level (0-100, 0 is off) for relay key; False if it is not a dimmer."""
+        if key not in self.topics:
+            return False
+        level = max(0, min(100, round(level)))
+        with self._cond:
+            if key in self._pending:
+                self.coalesced += 1
+            self._pending[key] = level
+            self._cond.notify()
+        return True
+
+    def handle(self, topic, payload):
+        """Handle a brightness/set message; returns False for other topics."""
+        key = self.commands.get(topic)
+        if key is None:
+            return False
+        try:
+            level = float(payload)
+        except ValueError:
+            level = math.nan
+        if not math.isfinite(level):
+            logger.warning("Invalid brightness %r on %s", payload, topic)
+            return True
+        self.set(key, level)
+        return True
+
+    def on_reply(self, key, state, client):
+        """Called for every SET reply on the CAN thread."""
+        if key not in self.topics:
+            return
+        with self._cond:
+            level = self._inflight.pop(key, None)
+            if key in self._pending:
+                self._cond.notify()
+        if level is not None and state == STATE_ON:
+            self.levels[key] = level
+            client.publish(self.topics[key], str(level), retain=True)
+
+    def _send(self, key, level, now):
+        self._inflight[key] = level
+        self._sent_at[key] = now
+        self.sent += 1
+        self.bus.send(build_set_message(key >> 8, key & 0xFF, STATE_ON if level else STATE_OFF, level))
+
+    def _send_due(self, now):
+        """Send the pending levels that are due; return seconds until the next one is, or None."""
+        wait = None
+        for key in list(self._pending):
+            sent_at = self._sent_at.get(key)
+            due = now if sent_at is None else sent_at + (
+                self.timeout if key in self._inflight else self.min_interval)
+            if due <= now:
+                self._send(key, self._pending.pop(key), now)
+            elif wait is None or due - now < wait:
+                wait = due - now
+        return wait
+
+    def _run(self):
+        with self._cond:
+            while not self._stopping:
+                self._cond.wait(self._send_due(_monotonic()))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True, name="dimmers")
+        self._thread.start()
+
+    def stop(self):
+        """Stop the thread and send every pending level at once."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join(timeout=2)
+        with self._cond:
+            now = _monotonic()
+            for key, level in list(self._pending.items()):
+                self._send(key, level, now)
+            self._pending.clear()
+
+
+class TimerScheduler:
+    """Auto-off and delayed SET commands kept on a hierarchical TimerWheel.
+
+    Each relay has at most one pending timer. A light with an ``auto_off``
+    (seconds) entry in config.yaml is switched off that long after it turns
+    on, whether the command came from MQTT or a wall panel; the transition
+    listener arms the timer and cancels it when the light goes off first.
+    Pending timers are saved to path (as wall-clock deadlines) when they
+    change and on stop(), and restored by start(); timers that came due
+    while the bridge was down fire right after the restart.
+    """
+
+    def __init__(self, config, relays, bus, path=TIMER_STATE_PATH, tick=TIMER_TICK):
+        self.bus = bus
+        self.path = path
+        self.tick = tick
+        self.auto_off = {
+            relay_key(*parse_address(light["address"])): min(float(light["auto_off"]), TIMER_MAX_DELAY)
+            for light in config
+            if light.get("auto_off")
+        }
+        self.wheel = TimerWheel(now=int(time.time() / tick))
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._stop = threading.Event()
+        self._thread = None
+        relays.listeners.append(self.on_transition)
+
+    def _deadline(self, delay):
+        return math.ceil((time.time() + delay) / self.tick)
+
+    def schedule(self, key, state, delay):
+        """Set relay key to state in delay seconds, replacing its pending timer."""
+        with self._lock:
+            self.wheel.schedule(key, self._deadline(delay), state)
+            self._dirty = True
+
+    def cancel(self, key):
+        with self._lock:
+            if self.wheel.cancel(key) is not None:
+                self._dirty = True
+
+    def manual(self, key, state, auto_off=None):
+        """Reset the relay's timer for a manual command and arm auto-off for ON."""
+        with self._lock:
+            if self.wheel.cancel(key) is not None:
+                self._dirty = True
+            seconds = auto_off if auto_off is not None else self.auto_off.get(key)
+            if state == STATE_ON and seconds:
+                self.wheel.schedule(key, self._deadline(seconds), STATE_OFF)
+                self._dirty = True
+
+    def on_transition(self, key, state):
+        """RelayTable listener: arm auto-off on ON, drop a pending auto-off on OFF."""
+        with self._lock:
+            pending = self.wheel.timers.get(key)
+            if state == STATE_ON:
+                if pending is None and key in self.auto_off:
+                    self.wheel.schedule(key, self._deadline(self.auto_off[key]), STATE_OFF)
+                    self._dirty = True
+            elif pending is not None and pending[1] == STATE_OFF:
+                self.wheel.cancel(key)
+                self._dirty = True
+
+    def run_pending(self, now=None):
+        """Send the SET frames of every timer due by now; returns the (key, state) pairs."""
+        with self._lock:
+            fired = self.wheel.advance(int((time.time() if now is None else now) / self.tick))
+            if fired:
+                self._dirty = True
+        for key, state in fired:
+            message = build_set_message(key >> 8, key & 0xFF, state)
+            try:
+                self.bus.send(message)
+            except can.CanError:
+                logger.exception("Failed to send timed CAN message: %s", message)
+            else:
+                logger.debug("Sent timed CAN message: %s", message)
+        return fired
+
+    def save(self):
+        """Write the pending timers to path."""
+        with self._lock:
+            entries = [
+                {"address": f"{key:04X}", "state": STATE_PAYLOADS[state], "due": expires * self.tick}
+                for key, (expires, state) in self.wheel.timers.items()
+            ]
+            self._dirty = False
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(entries, file)
+        os.replace(tmp_path, self.path)
+
+    def load(self):
+        """Restore timers saved by a previous run, if any."""
+        try:
+            with open(self.path, "r") as file:
+                entries = json.load(file)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            logger.warning("Ignoring unreadable timer snapshot %s", self.path)
+            return
+        with self._lock:
+            for entry in entries:
+                key = relay_key(*parse_address(entry["address"]))
+                state = STATE_PAYLOADS.index(entry["state"])
+                self.wheel.schedule(key, math.ceil(entry["due"] / self.tick), state)
+
+    def start(self):
+        self.load()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="timers")
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=2)
+        self.save()
+
+    def _run(self):
+        last_save = time.monotonic()
+        while not self._stop.wait(self.tick):
+            self.run_pending()
+            if self._dirty and time.monotonic() - last_save >= TIMER_SAVE_INTERVAL:
+                self.save()
+                last_save = time.monotonic()
+
+
+def _parse_clock(text):
+    """'19:30' -> minutes since midnight."""
+    hours, minutes = text.split(":")
+    return int(hours) * 60 + int(minutes)
+
+
+class Rule:
+    """One compiled rule: when trigger_key enters trigger_state (optionally
+    only between two local clock times), set each action's relay."""
+
+    __slots__ = ("name", "trigger_key", "trigger_state", "window", "actions", "hits")
+
+    def __init__(self, name, trigger_key, trigger_state, window, actions):
+        self.name = name
+        self.trigger_key = trigger_key
+        self.trigger_state = trigger_state
+        self.window = window    # (start, end) minutes since midnight, or None
+        self.actions = actions  # [(relay_key, state), ...]
+        self.hits = 0
+
+    def active(self, minute):
+        if self.window is None:
+            return True
+        start, end = self.window
+        if start <= end:
+            return start <= minute < end
+        return minute >= start or minute < end  # window spans midnight
+
+
+def compile_rules(config):
+    """Compile the ``rules`` entries of the lights in config into Rule objects.
+
+    A rule hangs off the light that triggers it::
+
+        - name: Entrance Light
+          address: '0105'
+          rules:
+            - when: "ON"                   # new state of this light
+              between: ["19:00", "07:00"]  # optional local-time window
+              then:
+                - address: '0100'
+                  state: "ON"
+
+    Raises ValueError for malformed rules and for rule sets that could keep
+    switching a relay on and off.
+    """
+    rules = []
+    for light in config:
+        trigger_key = relay_key(*parse_address(light["address"]))
+        for index, entry in enumerate(light.get("rules") or ()):
+            name = entry.get("name") or "%s#%d" % (light["address"], index + 1)
+            trigger_state = parse_state(str(entry.get("when")).encode())
+            if trigger_state is None:
+                raise ValueError("rule %s: 'when' must be ON or OFF" % name)
+            window = None
+            if entry.get("between"):
+                start, end = entry["between"]
+                window = (_parse_clock(start), _parse_clock(end))
+            actions = []
+            for action in entry.get("then") or ():
+                state = parse_state(str(action.get("state")).encode())
+                if state is None:
+                    raise ValueError("rule %s: action state must be ON or OFF" % name)
+                actions.append((relay_key(*parse_address(action["address"])), state))
+            if not actions:
+                raise ValueError("rule %s has no actions" % name)
+            rules.append(Rule(name, trigger_key, trigger_state, window, actions))
+    _check_rule_cycles(rules)
+    return rules
+
+
+def _check_rule_cycles(rules):
+    """Raise ValueError if rules can switch a relay back and forth forever.
+
+    That happens when a relay entering one state leads, through a chain of
+    rules, to it entering the other state and vice versa. Cycles that keep
+    every relay in one state (e.g. two lights linked both ways) end on their
+    own, because actions for relays already in the target state are skipped.
+    """
+    edges = {}
+    for rule in rules:
+        edges.setdefault((rule.trigger_key, rule.trigger_state), set()).update(rule.actions)
 
+    def reachable(start):
+        seen, todo = set(), [start]
+        while todo:
+            for child in edges.get(todo.pop(), ()):
+                if child not in seen:
+                    seen.add(child)
+                    todo.append(child)
+        return seen
 
-def make_on_connect(config):
-    """Return an on_connect callback that subscribes to all configured lights."""
+    for key, state in edges:
+        if (key, 1 - state) in reachable((key, state)) and (key, state) in reachable((key, 1 - state)):
+            raise ValueError("rules loop: %04X is switched ON and OFF by its own rules" % key)
+
+
+class RuleEngine:
+    """Evaluate rules on the CAN thread and send their SET frames directly.
+
+    Rules are indexed by (relay key, new state), so a state transition costs
+    one dict lookup when no rule matches. The engine is a RelayTable
+    listener, so it only sees real transitions and never touches the MQTT
+    path. An action whose relay already has the requested state is not
+    sent, and rule sets that could oscillate are rejected by
+    compile_rules(). Each rule counts its
+    hits, exposed through /rules.json.
+    """
+
+    def __init__(self, rules, relays, bus):
+        self.rules = rules
+        self.relays = relays
+        self.bus = bus
+        self.index = {}
+        for rule in rules:
+            self.index.setdefault((rule.trigger_key, rule.trigger_state), []).append(rule)
+        if self.index:
+            relays.listeners.append(self.on_transition)
+
+    def on_transition(self, key, state):
+        matches = self.index.get((key, state))
+        if matches is None:
+            return
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        states = self.relays.states
+        for rule in matches:
+            if not rule.active(minute):
+                continue
+            rule.hits += 1
+            for target, target_state in rule.actions:
+                if states[target] == target_state:
+                    continue
+                message = build_set_message(target >> 8, target & 0xFF, target_state)
+                try:
+                    self.bus.send(message)
+                except can.CanError:
+                    logger.exception("Rule %s failed to send CAN message: %s", rule.name, message)
+                else:
+                    logger.debug("Rule %s sent CAN message: %s", rule.name, message)
+
+    def stats(self):
+        """Return [{"name", "hits"}, ...] for every rule."""
+        return [{"name": rule.name, "hits": rule.hits} for rule in self.rules]
+
+
+def make_on_connect(config, extra_topics=(), availability_topic=None):
+    """Return an on_connect callback that subscribes to all configured lights.
+
+    extra_topics (e.g. the refresh topics) are subscribed after the lights.
+    With an availability_topic, a retained "online" is published to it.
+    """
     def on_connect(client, userdata, flags, rc):
         logger.debug("Connected with result code %s", rc)
         for light in config:
             client.subscribe(f"dobiss/light/{light['address']}/state/set")
+        for topic in extra_topics:
+            client.subscribe(topic)
+        if availability_topic is not None:
+            client.publish(availability_topic, "online", qos=1, retain=True)
     return on_connect
 
 
-def make_on_message(mqtt_to_can, bus):
-    """Return an on_message callback that forwards MQTT messages to the CAN bus."""
+class CommandFreshness:
+    """Drop MQTT commands that are too old to act on.
+
+    After a broker or network hiccup a backlog of commands can arrive at
+    once; replaying it would step lights through old states. check() drops
+    a retained message: it is replayed on every subscribe, however old it
+    is. issued_at() drops a command whose "ts" field (the sender's
+    wall-clock time, so the clocks must be in sync) is more than max_age
+    seconds old. Dropped commands are counted per reason for /commands.json.
+
+    paho calls on_message as soon as a message is read, so the time a
+    command waits inside the bridge is spent in the TxScheduler queue; SET
+    requests that waited there longer than COMMAND_MAX_AGE are dropped by
+    the scheduler (see TxScheduler.expired).
+    """
+
+    def __init__(self, max_age=COMMAND_MAX_AGE):
+        self.max_age = max_age
+        self.dropped = {"retained": 0, "too_old": 0}
+
+    def check(self, msg):
+        """Return True if msg may be handled."""
+        if msg.retain:
+            return self._drop("retained", msg.topic)
+        return True
+
+    def issued_at(self, timestamp, topic, now=None):
+        """Return True if a command issued at wall-clock time timestamp may be sent."""
+        if self.max_age is None or (time.time() if now is None else now) - timestamp <= self.max_age:
+            return True
+        return self._drop("too_old", topic)
+
+    def _drop(self, reason, topic):
+        self.dropped[reason] += 1
+        logger.info("Dropped %s command on %s", reason.replace("_", " "), topic)
+        return False
+
+    def stats(self):
+        return {"max_age": self.max_age, "dropped": dict(self.dropped)}
+
+
+def make_on_message(mqtt_to_can, bus, refresh_table=None, refresher=None, timers=None, trace=None, freshness=None,
+                    dimmers=None):
+    """Return an on_message callback that forwards MQTT messages to the CAN bus.
+
+    Topics that are not SET topics are tried as brightness commands when a
+    DimmerStreamer is given, then as refresh requests when a
+    RefreshCoordinator is. timers, freshness and dimmers are passed on to
+    handle_mqtt_message(); with a CommandFreshness, stale messages are
+    dropped before any of this. With a TraceRing, each message's handling
+    time is recorded in it.
+    """
+    clock = time.perf_counter
+
     def on_message(client, userdata, msg):
+        started = clock()
         logger.debug("%s %s", msg.topic, msg.payload)
-        handle_mqtt_message(msg.topic, msg.payload, mqtt_to_can, bus)
+        if freshness is None or freshness.check(msg):
+            handled = handle_mqtt_message(msg.topic, msg.payload, mqtt_to_can, bus, timers, freshness, dimmers)
+            if not handled and dimmers is not None:
+                handled = dimmers.handle(msg.topic, msg.payload)
+            if not handled and refresher is not None:
+                handle_refresh_message(msg.topic, msg.payload, refresh_table, refresher)
+        if trace is not None:
+            trace.record(msg.topic, started)
     return on_message
 
 
+class StateBroadcaster:
+    """Fan relay state transitions out to Server-Sent Events clients.
+
+    notify() is registered as a RelayTable listener and only puts the
+    transition on a queue, so the CAN thread does O(1) work regardless of
+    the number of clients. A broadcaster thread encodes each event once into
+    a bounded backlog and wakes the client threads, which copy whatever they
+    have not sent yet. A client that falls more than backlog events behind,
+    or whose socket write times out, is disconnected.
+    """
+
+    def __init__(self, relays, backlog=SSE_BACKLOG):
+        self.relays = relays
+        self.clients = 0
+        self.dropped_clients = 0
+        self._incoming = queue.SimpleQueue()
+        self._events = deque(maxlen=backlog)
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        relays.listeners.append(self.notify)
+
+    def notify(self, key, state):
+        self._incoming.put((key, state, time.time()))
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True, name="sse")
+        self._thread.start()
+
+    def stop(self):
+        self._incoming.put(None)
+        if self._thread:
+            self._thread.join(timeout=2)
+
+    def _run(self):
+        while True:
+            item = self._incoming.get()
+            if item is None:
+                break
+            key, state, timestamp = item
+            data = json.dumps({"address": f"{key:04X}", "state": STATE_PAYLOADS[state], "timestamp": timestamp})
+            with self._cond:
+                self._seq += 1
+                self._events.append(f"id: {self._seq}\nevent: state\ndata: {data}\n\n".encode())
+                self._cond.notify_all()
+
+    def snapshot(self):
+        """Return a "snapshot" event with the known state of every configured light."""
+        relays = self.relays
+        # Lights with a non-plain payload schema live in relays.encoded.
+        configured = [key for key, topic in enumerate(relays.topics) if topic is not None]
+        configured.extend(relays.encoded)
+        states = {
+            f"{key:04X}": STATE_PAYLOADS[relays.states[key]]
+            for key in sorted(configured)
+            if relays.states[key] != STATE_UNKNOWN
+        }
+        return f"event: snapshot\ndata: {json.dumps(states)}\n\n".encode()
+
+    def stream(self, wfile, keepalive=SSE_KEEPALIVE):
+        """Write a snapshot, then every transition, to wfile until the client goes away.
+
+        Returns False if the client was dropped for falling behind.
+        """
+        with self._cond:
+            cursor = self._seq
+            self.clients += 1
+        try:
+            wfile.write(self.snapshot())
+            wfile.flush()
+            while True:
+                with self._cond:
+                    if self._seq == cursor:
+                        self._cond.wait(keepalive)
+                    behind = self._seq - cursor
+                    if behind > len(self._events):
+                        self.dropped_clients += 1
+                        logger.info("Dropping event-stream client %d events behind", behind)
+                        return False
+                    chunk = b"".join([self._events[i] for i in range(-behind, 0)])
+                    cursor = self._seq
+                wfile.write(chunk or b": keepalive\n\n")
+                wfile.flush()
+        except OSError:
+            return True
+        finally:
+            with self._cond:
+                self.clients -= 1
+
+
+class StateHistory:
+    """Recent state transitions per relay in fixed, preallocated arrays.
+
+    The first HISTORY_RELAYS relays that change state each get a ring of
+    depth (timestamp, state) slots; transitions of further relays are only
+    counted in ``dropped``. All memory is allocated up front (a key -> ring
+    index table for the whole 16-bit address space plus the rings), so usage
+    does not grow with uptime or traffic. record() is registered as a
+    RelayTable listener.
+    """
+
+    def __init__(self, relays, depth=HISTORY_DEPTH, max_relays=HISTORY_RELAYS):
+        if depth & (depth - 1):
+            raise ValueError("depth must be a power of two")
+        self.depth = depth
+        self.max_relays = max_relays
+        self.dropped = 0
+        self._mask = depth - 1
+        self._ring_of = array("i", [-1]) * RELAY_SPACE
+        self._timestamps = array("d", bytes(8 * depth * max_relays))
+        self._states = bytearray(depth * max_relays)
+        self._counts = array("Q", bytes(8 * max_relays))  # transitions ever recorded per ring
+        self._rings = 0
+        self._lock = threading.Lock()
+        relays.listeners.append(self.record)
+
+    def record(self, key, state, timestamp=None):
+        with self._lock:
+            ring = self._ring_of[key]
+            if ring < 0:
+                if self._rings == self.max_relays:
+                    self.dropped += 1
+                    return
+                ring = self._ring_of[key] = self._rings
+                self._rings += 1
+            count = self._counts[ring]
+            slot = ring * self.depth + (count & self._mask)
+            self._timestamps[slot] = time.time() if timestamp is None else timestamp
+            self._states[slot] = state
+            self._counts[ring] = count + 1
+
+    def events(self, key):
+        """Return [(absolute index, timestamp, state), ...] oldest first."""
+        with self._lock:
+            ring = self._ring_of[key]
+            if ring < 0:
+                return []
+            count = self._counts[ring]
+            base = ring * self.depth
+            return [
+                (index, self._timestamps[base + (index & self._mask)], self._states[base + (index & self._mask)])
+                for index in range(max(0, count - self.depth), count)
+            ]
+
+    def query(self, key, start, end, now=None):
+        """Summarise relay key between timestamps start and end.
+
+        Returns a dict with the transitions in range, the seconds spent ON,
+        the number of toggles (the first state ever seen is not a toggle)
+        and the last change at or before end. On-time before the oldest
+        retained transition is not counted.
+        """
+        now = time.time() if now is None else now
+        end = min(end, now)
+        events = self.events(key)
+        in_range = []
+        on_time = 0.0
+        toggles = 0
+        state = None
+        since = start
+        last_change = None
+        for index, timestamp, new_state in events:
+            if timestamp > end:
+                break
+            last_change = {"timestamp": timestamp, "state": STATE_PAYLOADS[new_state]}
+            if timestamp < start:
+                state = new_state
+                continue
+            if state == STATE_ON:
+                on_time += timestamp - since
+            state, since = new_state, timestamp
+            in_range.append([timestamp, STATE_PAYLOADS[new_state]])
+            if index > 0:
+                toggles += 1
+        if state == STATE_ON and end > since:
+            on_time += end - since
+        return {
+            "address": f"{key:04X}",
+            "events": in_range,
+            "on_time": on_time,
+            "toggles": toggles,
+            "last_change": last_change,
+        }
+
+
+def handle_bulk_command(commands, mqtt_to_can, relays, bus, timeout=BULK_REPLY_TIMEOUT):
+    """Send a batch of {"address": ..., "state": ...} commands and await their replies.
+
+    Every command is validated against mqtt_to_can and parse_state() first;
+    the SET frames of the valid ones are then built and sent back to back.
+    A command counts as confirmed once the RelayTable records a state report
+    for its relay that is newer than the batch.
+
+    Returns one result dict per command, in order, with "address", "state"
+    and "result": "ok", "mismatch" (the relay reported another state),
+    "timeout", "unknown_address" or "invalid_state".
+    """
+    results = []
+    batch = []
+    for command in commands:
+        address = str(command.get("address", "")) if isinstance(command, dict) else ""
+        requested = command.get("state") if isinstance(command, dict) else None
+        result = {"address": address, "state": requested}
+        results.append(result)
+        key = mqtt_to_can.get(f"dobiss/light/{address}/state/set")
+        if key is None:
+            result["result"] = "unknown_address"
+            continue
+        state = parse_state(str(requested).encode())
+        if state is None:
+            result["result"] = "invalid_state"
+            continue
+        module, relay = key
+        batch.append((result, module << 8 | relay, state, build_set_message(module, relay, state)))
+
+    sent_at = time.monotonic()
+    for _, _, _, message in batch:
+        bus.send(message)
+
+    deadline = sent_at + timeout
+    waiting = batch
+    while waiting:
+        still_waiting = []
+        for entry in waiting:
+            result, key, state, _ = entry
+            if relays.updated[key] > sent_at:
+                result["result"] = "ok" if relays.states[key] == state else "mismatch"
+            else:
+                still_waiting.append(entry)
+        waiting = still_waiting
+        if waiting:
+            if time.monotonic() >= deadline:
+                for result, _, _, _ in waiting:
+                    result["result"] = "timeout"
+                break
+            time.sleep(BULK_POLL_INTERVAL)
+    return results
+
+
+class ConfigCache:
+    """In-memory, pre-encoded copy of the config file for the HTTP server.
+
+    get() stats the file and reloads it only when its size, mtime or inode
+    changed, so requests are served without reading the disk. Each load
+    keeps the raw body, its gzip encoding, a strong ETag and the parsed
+    lights with their relay keys.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._stamp = None
+        self._entry = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Return (body, gzipped, etag, lights) for the current file contents.
+
+        lights is a list of (light, relay_key) pairs.
+        """
+        stat = os.stat(self.path)
+        stamp = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        if stamp != self._stamp:
+            with self._lock:
+                if stamp != self._stamp:
+                    with open(self.path, "rb") as file:
+                        body = file.read()
+                    lights = [
+                        (light, relay_key(*parse_address(light["address"])))
+                        for light in yaml.safe_load(body) or []
+                    ]
+                    etag = '"%s"' % hashlib.sha1(body).hexdigest()
+                    self._entry = (body, gzip.compress(body, mtime=0), etag, lights)
+                    self._stamp = stamp
+        return self._entry
+
+
+def build_discovery(config, can_to_mqtt, mqtt_to_can, prefix=DISCOVERY_PREFIX):
+    """Return {discovery_topic: payload} Home Assistant light documents for config.
+
+    Topics come from the build_lookup_tables() dicts. Payloads are compact
+    JSON with sorted keys, so an unchanged light always yields the same bytes.
+    """
+    set_topics = {key: topic for topic, key in mqtt_to_can.items()}
+    documents = {}
+    for light in config:
+        key = parse_address(light["address"])
+        unique_id = "dobiss_%04X" % relay_key(*key)
+        documents[f"{prefix}/light/{unique_id}/config"] = json.dumps({
+            "name": light["name"],
+            "unique_id": unique_id,
+            "state_topic": can_to_mqtt[key],
+            "command_topic": set_topics[key],
+            "payload_on": "ON",
+            "payload_off": "OFF",
+            "availability_topic": AVAILABILITY_TOPIC,
+            **({} if light.get("schema", PAYLOAD_SCHEMA) == "plain"
+               else {"state_value_template": "{{ value_json.state }}"}),
+            **({} if not light.get("dimmer") else {
+                "brightness_command_topic": f"dobiss/light/{light['address']}/brightness/set",
+                "brightness_state_topic": f"dobiss/light/{light['address']}/brightness",
+                "brightness_scale": 100,
+                "on_command_type": "brightness",
+            }),
+        }, sort_keys=True, separators=(",", ":"))
+    return documents
+
+
+class DiscoveryPublisher:
+    """Publish only the discovery documents that differ from the last run.
+
+    The SHA-1 of every published document is kept in cache_path, so a
+    restart or reconnect publishes nothing when the config did not change.
+    sync() queues added and changed documents and an empty retained payload
+    for removed ones; a background thread publishes the queue at rate
+    messages per second (QoS 1, so paho holds them until connected) and
+    records each hash once it is handed to paho. The thread also rebuilds
+    the documents whenever config_path changes.
+    """
+
+    def __init__(self, client, config_path="config.yaml", path=DISCOVERY_CACHE_PATH,
+                 rate=DISCOVERY_RATE, check_interval=DISCOVERY_CHECK_INTERVAL):
+        self.client = client
+        self.config = ConfigCache(config_path)
+        self.path = path
+        self.rate = rate
+        self.check_interval = check_interval
+        self.published = self._load()
+        self._etag = None
+        self._pending = {}
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = None
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            logger.warning("Ignoring unreadable discovery cache %s", self.path)
+            return {}
+
+    def _save(self):
+        with self._cond:
+            published = dict(self.published)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(published, file)
+        os.replace(tmp_path, self.path)
+
+    def sync(self, documents):
+        """Queue what differs from the published set; returns (added, changed, removed)."""
+        added = changed = removed = 0
+        pending = {}
+        with self._cond:
+            for topic, payload in documents.items():
+                digest = hashlib.sha1(payload.encode()).hexdigest()
+                previous = self.published.get(topic)
+                if previous != digest:
+                    pending[topic] = payload
+                    if previous is None:
+                        added += 1
+                    else:
+                        changed += 1
+            for topic in self.published:
+                if topic not in documents:
+                    pending[topic] = ""
+                    removed += 1
+            self._pending = pending
+            self._cond.notify()
+        if pending:
+            logger.info("Discovery: %d added, %d changed, %d removed", added, changed, removed)
+        return added, changed, removed
+
+    def check(self):
+        """Rebuild and sync the documents if the config file changed."""
+        _, _, etag, lights = self.config.get()
+        if etag == self._etag:
+            return None
+        self._etag = etag
+        config = [light for light, _ in lights]
+        can_to_mqtt, mqtt_to_can = build_lookup_tables(config)
+        return self.sync(build_discovery(config, can_to_mqtt, mqtt_to_can))
+
+    def pending(self):
+        with self._cond:
+            return len(self._pending)
+
+    def _run(self):
+        interval = 1.0 / self.rate
+        next_check = 0.0
+        while True:
+            with self._cond:
+                if not self._pending and not self._stopping:
+                    self._cond.wait(max(0.0, next_check - time.monotonic()))
+                if self._stopping:
+                    break
+                item = None
+                if self._pending:
+                    topic = next(iter(self._pending))
+                    item = topic, self._pending.pop(topic)
+            if item is None:
+                if time.monotonic() >= next_check:
+                    next_check = time.monotonic() + self.check_interval
+                    try:
+                        self.check()
+                    except (OSError, ValueError, yaml.YAMLError):
+                        logger.exception("Discovery: cannot read config")
+                continue
+            topic, payload = item
+            self.client.publish(topic, payload, qos=1, retain=True)
+            with self._cond:
+                if payload:
+                    self.published[topic] = hashlib.sha1(payload.encode()).hexdigest()
+                else:
+                    self.published.pop(topic, None)
+                done = not self._pending
+            if done:
+                self._save()
+            time.sleep(interval)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True, name="discovery")
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join(timeout=2)
+        self._save()
+
+
 class RequestHandler(BaseHTTPRequestHandler):
-    """HTTP handler that serves the config file."""
+    """HTTP handler that serves the config file, light states and the state
+    event stream, and accepts bulk light commands."""
 
+    protocol_version = "HTTP/1.1"
     config_path = "config.yaml"
+    relays = None       # RelayTable merged into /lights.json, if any
+    events = None       # StateBroadcaster behind /events, if any
+    bus = None          # bus that POST /lights sends SET frames to, if any
+    mqtt_to_can = None  # lookup table POST /lights validates against
+    rules = None        # RuleEngine whose hit counters /rules.json reports, if any
+    tx = None           # TxScheduler whose queue statistics /tx.json reports, if any
+    history = None      # StateHistory behind /history, if any
+    profiler = None     # SamplingProfiler started by POST /debug/profile, if any
+    watchdog = None     # Watchdog behind /healthz and /readyz, if any
+    snoop = None        # SetSnooper whose attribution counters /snoop.json reports, if any
+    freshness = None    # CommandFreshness whose drop counters /commands.json reports, if any
+    traces = None       # {stage: TraceRing} dumped by GET /debug/trace, if any
+    _config_caches = {}
+
+    def _config(self):
+        cache = self._config_caches.get(self.config_path)
+        if cache is None:
+            cache = self._config_caches.setdefault(self.config_path, ConfigCache(self.config_path))
+        return cache.get()
+
+    def _send_body(self, content_type, body, headers=()):
+        self.send_response(200)
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
 
     def do_GET(self):
         if self.path == "/config.yaml":
+            body, gzipped, etag, _ = self._config()
+            if_none_match = self.headers.get("If-None-Match", "")
+            if etag in if_none_match or if_none_match.strip() == "*":
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            headers = [("ETag", etag), ("Vary", "Accept-Encoding")]
+            if "gzip" in self.headers.get("Accept-Encoding", ""):
+                body = gzipped
+                headers.append(("Content-Encoding", "gzip"))
+            self._send_body("text/yaml", body, headers)
+        elif self.path == "/lights.json":
+            _, _, _, lights = self._config()
+            relays = self.relays
+            merged = []
+            for light, key in lights:
+                state = relays.states[key] if relays is not None else STATE_UNKNOWN
+                merged.append(dict(light, state=STATE_PAYLOADS[state] if state != STATE_UNKNOWN else None))
+            self._send_body("application/json", json.dumps(merged).encode())
+        elif self.path == "/rules.json" and self.rules is not None:
+            self._send_body("application/json", json.dumps(self.rules.stats()).encode())
+        elif self.path == "/snoop.json" and self.snoop is not None:
+            self._send_body("application/json", json.dumps(self.snoop.stats()).encode())
+        elif self.path == "/commands.json" and self.freshness is not None:
+            self._send_body("application/json", json.dumps(self.freshness.stats()).encode())
+        elif self.path == "/tx.json" and self.tx is not None:
+            self._send_body("application/json", json.dumps(self.tx.stats()).encode())
+        elif self.path.partition("?")[0] == "/history" and self.history is not None:
+            self._history()
+        elif self.path in ("/healthz", "/readyz") and self.watchdog is not None:
+            status = self.watchdog.status()
+            ok = status["live"] if self.path == "/healthz" else status["ready"]
+            self._send_json(200 if ok else 503, status)
+        elif self.path == "/debug/trace" and self.traces is not None:
+            self._send_body("application/json", json.dumps(dump_traces(self.traces)).encode())
+        elif self.path == "/events" and self.events is not None:
             self.send_response(200)
-            self.send_header("Content-type", "text/yaml")
+            self.send_header("Content-type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
             self.end_headers()
-            with open(self.config_path, "r") as file:
-                self.wfile.write(file.read().encode())
+            self.connection.settimeout(SSE_WRITE_TIMEOUT)
+            self.events.stream(self.wfile)
+            self.close_connection = True
         else:
             self.send_response(404)
+            self.send_header("Content-Length", "0")
             self.end_headers()
 
+    def _history(self):
+        """GET /history[?address=0100,0107][&from=<unix time>][&to=<unix time>].
+
+        Without addresses, every configured light is summarised.
+        """
+        params = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        try:
+            now = time.time()
+            end = float(params["to"][0]) if "to" in params else now
+            start = float(params["from"][0]) if "from" in params else end - HISTORY_DEFAULT_RANGE
+            if "address" in params:
+                keys = [relay_key(*parse_address(a)) for a in params["address"][0].split(",")]
+                if not all(0 <= key < RELAY_SPACE for key in keys):
+                    raise ValueError("address out of range")
+            else:
+                keys = [key for _, key in self._config()[3]]
+        except ValueError as error:
+            self._send_json(400, {"error": str(error)})
+            return
+        summaries = [self.history.query(key, start, end, now) for key in keys]
+        self._send_body("application/json", json.dumps(summaries).encode())
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _profile(self):
+        """POST /debug/profile[?seconds=N]: start a background capture."""
+        params = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        try:
+            seconds = float(params["seconds"][0]) if "seconds" in params else PROFILE_SECONDS
+        except ValueError as error:
+            self._send_json(400, {"error": str(error)})
+            return
+        if not 0 < seconds <= PROFILE_MAX_SECONDS:
+            self._send_json(400, {"error": "seconds must be between 0 and %g" % PROFILE_MAX_SECONDS})
+            return
+        path = self.profiler.start(seconds)
+        if path is None:
+            self._send_json(409, {"error": "a profile is already being captured"})
+        else:
+            self._send_json(202, {"path": path, "seconds": seconds})
+
+    def do_POST(self):
+        if self.path.partition("?")[0] == "/debug/profile" and self.profiler is not None:
+            self._profile()
+            return
+        if self.path != "/lights" or self.bus is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            commands = json.loads(self.rfile.read(length))
+            if not isinstance(commands, list):
+                raise ValueError("expected a JSON list")
+        except ValueError as error:
+            self._send_json(400, {"error": str(error)})
+            return
+        results = handle_bulk_command(commands, self.mqtt_to_can, self.relays, self.bus)
+        self._send_body("application/json", json.dumps(results).encode())
+
     def log_message(self, format, *args):  # noqa: A002
         logger.debug(format, *args)
 
 
-if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO)
+class _TxLane:
+    """bus.send() adapter that submits frames to a TxScheduler in one class."""
 
-    config = load_config("config.yaml")
-    can_to_mqtt, mqtt_to_can = build_lookup_tables(config)
+    __slots__ = ("scheduler", "priority")
+
+    def __init__(self, scheduler, priority):
+        self.scheduler = scheduler
+        self.priority = priority
+
+    def send(self, message):
+        self.scheduler.send(message, self.priority)
+
+
+class TxScheduler:
+    """Priority queue in front of bus.send(), drained by one sender thread.
+
+    Frames are queued per class (TX_INTERACTIVE, TX_BATCH, TX_BACKGROUND)
+    and sent highest class first, at most one per frame_time so the driver's
+    own FIFO stays short. A lower-class frame that has waited longer than
+    starvation_limit is sent out of turn, but never twice in a row, so an
+    interactive frame waits behind at most one lower-class frame besides the
+    one already on the wire. Queue waits are counted per class in
+    TX_WAIT_BUCKETS histograms.
+
+    With collapse, a SET request for a relay that already has one queued
+    replaces that frame in its place in the queue, so a backlog of commands
+    sends only the newest state per relay; replacements are counted per
+    class of the newer frame. When the newer frame has a higher class, the
+    queued entry is marked dead (message None, skipped when it reaches the
+    head of its queue) and the frame is queued afresh in its own class, so
+    an interactive command never waits behind a batch backlog.
+
+    A SET request that waited longer than max_age seconds in its queue is
+    dropped instead of sent and counted in expired; GET requests are always
+    sent.
+
+    Usage::
+
+        tx = TxScheduler(bus)
+        tx.start()
+        handle_mqtt_message(topic, payload, mqtt_to_can, tx.lane(TX_INTERACTIVE))
+    """
+
+    def __init__(self, bus, frame_time=CAN_TX_FRAME_TIME, starvation_limit=TX_STARVATION_LIMIT,
+                 collapse=TX_COLLAPSE_SETS, max_age=COMMAND_MAX_AGE):
+        self.bus = bus
+        self.frame_time = frame_time
+        self.starvation_limit = starvation_limit
+        self.collapse = collapse
+        self.max_age = max_age
+        # queued entries are [message, queued_at, relay key of a SET or None, class];
+        # message is None once the entry was moved to a higher class
+        self._queues = [deque() for _ in TX_CLASSES]
+        self._dead = [0] * len(TX_CLASSES)
+        # relay key -> queued entry of its SET request
+        self._sets = {}
+        self._cond = threading.Condition()
+        self._promoted = False
+        self._stopping = False
+        self._thread = None
+        self.sent = [0] * len(TX_CLASSES)
+        self.promoted = [0] * len(TX_CLASSES)
+        self.collapsed = [0] * len(TX_CLASSES)
+        self.expired = [0] * len(TX_CLASSES)
+        self.errors = 0
+        # called as listener(message, priority) on the sender thread just
+        # before each frame goes to the bus
+        self.listeners = []
+        # time.monotonic() of the last successful and the last failed send
+        self.last_sent = 0.0
+        self.last_error = 0.0
+        self.waits = [[0] * (len(TX_WAIT_BUCKETS) + 1) for _ in TX_CLASSES]
+
+    def lane(self, priority):
+        """Return an object whose send(message) queues in class priority."""
+        return _TxLane(self, priority)
 
-    # CAN bus setup
+    def send(self, message, priority=TX_INTERACTIVE):
+        key = None
+        if self.collapse and message.arbitration_id & SET_REQUEST_MASK == ARBIT_SET_REQUEST:
+            data = message.data
+            key = data[0] << 8 | data[1]
+        with self._cond:
+            if key is not None:
+                queued = self._sets.get(key)
+                if queued is not None:
+                    self.collapsed[priority] += 1
+                    if priority >= queued[3]:
+                        queued[0] = message
+                        queued[1] = _monotonic()
+                        return
+                    queued[0] = None
+                    self._dead[queued[3]] += 1
+                entry = self._sets[key] = [message, _monotonic(), key, priority]
+            else:
+                entry = (message, _monotonic(), None, priority)
+            self._queues[priority].append(entry)
+            self._cond.notify()
+
+    def pending(self):
+        """Number of queued frames per class."""
+        return [len(q) - dead for q, dead in zip(self._queues, self._dead)]
+
+    def _pop(self):
+        """Pick the next frame, or None if only dead entries were queued; the caller holds _cond."""
+        queues = self._queues
+        for priority, queued in enumerate(queues):
+            while queued and queued[0][0] is None:
+                queued.popleft()
+                self._dead[priority] -= 1
+        top = next((priority for priority, queued in enumerate(queues) if queued), None)
+        if top is None:
+            return None
+        if not self._promoted:
+            deadline = _monotonic() - self.starvation_limit
+            oldest = None
+            for priority in range(top + 1, len(queues)):
+                queued = queues[priority]
+                if queued and queued[0][1] <= deadline and (oldest is None or queued[0][1] < queues[oldest][0][1]):
+                    oldest = priority
+            if oldest is not None:
+                self._promoted = True
+                self.promoted[oldest] += 1
+                return oldest, queues[oldest].popleft()
+        self._promoted = False
+        return top, queues[top].popleft()
+
+    def _run(self):
+        waits = self.waits
+        while True:
+            with self._cond:
+                picked = None
+                while picked is None:
+                    while not any(self._queues):
+                        if self._stopping:
+                            return
+                        self._cond.wait()
+                    picked = self._pop()
+                priority, (message, queued_at, key, _) = picked
+                if key is not None:
+                    del self._sets[key]
+            started = _monotonic()
+            max_age = self.max_age
+            if max_age is not None and started - queued_at > max_age \
+                    and message.arbitration_id & SET_REQUEST_MASK == ARBIT_SET_REQUEST:
+                self.expired[priority] += 1
+                logger.info("Dropped SET request that waited %.1fs to be sent: %s", started - queued_at, message)
+                continue
+            waits[priority][bisect.bisect_left(TX_WAIT_BUCKETS, started - queued_at)] += 1
+            for listener in self.listeners:
+                listener(message, priority)
+            try:
+                self.bus.send(message)
+            except (can.CanError, OSError):
+                logger.exception("Failed to send CAN message: %s", message)
+                self.errors += 1
+                self.last_error = _monotonic()
+            else:
+                self.last_sent = _monotonic()
+            self.sent[priority] += 1
+            if self.frame_time:
+                remaining = started + self.frame_time - _monotonic()
+                if remaining > 0:
+                    time.sleep(remaining)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True, name="can-tx")
+        self._thread.start()
+
+    def stop(self, timeout=2):
+        """Send what is still queued, then stop the sender thread.
+
+        Returns the number of frames still queued after timeout seconds.
+        """
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join(timeout)
+        return sum(self.pending())
+
+    def stats(self):
+        """Per-class counters and wait histograms, keyed by class name."""
+        bounds = ["%gms" % (bound * 1000) for bound in TX_WAIT_BUCKETS] + ["inf"]
+        return {
+            name: {
+                "queued": len(self._queues[priority]) - self._dead[priority],
+                "sent": self.sent[priority],
+                "promoted": self.promoted[priority],
+                "collapsed": self.collapsed[priority],
+                "expired": self.expired[priority],
+                "wait": dict(zip(bounds, self.waits[priority])),
+            }
+            for priority, name in enumerate(TX_CLASSES)
+        }
+
+
+def open_can_bus(filters=CAN_FILTERS):
+    """Open the CAN bus selected by CAN_BACKEND with filters applied."""
+    if CAN_BACKEND == "raw":
+        from rawcan import RawCanBus
+        return RawCanBus.open(CAN_CHANNEL, filters=filters, receive_own_messages=True)
     bus = can.Bus(bustype=CAN_INTERFACE, channel=CAN_CHANNEL, bitrate=125000, receive_own_messages=True)
-    bus.set_filters([
-        {"can_id": ARBIT_GET_REQUEST, "can_mask": 0x1FFFFFFF, "extended": True},  # GET request (snoop)
-        {"can_id": ARBIT_SET_REPLY,   "can_mask": 0x1FFFFFFF, "extended": True},  # Reply to SET
-        {"can_id": ARBIT_GET_REPLY,   "can_mask": 0x1FFFFFFF, "extended": True},  # Reply to GET
-    ])
+    bus.set_filters(filters)
+    return bus
+
+
+def sd_notify(state):
+    """Send state (e.g. "READY=1" or "WATCHDOG=1") to systemd's NOTIFY_SOCKET.
+
+    Returns False without doing anything when not run by systemd.
+    """
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return False
+    if address[0] == "@":
+        address = "\0" + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.connect(address)
+            sock.sendall(state.encode())
+    except OSError:
+        logger.warning("Cannot notify systemd at %s", address)
+        return False
+    return True
+
+
+class CanReceiver:
+    """run_can_loop() on a thread, over a bus that can be reopened in place.
+
+    open_bus() is called by reopen() (and by start() when no bus was given);
+    the new bus is handed to tx as well so transmissions follow it.
+    """
+
+    def __init__(self, open_bus, relays, client, pending_gets, bus=None, tx=None, trace=None):
+        self.open_bus = open_bus
+        self.relays = relays
+        self.client = client
+        self.pending_gets = pending_gets
+        self.bus = bus
+        self.tx = tx
+        self.trace = trace
+        self.reopens = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.bus is None:
+            self.bus = self.open_bus()
+        if self.tx is not None:
+            self.tx.bus = self.bus
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=run_can_loop, args=(self.bus, self.relays, self.client, self.pending_gets),
+            kwargs={"trace": self.trace, "stop": self._stop}, daemon=True, name="can-rx",
+        )
+        self._thread.start()
+
+    def stop(self, timeout=1):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+
+    def reopen(self):
+        """Close the bus and open a new one; raises whatever open_bus() raises."""
+        self.stop()
+        self._close()
+        self.bus = self.open_bus()
+        self.reopens += 1
+        self.start()
+
+    def _close(self):
+        if self.bus is not None:
+            try:
+                self.bus.shutdown()
+            except (can.CanError, OSError):
+                logger.exception("Failed to close the CAN bus")
+            self.bus = None
+
+    def attach(self, client, tx=None):
+        """Publish through client (and send through tx) from now on, e.g. after a takeover."""
+        self.stop()
+        self.client = client
+        self.tx = tx
+        self.start()
+
+    def shutdown(self):
+        self.stop()
+        self._close()
+
+
+class PassiveClient:
+    """MQTT stand-in for the CAN handlers of a standby instance.
+
+    The active instance publishes every state; the standby only keeps its
+    RelayTable and pending GETs in step with the bus.
+    """
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        pass
+
+
+def make_probe(config, bus):
+    """Return a callable that sends a GET for the first configured light, or None."""
+    if not config:
+        return None
+    module, relay = parse_address(config[0]["address"])
+    return lambda: bus.send(build_get_message(module, relay))
+
+
+class Watchdog:
+    """Tell whether the bridge is making progress and act on it.
+
+    The CAN side is live while frames keep arriving (RelayTable.received);
+    an idle bus is probed with a GET request after half of can_timeout, and
+    the request's own echo or its reply counts as a frame. The send side is
+    live while the TxScheduler's last send succeeded, and the bridge is
+    ready once it is live and the MQTT client is connected.
+
+    check() runs every interval seconds: it pings systemd with WATCHDOG=1
+    only while live, and calls reopen() (e.g. CanReceiver.reopen) when the
+    CAN side is stalled. Reopens are retried with exponential backoff until
+    a frame arrives, including reopens that succeeded but brought no frames.
+
+    With can_timeout=None silence never counts as a stall. A standby uses
+    this: it may not send a probe, so it cannot tell a quiet bus from a dead
+    one, and it leaves the CAN side to the watchdog it gets when promoted.
+    """
+
+    def __init__(self, relays, tx=None, client=None, probe=None, reopen=None,
+                 can_timeout=WATCHDOG_CAN_TIMEOUT, interval=WATCHDOG_INTERVAL,
+                 backoff=WATCHDOG_REOPEN_BACKOFF, max_backoff=WATCHDOG_REOPEN_MAX_BACKOFF, notify=sd_notify):
+        self.relays = relays
+        self.tx = tx
+        self.client = client
+        self.probe = probe
+        self.reopen = reopen
+        self.can_timeout = can_timeout
+        watchdog_usec = os.environ.get("WATCHDOG_USEC")
+        self.interval = min(interval, int(watchdog_usec) / 2e6) if watchdog_usec else interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.notify = notify
+        self.reopens = 0
+        self.reopen_failures = 0
+        # wall-clock time frames are measured from: start, or the last reopen
+        self._since = time.time()
+        self._probed = 0.0
+        self._next_reopen = 0.0
+        self._delay = backoff
+        self._stop = threading.Event()
+        self._thread = None
+
+    def status(self, now=None):
+        """Return the health report served at /healthz and /readyz."""
+        now = time.time() if now is None else now
+        frame_age = now - max(self.relays.received, self._since)
+        can_ok = self.can_timeout is None or frame_age <= self.can_timeout
+        tx = self.tx
+        send_ok = tx is None or tx.last_error <= tx.last_sent
+        mqtt_ok = self.client is None or self.client.is_connected()
+        live = can_ok and send_ok
+        return {
+            "live": live,
+            "ready": live and mqtt_ok,
+            "can": {"ok": can_ok, "last_frame_age": round(frame_age, 3), "reopens": self.reopens},
+            "send": {"ok": send_ok, "errors": tx.errors if tx is not None else 0},
+            "mqtt": {"ok": mqtt_ok},
+        }
+
+    def check(self, now=None):
+        """Probe, reopen and notify as needed; returns status()."""
+        now = time.time() if now is None else now
+        status = self.status(now)
+        frame_age = status["can"]["last_frame_age"]
+        if self.probe is not None and self.can_timeout is not None and frame_age > self.can_timeout / 2 and now - self._probed >= self.can_timeout / 2:
+            self._probed = now
+            self.probe()
+        if status["can"]["ok"]:
+            # Only frames prove a reopen worked; the grace period after it does not.
+            if self.relays.received > self._since:
+                self._delay = self.backoff
+        elif self.reopen is not None and now >= self._next_reopen:
+            self._reopen(now)
+        if status["live"]:
+            self.notify("WATCHDOG=1")
+        return status
+
+    def _reopen(self, now):
+        logger.warning("No CAN frames for %.1fs, reopening the bus", now - max(self.relays.received, self._since))
+        try:
+            self.reopen()
+        except (can.CanError, OSError):
+            self.reopen_failures += 1
+            logger.exception("Reopening the CAN bus failed, retrying in %gs", self._delay)
+        else:
+            self.reopens += 1
+            self._since = now
+        self._next_reopen = now + self._delay
+        self._delay = min(self._delay * 2, self.max_backoff)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                logger.exception("Watchdog check failed")
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True, name="watchdog")
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=2)
+
+
+class LeaderElection:
+    """Active/standby role of this instance, decided by heartbeats on topic.
+
+    The active instance publishes its id retained to topic every interval
+    seconds. A standby takes over when it has heard no live heartbeat for
+    timeout seconds, so a takeover happens within timeout + interval; when
+    the active instance announces "<id> offline" (its last will, or a clean
+    stop) the standby takes over at once. A retained heartbeat names the
+    last leader but is no sign of life. If two instances are active at the
+    same time, the one with the higher id calls on_demote.
+
+    Every instance starts as a standby, so a lone instance takes over after
+    timeout seconds. check() runs every interval seconds on a thread; the
+    election needs its own MQTT client (see start_election_client()).
 
-    # MQTT client setup
+    With an availability_topic, the active instance also publishes a
+    retained "online" there with every heartbeat. The broker sends a dead
+    leader's last will ("offline") only after its keepalive ran out, which
+    can be long after the takeover; the next heartbeat corrects it.
+    """
+
+    def __init__(self, instance=INSTANCE_ID, topic=LEADER_TOPIC, interval=LEADER_HEARTBEAT, timeout=LEADER_TIMEOUT,
+                 on_promote=None, on_demote=None, availability_topic=None):
+        self.instance = instance
+        self.topic = topic
+        self.availability_topic = availability_topic
+        self.interval = interval
+        self.timeout = timeout
+        self.on_promote = on_promote
+        self.on_demote = on_demote
+        self.client = None
+        self.active = False
+        self.leader = None
+        self.takeovers = 0
+        # time.monotonic() of the last live heartbeat; None once the leader left
+        self._heard = time.monotonic()
+        self._wake = threading.Event()
+        self._stop = False
+        self._thread = None
+
+    def on_connect(self, client, userdata, flags, rc):
+        client.subscribe(self.topic, qos=1)
+        # Heartbeats were not seen while disconnected; give the leader a full timeout.
+        self._heard = time.monotonic()
+
+    def on_message(self, client, userdata, msg):
+        instance, _, status = msg.payload.decode(errors="replace").partition(" ")
+        if not instance or instance == self.instance:
+            return
+        if status == "offline":
+            if instance == self.leader:
+                self._heard = None
+                self._wake.set()
+            return
+        self.leader = instance
+        if msg.retain:
+            return
+        self._heard = time.monotonic()
+        if self.active and instance < self.instance:
+            logger.warning("Instance %s is active as well, standing down", instance)
+            self.active = False
+            if self.on_demote is not None:
+                self.on_demote()
+
+    def check(self, now=None):
+        """Send the heartbeat while active, or take over when the leader is gone."""
+        now = time.monotonic() if now is None else now
+        client = self.client
+        if self.active:
+            client.publish(self.topic, self.instance, qos=1, retain=True)
+            if self.availability_topic is not None:
+                client.publish(self.availability_topic, "online", qos=1, retain=True)
+            return
+        # Without the broker, heartbeats cannot be told from silence.
+        if not client.is_connected():
+            return
+        heard = self._heard
+        if heard is None or now - heard >= self.timeout:
+            self.promote()
+
+    def promote(self):
+        logger.warning("Taking over from %s", self.leader or "nobody")
+        self.active = True
+        self.leader = self.instance
+        self.takeovers += 1
+        self.client.publish(self.topic, self.instance, qos=1, retain=True)
+        if self.on_promote is not None:
+            self.on_promote()
+
+    def _run(self):
+        while not self._stop:
+            try:
+                self.check()
+            except Exception:
+                logger.exception("Leader election check failed")
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True, name="election")
+        self._thread.start()
+
+    def stop(self):
+        """Stop the thread; an active instance hands over at once."""
+        self._stop = True
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout=2)
+        if self.active:
+            self.active = False
+            info = self.client.publish(self.topic, f"{self.instance} offline", qos=1)
+            try:
+                info.wait_for_publish(1)
+            except (RuntimeError, ValueError):
+                pass  # disconnected: the standby takes over after LEADER_TIMEOUT
+
+
+def wait_for_leadership(election, stop, poll=0.5):
+    """Block until election promotes this instance (True) or stop is set (False).
+
+    Replaces election.on_promote.
+    """
+    promoted = threading.Event()
+    election.on_promote = promoted.set
+    while not stop.is_set():
+        if promoted.wait(poll):
+            return True
+    return False
+
+
+def start_election_client(election):
+    """Connect election's own MQTT client, whose last will announces this instance offline."""
     client = mqtt.Client()
-    client.on_connect = make_on_connect(config)
-    client.on_message = make_on_message(mqtt_to_can, bus)
+    client.will_set(election.topic, f"{election.instance} offline", qos=1)
+    client.on_connect = election.on_connect
+    client.on_message = election.on_message
+    election.client = client
     client.connect(MQTT_BROKER, MQTT_PORT, 60)
     client.loop_start()
+    return client
 
-    # HTTP server
-    httpd = HTTPServer(("0.0.0.0", 8000), RequestHandler)
-    threading.Thread(target=httpd.serve_forever).start()
 
-    # CAN bus loop
-    pending_gets = deque()
-    while True:
-        message = bus.recv()
-        handle_can_message(message, can_to_mqtt, client, pending_gets)
+def start_mqtt_client(config, mqtt_to_can, bus, relays, timers=None, refresh_bus=None, trace=None, freshness=None,
+                      dimmers=None):
+    """Connect to the MQTT broker and start paho's network thread.
+
+    Refresh GETs go to refresh_bus when given (e.g. a TX_BACKGROUND lane).
+    Stale commands are dropped by freshness, and brightness commands go to
+    dimmers, if given.
+    """
+    client = mqtt.Client()
+    client.will_set(AVAILABILITY_TOPIC, "offline", qos=1, retain=True)
+    refresher = RefreshCoordinator(relays, bus if refresh_bus is None else refresh_bus, client)
+    extra_topics = (REFRESH_GET_TOPICS, REFRESH_TOPIC) + ((BRIGHTNESS_SET_TOPICS,) if dimmers is not None else ())
+    client.on_connect = make_on_connect(config, extra_topics=extra_topics, availability_topic=AVAILABILITY_TOPIC)
+    client.on_message = make_on_message(mqtt_to_can, bus, build_refresh_table(config), refresher, timers, trace,
+                                        freshness, dimmers)
+    client.connect(MQTT_BROKER, MQTT_PORT, 60)
+    client.loop_start()
+    return client
+
+
+def start_http_server(relays, bus, mqtt_to_can, port=HTTP_PORT, rules=None, tx=None, profiler=None, traces=None,
+                      watchdog=None, snoop=None, freshness=None):
+    """Serve RequestHandler on port from background threads, backed by relays and bus."""
+    RequestHandler.freshness = freshness
+    RequestHandler.watchdog = watchdog
+    RequestHandler.snoop = snoop
+    RequestHandler.profiler = profiler
+    RequestHandler.traces = traces
+    RequestHandler.relays = relays
+    RequestHandler.history = StateHistory(relays)
+    RequestHandler.bus = bus
+    RequestHandler.mqtt_to_can = mqtt_to_can
+    RequestHandler.rules = rules
+    RequestHandler.tx = tx
+    RequestHandler.events = StateBroadcaster(relays)
+    RequestHandler.events.start()
+    httpd = ThreadingHTTPServer(("0.0.0.0", port), RequestHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True, name="http").start()
+    return httpd
+
+
+def dump_traces(traces):
+    """Return {stage: TraceRing.dump()} for the trace rings."""
+    return {stage: ring.dump() for stage, ring in traces.items()}
 
+
+def install_debug_signals(profiler, traces, directory=PROFILE_DIR):
+    """SIGUSR1 starts a PROFILE_SECONDS capture; SIGUSR2 writes the trace rings to a file."""
+    def on_profile(signum, frame):
+        path = profiler.start(PROFILE_SECONDS)
+        if path is None:
+            logger.info("A profile is already being captured")
+        else:
+            logger.info("Profiling for %gs into %s", PROFILE_SECONDS, path)
+
+    def on_trace(signum, frame):
+        path = os.path.join(directory, time.strftime("trace-%Y%m%d-%H%M%S.json"))
+        with open(path, "w") as file:
+            json.dump(dump_traces(traces), file)
+        logger.info("Wrote trace rings to %s", path)
+
+    signal.signal(signal.SIGUSR1, on_profile)
+    signal.signal(signal.SIGUSR2, on_trace)
+
+
+def install_shutdown_signals(stop):
+    """Set the threading.Event stop on SIGTERM or SIGINT."""
+    def on_signal(signum, frame):
+        logger.info("Received %s, shutting down", signal.Signals(signum).name)
+        stop.set()
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+
+
+def save_relay_states(relays, path=RELAY_STATE_PATH):
+    """Write every known relay state to path as {"0107": "ON", ...}."""
+    states = relays.states
+    snapshot = {
+        f"{key:04X}": STATE_PAYLOADS[states[key]]
+        for key in range(RELAY_SPACE)
+        if states[key] != STATE_UNKNOWN
+    }
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(snapshot, file)
+    os.replace(tmp_path, path)
+    return len(snapshot)
+
+
+def load_relay_states(relays, path=RELAY_STATE_PATH):
+    """Seed relays.states from a save_relay_states() file, if there is one.
+
+    The states are left stale (updated stays 0.0), so refresh requests still
+    ask the bus; they only stand in until the first report arrives.
+    """
+    try:
+        with open(path, "r") as file:
+            snapshot = json.load(file)
+    except FileNotFoundError:
+        return 0
+    except ValueError:
+        logger.warning("Ignoring unreadable relay state snapshot %s", path)
+        return 0
+    for address, payload in snapshot.items():
+        relays.states[int(address, 16)] = STATE_PAYLOADS.index(payload)
+    return len(snapshot)
+
+
+def graceful_shutdown(client, relays, pending_gets=None, tx=None, timers=None, discovery=None, httpd=None,
+                      timeout=SHUTDOWN_TIMEOUT, state_path=RELAY_STATE_PATH, availability_topic=AVAILABILITY_TOPIC,
+                      commands=None):
+    """Stop the bridge in order, spending at most timeout seconds draining.
+
+    New MQTT commands and HTTP requests are refused first. Then the timers
+    stop, the CAN TX queue drains, outstanding GET requests get a chance to
+    be answered (the CAN receiver must still be running), timers and relay
+    states are saved, "offline" is published to availability_topic and the
+    MQTT connection is flushed and closed. The bus is left to the caller.
+    Pass availability_topic=None when another instance is still serving the
+    lights (a demoted standby), so that they stay available. In the split
+    deployment, commands is the ShmRing the CAN process sends from: the
+    drain waits for it to empty too, and frames left in it count as unsent.
+
+    Returns a report of the time taken and of everything left behind.
+    """
+    started = time.monotonic()
+    deadline = started + timeout
+
+    def remaining():
+        return max(0.0, deadline - time.monotonic())
+
+    # paho drops incoming messages when there is no on_message callback.
+    client.on_message = None
+    client.on_connect = None
+    if httpd is not None:
+        httpd.shutdown()
+    if timers is not None:
+        timers.stop()
+    if discovery is not None:
+        discovery.stop()
+    can_unsent = tx.stop(remaining()) if tx is not None else 0
+    while commands is not None and len(commands) and remaining():
+        time.sleep(0.01)
+    if commands is not None:
+        can_unsent += len(commands)
+    while pending_gets and remaining():
+        time.sleep(0.01)
+    # Replies that arrived during the drain may have armed auto-off timers.
+    if timers is not None:
+        timers.save()
+    states_saved = save_relay_states(relays, state_path)
+    info = None
+    if availability_topic is not None:
+        info = client.publish(availability_topic, "offline", qos=1, retain=True)
+        try:
+            info.wait_for_publish(remaining())
+        except (RuntimeError, ValueError):
+            pass
+    while client.want_write() and remaining():
+        time.sleep(0.01)
+    mqtt_flushed = (info is None or info.is_published()) and not client.want_write()
+    client.disconnect()
     client.loop_stop()
+    if httpd is not None:
+        httpd.server_close()
+    report = {
+        "seconds": round(time.monotonic() - started, 3),
+        "can_unsent": can_unsent,
+        "gets_unanswered": len(pending_gets) if pending_gets else 0,
+        "states_saved": states_saved,
+        "mqtt_flushed": mqtt_flushed,
+    }
+    if can_unsent or report["gets_unanswered"] or not mqtt_flushed:
+        logger.warning("Shutdown left work behind: %s", report)
+    else:
+        logger.info("Shutdown complete: %s", report)
+    return report
+
+
+def start_state_export(relays, name=STATE_EXPORT_NAME):
+    """Mirror relays.states into a shared memory block (see shmstate.py)."""
+    from shmstate import StateExport
+    export = StateExport.create(name)
+    export.load(relays.states)
+    relays.listeners.append(export.set)
+    return export
+
+
+def run_can_loop(bus, relays, client, pending_gets, trace=None, stop=None):
+    """Receive frames and hand them to the CAN handlers until stop is set.
+
+    Runs forever without a threading.Event stop. With a TraceRing, each
+    frame's handling time is recorded in it.
+    """
+    clock = time.perf_counter
+    if stop is None:
+        stop = threading.Event()
+    if hasattr(bus, "recv_batch"):
+        while not stop.is_set():
+            batch = bus.recv_batch(timeout=0.5)
+            if not batch:
+                continue
+            relays.received = time.time()
+            for arbitration_id, data in batch:
+                started = clock()
+                dispatch_can_frame(arbitration_id, data, relays, client, pending_gets)
+                if trace is not None:
+                    trace.record(arbitration_id, started)
+    else:
+        while not stop.is_set():
+            message = bus.recv(timeout=0.5)
+            if message is None:
+                continue
+            started = clock()
+            handle_can_message(message, relays, client, pending_gets)
+            if trace is not None:
+                trace.record(message.arbitration_id, started)
+
+
+# ---------------------------------------------------------------------------
+# Split-process deployment
+#
+# The CAN process owns the bus and only moves frames; the MQTT process owns
+# the broker connection, the RelayTable and pending_gets. Frames received
+# from the bus and frames to transmit travel through two ShmRing buffers
+# created by the supervisor, so either child can be restarted without
+# touching the other and a stalled MQTT side never blocks CAN reception:
+# when the frame ring is full new frames are counted as dropped.
+# ---------------------------------------------------------------------------
+
+# timestamp, arbitration_id, dlc, data — used in both directions
+FRAME_RECORD = struct.Struct("=dIB3x8s")
+
+
+class RingBus:
+    """bus stand-in for the MQTT process: send() queues frames for the CAN process."""
+
+    def __init__(self, ring):
+        self.ring = ring
+
+    def send(self, message):
+        data = bytes(message.data)
+        if not self.ring.push(FRAME_RECORD, time.time(), message.arbitration_id, len(data), data):
+            logger.warning("Command ring full, dropped CAN message: %s", message)
+
+
+def _forward_commands(commands, bus, stop):
+    """Transmit every frame the MQTT process queued in the commands ring.
+
+    Once stop is set, what is still queued is sent before returning.
+    """
+    while True:
+        record = commands.pop(FRAME_RECORD)
+        if record is None:
+            if stop.is_set():
+                return
+            time.sleep(RING_POLL_INTERVAL)
+            continue
+        _, arbitration_id, dlc, data = record
+        bus.send(can.Message(arbitration_id=arbitration_id, data=data[:dlc], is_extended_id=True))
+
+
+def run_can_side(bus, frames, commands, stop):
+    """CAN process loop: push received frames into frames, transmit commands.
+
+    Runs until stop (a threading.Event or multiprocessing.Event) is set,
+    then sends the commands still queued.
+    """
+    sender = threading.Thread(target=_forward_commands, args=(commands, bus, stop), daemon=True, name="can-tx")
+    sender.start()
+    full = False
+    while not stop.is_set():
+        if hasattr(bus, "recv_batch"):
+            batch = [(time.time(), arbitration_id, bytes(data)) for arbitration_id, data in bus.recv_batch(timeout=0.5)]
+        else:
+            message = bus.recv(timeout=0.5)
+            if message is None:
+                continue
+            batch = [(message.timestamp, message.arbitration_id, bytes(message.data))]
+        for timestamp, arbitration_id, data in batch:
+            pushed = frames.push(FRAME_RECORD, timestamp, arbitration_id, len(data), data)
+            if not pushed and not full:
+                logger.warning("Frame ring full, dropping CAN frames until the MQTT process catches up")
+            full = not pushed
+    sender.join(timeout=1)
+
+
+def run_mqtt_side(frames, relays, client, pending_gets, stop, trace=None):
+    """MQTT process loop: dispatch frames from the frames ring to the CAN handlers.
+
+    Runs until the threading.Event stop is set. With a TraceRing, each
+    frame's handling time is recorded in it.
+    """
+    clock = time.perf_counter
+    while not stop.is_set():
+        record = frames.pop(FRAME_RECORD)
+        if record is None:
+            time.sleep(RING_POLL_INTERVAL)
+            continue
+        started = clock()
+        relays.received, arbitration_id, dlc, data = record
+        dispatch_can_frame(arbitration_id, data[:dlc], relays, client, pending_gets)
+        if trace is not None:
+            trace.record(arbitration_id, started)
+
+
+def _can_process_main(frames_name, commands_name, filters=CAN_FILTERS, stop=None):
+    """CAN child: runs until the supervisor sets the multiprocessing.Event stop.
+
+    SIGTERM and SIGINT are ignored. Under systemd (KillMode=control-group)
+    or Ctrl+C every process gets the signal at once, and the CAN process
+    must outlive the MQTT process, which drains its commands through it.
+    """
+    from shmring import ShmRing
+    logging.basicConfig(level=logging.INFO)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    frames = ShmRing.attach(frames_name)
+    commands = ShmRing.attach(commands_name)
+    bus = open_can_bus(filters)
+    run_can_side(bus, frames, commands, stop)
+    bus.shutdown()
+
+
+def _mqtt_process_main(frames_name, commands_name, config_path):
+    from shmring import ShmRing
+    logging.basicConfig(level=logging.INFO)
+    # Replaces the handlers inherited from the supervisor.
+    stop = threading.Event()
+    install_shutdown_signals(stop)
+    frames = ShmRing.attach(frames_name)
+    commands = ShmRing.attach(commands_name)
+    config = load_config(config_path)
+    can_to_mqtt, mqtt_to_can = build_lookup_tables(config)
+    relays = RelayTable(can_to_mqtt)
+    apply_payload_schemas(relays, config)
+    load_relay_states(relays)
+    bus = RingBus(commands)
+    if STATE_EXPORT_NAME:
+        start_state_export(relays)
+    tx = TxScheduler(bus)
+    snoop = None
+    if SNOOP_SET_REQUESTS:
+        snoop = SetSnooper(config, relays)
+        tx.listeners.append(snoop.on_sent)
+    tx.start()
+    timers = TimerScheduler(config, relays, tx.lane(TX_BATCH))
+    timers.start()
+    rules = RuleEngine(compile_rules(config), relays, tx.lane(TX_INTERACTIVE))
+    dimmers = None
+    if any(light.get("dimmer") for light in config):
+        dimmers = DimmerStreamer(config, relays, tx.lane(TX_INTERACTIVE))
+        dimmers.start()
+    traces = {"can": TraceRing(TRACE_CAPACITY), "mqtt": TraceRing(TRACE_CAPACITY)}
+    profiler = SamplingProfiler(PROFILE_INTERVAL, PROFILE_DIR)
+    install_debug_signals(profiler, traces)
+    freshness = CommandFreshness()
+    client = start_mqtt_client(config, mqtt_to_can, tx.lane(TX_INTERACTIVE), relays, timers,
+                               refresh_bus=tx.lane(TX_BACKGROUND), trace=traces["mqtt"], freshness=freshness,
+                               dimmers=dimmers)
+    discovery = None
+    if DISCOVERY_ENABLED:
+        discovery = DiscoveryPublisher(client, config_path)
+        discovery.start()
+    # The CAN process owns the bus (the supervisor restarts it if it dies),
+    # so this watchdog only reports and pings.
+    watchdog = Watchdog(relays, tx, client, probe=make_probe(config, tx.lane(TX_BACKGROUND)))
+    watchdog.start()
+    httpd = start_http_server(relays, tx.lane(TX_BATCH), mqtt_to_can, rules=rules, tx=tx,
+                              profiler=profiler, traces=traces, watchdog=watchdog, snoop=snoop,
+                              freshness=freshness)
+    pending_gets = deque()
+    receiver_stop = threading.Event()
+    receiver = threading.Thread(target=run_mqtt_side, args=(frames, relays, client, pending_gets, receiver_stop),
+                                kwargs={"trace": traces["can"]}, daemon=True, name="frames")
+    receiver.start()
+    stop.wait()
+    watchdog.stop()
+    if dimmers is not None:
+        dimmers.stop()
+    graceful_shutdown(client, relays, pending_gets, tx=tx, timers=timers, discovery=discovery, httpd=httpd,
+                      commands=commands)
+    receiver_stop.set()
+    receiver.join(timeout=1)
+
+
+class Supervisor:
+    """Keep named child processes alive, restarting any that exit.
+
+    children maps a name to a (target, args) pair for multiprocessing.Process.
+    A child named in stops is stopped by setting its multiprocessing.Event
+    instead of being sent SIGTERM.
+    """
+
+    def __init__(self, children, backoff=RESTART_BACKOFF, stops=None):
+        self.children = children
+        self.backoff = backoff
+        self.stops = stops or {}
+        self.processes = {}
+        self.restarts = dict.fromkeys(children, 0)
+
+    def _spawn(self, name):
+        target, args = self.children[name]
+        process = multiprocessing.Process(target=target, args=args, name=name, daemon=True)
+        process.start()
+        self.processes[name] = process
+
+    def start(self):
+        for name in self.children:
+            self._spawn(name)
+
+    def poll(self):
+        """Restart every child that has exited; return the restarted names."""
+        restarted = []
+        for name, process in self.processes.items():
+            if not process.is_alive():
+                logger.warning("%s process exited with code %s, restarting", name, process.exitcode)
+                self.restarts[name] += 1
+                restarted.append(name)
+        for name in restarted:
+            self._spawn(name)
+        return restarted
+
+    def run(self, stop):
+        """Poll until the threading.Event stop is set."""
+        while not stop.wait(self.backoff):
+            self.poll()
+
+    def stop(self, timeout=2):
+        """Terminate the children in reverse start order.
+
+        Each child gets up to timeout seconds to exit before the next one is
+        terminated, so a child shutting down can still use the ones started
+        before it (the MQTT process drains through the CAN process). A child
+        with a stop event that does not exit in time is killed.
+        """
+        for name, process in reversed(list(self.processes.items())):
+            event = self.stops.get(name)
+            if event is None:
+                process.terminate()
+            else:
+                event.set()
+            process.join(timeout)
+            if event is not None and process.is_alive():
+                logger.warning("%s process did not stop, killing it", name)
+                process.kill()
+                process.join(timeout)
+
+
+def run_split(config_path="config.yaml"):
+    """Run the bridge as a supervised CAN process plus MQTT process."""
+    from shmring import ShmRing
+    frames = ShmRing.create(FRAME_RECORD.size, RING_CAPACITY)
+    commands = ShmRing.create(FRAME_RECORD.size, RING_CAPACITY)
+    can_stop = multiprocessing.Event()
+    supervisor = Supervisor({
+        "can": (_can_process_main, (frames.name, commands.name,
+                                    build_can_filters(load_config(config_path), SNOOP_SET_REQUESTS), can_stop)),
+        "mqtt": (_mqtt_process_main, (frames.name, commands.name, config_path)),
+    }, stops={"can": can_stop})
+    stop = threading.Event()
+    install_shutdown_signals(stop)
+    supervisor.start()
+    # The MQTT process sends the WATCHDOG=1 pings, which needs NotifyAccess=all.
+    sd_notify("READY=1")
+    try:
+        supervisor.run(stop)
+    finally:
+        sd_notify("STOPPING=1")
+        supervisor.stop(SHUTDOWN_TIMEOUT + 1)
+        if len(commands):
+            logger.warning("Shutdown left %d CAN frames unsent in the command ring", len(commands))
+        frames.close()
+        commands.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    if SPLIT_PROCESSES:
+        run_split("config.yaml")
+    else:
+        config = load_config("config.yaml")
+        can_to_mqtt, mqtt_to_can = build_lookup_tables(config)
+        relays = RelayTable(can_to_mqtt)
+        apply_payload_schemas(relays, config)
+        load_relay_states(relays)
+        stop = threading.Event()
+        install_shutdown_signals(stop)
+
+        open_bus = functools.partial(open_can_bus, build_can_filters(config, SNOOP_SET_REQUESTS))
+        bus = open_bus()
+        traces = {"can": TraceRing(TRACE_CAPACITY), "mqtt": TraceRing(TRACE_CAPACITY)}
+        # The CAN receiver keeps running while the shutdown drains.
+        pending_gets = deque()
+        receiver = CanReceiver(open_bus, relays, PassiveClient(), pending_gets, bus=bus, trace=traces["can"])
+        election = None
+        if STANDBY_ENABLED:
+            # Mirror the bus passively, sending nothing, until the active instance goes away.
+            receiver.start()
+            watchdog = Watchdog(relays, can_timeout=None)
+            watchdog.start()
+            election = LeaderElection(on_demote=stop.set, availability_topic=AVAILABILITY_TOPIC)
+            start_election_client(election)
+            election.start()
+            sd_notify("READY=1")
+            promoted = wait_for_leadership(election, stop)
+            watchdog.stop()
+            if not promoted:
+                election.stop()
+                receiver.shutdown()
+                raise SystemExit(0)
+        if STATE_EXPORT_NAME:
+            start_state_export(relays)
+        tx = TxScheduler(bus)
+        snoop = None
+        if SNOOP_SET_REQUESTS:
+            snoop = SetSnooper(config, relays)
+            tx.listeners.append(snoop.on_sent)
+        tx.start()
+        timers = TimerScheduler(config, relays, tx.lane(TX_BATCH))
+        timers.start()
+        rules = RuleEngine(compile_rules(config), relays, tx.lane(TX_INTERACTIVE))
+        dimmers = None
+        if any(light.get("dimmer") for light in config):
+            dimmers = DimmerStreamer(config, relays, tx.lane(TX_INTERACTIVE))
+            dimmers.start()
+        profiler = SamplingProfiler(PROFILE_INTERVAL, PROFILE_DIR)
+        install_debug_signals(profiler, traces)
+        freshness = CommandFreshness()
+        client = start_mqtt_client(config, mqtt_to_can, tx.lane(TX_INTERACTIVE), relays, timers,
+                                   refresh_bus=tx.lane(TX_BACKGROUND), trace=traces["mqtt"], freshness=freshness,
+                                   dimmers=dimmers)
+        discovery = None
+        if DISCOVERY_ENABLED:
+            discovery = DiscoveryPublisher(client, "config.yaml")
+            discovery.start()
+        receiver.attach(client, tx)
+        watchdog = Watchdog(relays, tx, client, probe=make_probe(config, tx.lane(TX_BACKGROUND)),
+                            reopen=receiver.reopen)
+        watchdog.start()
+        httpd = start_http_server(relays, tx.lane(TX_BATCH), mqtt_to_can, rules=rules, tx=tx,
+                                  profiler=profiler, traces=traces, watchdog=watchdog, snoop=snoop,
+                                  freshness=freshness)
+        sd_notify("READY=1")
+        stop.wait()
+        sd_notify("STOPPING=1")
+        watchdog.stop()
+        if dimmers is not None:
+            dimmers.stop()
+        # A demoted instance leaves the lights to the active one, which keeps them available.
+        demoted = election is not None and not election.active
+        graceful_shutdown(client, relays, pending_gets, tx=tx, timers=timers, discovery=discovery, httpd=httpd,
+                          availability_topic=None if demoted else AVAILABILITY_TOPIC)
+        if election is not None:
+            election.stop()
+        receiver.shutdown()
@@ -0,0 +1,148 @@
+"""Runtime diagnostics: a sampling profiler and per-stage trace rings.
+
+Neither needs a restart. SamplingProfiler runs only while a capture is in
+progress: a background thread snapshots every thread's stack with
+sys._current_frames() at a fixed interval and writes the counts in the
+collapsed-stack format understood by flamegraph.pl and speedscope
+(``thread;module:function;... count``). When no capture is running nothing
+is sampled at all.
+
+TraceRing is the always-on part: a fixed-size ring of (start, duration,
+label) records for one processing stage, written by exactly one thread with
+a few array stores per message. Readers (the HTTP server, a signal handler)
+may see a record that is being overwritten; the data is diagnostic.
+"""
+
+import os
+import sys
+import threading
+import time
+from array import array
+from collections import Counter
+
+
+class SamplingProfiler:
+    """Collect collapsed stacks of all threads for a limited time.
+
+    Usage::
+
+        profiler = SamplingProfiler(directory="/tmp")
+        path = profiler.start(seconds=10)  # None if a capture is running
+    """
+
+    def __init__(self, interval=0.005, directory="."):
+        self.interval = interval
+        self.directory = directory
+        self.last_path = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def sample(self, seconds):
+        """Sample for seconds in the calling thread and return a Counter of stacks."""
+        stacks = Counter()
+        me = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                calls = []
+                while frame is not None:
+                    code = frame.f_code
+                    calls.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                calls.append(names.get(ident) or str(ident))
+                stacks[";".join(reversed(calls))] += 1
+            time.sleep(self.interval)
+        return stacks
+
+    def start(self, seconds):
+        """Capture for seconds in the background; returns the output path.
+
+        Returns None when a capture is already in progress.
+        """
+        with self._lock:
+            if self.running:
+                return None
+            path = os.path.join(self.directory, time.strftime("profile-%Y%m%d-%H%M%S.folded"))
+            self._thread = threading.Thread(target=self._capture, args=(seconds, path), daemon=True, name="profiler")
+            self._thread.start()
+            return path
+
+    def _capture(self, seconds, path):
+        stacks = self.sample(seconds)
+        with open(path, "w") as file:
+            for stack, count in stacks.most_common():
+                file.write(f"{stack} {count}\n")
+        self.last_path = path
+
+    def join(self, timeout=None):
+        if self._thread:
+            self._thread.join(timeout)
+
+
+class TraceRing:
+    """Timings of the last capacity messages through one stage.
+
+    Usage (single writer)::
+
+        started = time.perf_counter()
+        dispatch_can_frame(...)
+        ring.record(arbitration_id, started)
+    """
+
+    def __init__(self, capacity=4096):
+        if capacity & (capacity - 1):
+            raise ValueError("capacity must be a power of two")
+        self.capacity = capacity
+        self.count = 0
+        self._mask = capacity - 1
+        self._started = array("d", bytes(8 * capacity))
+        self._durations = array("d", bytes(8 * capacity))
+        self._labels = [None] * capacity
+        # Maps perf_counter() readings to wall-clock time in dumps.
+        self._epoch = time.time() - time.perf_counter()
+
+    def record(self, label, started, clock=time.perf_counter):
+        """Store one message that entered the stage at perf_counter() value started."""
+        index = self.count & self._mask
+        self._durations[index] = clock() - started
+        self._started[index] = started
+        self._labels[index] = label
+        self.count += 1
+
+    def entries(self):
+        """Return the retained records, oldest first, as (timestamp, seconds, label)."""
+        count = self.count
+        epoch = self._epoch
+        mask = self._mask
+        return [
+            (epoch + self._started[i & mask], self._durations[i & mask], self._labels[i & mask])
+            for i in range(max(0, count - self.capacity), count)
+        ]
+
+    def summary(self):
+        """Return count, retained and p50/p99/max duration in microseconds."""
+        durations = sorted(duration for _, duration, _ in self.entries())
+        if not durations:
+            return {"count": self.count, "retained": 0, "p50_us": None, "p99_us": None, "max_us": None}
+        return {
+            "count": self.count,
+            "retained": len(durations),
+            "p50_us": durations[len(durations) // 2] * 1e6,
+            "p99_us": durations[min(len(durations) - 1, len(durations) * 99 // 100)] * 1e6,
+            "max_us": durations[-1] * 1e6,
+        }
+
+    def dump(self):
+        """Summary plus every retained record, JSON-serialisable."""
+        return dict(self.summary(), entries=[
+            {"timestamp": timestamp, "duration_us": duration * 1e6,
+             "label": label if isinstance(label, str) else f"{label:08X}"}
+            for timestamp, duration, label in self.entries()
+        ])
@@ -0,0 +1,155 @@
+"""Raw SocketCAN receive backend with batched, zero-copy frame decoding.
+
+python-can turns every received frame into a can.Message before
+handle_can_message reads three bytes out of it. This module reads
+``struct can_frame`` records straight from an ``AF_CAN`` raw socket into a
+preallocated buffer and decodes them in place with ``struct.unpack_from``,
+handing (arbitration ID, data view) pairs to can2mqtt.dispatch_can_frame().
+
+Linux ``struct can_frame`` (16 bytes)
+─────────────────────────────────────────────────────────────
+Offset  Size  Field
+─────────────────────────────────────────────────────────────
+0       4     can_id   29-bit ID | EFF (bit 31) | RTR (30) | ERR (29)
+4       1     len      data length code (0-8)
+5       3     padding / reserved / len8_dlc
+8       8     data
+─────────────────────────────────────────────────────────────
+
+The decoding functions work on any buffer, so they can be exercised with a
+socketpair or a bytearray instead of a ``vcan`` device.
+"""
+
+import select
+import socket
+import struct
+
+CAN_FRAME_SIZE = 16
+CAN_DATA_OFFSET = 8
+
+CAN_EFF_FLAG = 0x80000000  # extended (29-bit) frame
+CAN_RTR_FLAG = 0x40000000  # remote transmission request
+CAN_ERR_FLAG = 0x20000000  # error frame
+CAN_EFF_MASK = 0x1FFFFFFF
+
+_FRAME_HEADER = struct.Struct("=IB3x")
+_FRAME = struct.Struct("=IB3x8s")
+_FILTER = struct.Struct("=II")
+
+
+def pack_frame(arbitration_id, data, extended=True):
+    """Encode one frame as a 16-byte ``struct can_frame`` record."""
+    can_id = arbitration_id | CAN_EFF_FLAG if extended else arbitration_id
+    return _FRAME.pack(can_id, len(data), bytes(data))
+
+
+def pack_filters(filters):
+    """Encode python-can style filter dicts as a CAN_RAW_FILTER option value.
+
+    Each filter is ``{"can_id": ..., "can_mask": ..., "extended": bool}``,
+    the same format bus.set_filters() accepts.
+    """
+    packed = bytearray()
+    for can_filter in filters:
+        can_id = can_filter["can_id"]
+        can_mask = can_filter["can_mask"]
+        if can_filter.get("extended"):
+            can_id |= CAN_EFF_FLAG
+            can_mask |= CAN_EFF_FLAG
+        packed += _FILTER.pack(can_id, can_mask)
+    return bytes(packed)
+
+
+def iter_frames(buffer, nbytes):
+    """Yield (arbitration_id, data) for every data frame in buffer[:nbytes].
+
+    data is a memoryview into buffer covering the frame's DLC bytes; nothing
+    is copied, so the views are only valid until the buffer is reused.
+    Remote and error frames are skipped.
+    """
+    view = memoryview(buffer)
+    unpack_from = _FRAME_HEADER.unpack_from
+    for offset in range(0, nbytes - CAN_FRAME_SIZE + 1, CAN_FRAME_SIZE):
+        can_id, length = unpack_from(view, offset)
+        if can_id & (CAN_RTR_FLAG | CAN_ERR_FLAG):
+            continue
+        start = offset + CAN_DATA_OFFSET
+        yield can_id & CAN_EFF_MASK, view[start:start + length]
+
+
+class RawCanBus:
+    """Batched receiver (and minimal sender) on a raw CAN socket.
+
+    Usage::
+
+        bus = RawCanBus.open("can0", filters=CAN_FILTERS)
+        while True:
+            for arbitration_id, data in bus.recv_batch():
+                dispatch_can_frame(arbitration_id, data, relays, client, pending_gets)
+
+    Any connected datagram or seqpacket socket carrying 16-byte
+    ``struct can_frame`` records can be passed to the constructor, which is
+    how the tests drive it through a socketpair.
+    """
+
+    def __init__(self, sock, batch_size=64):
+        self.sock = sock
+        self.batch_size = batch_size
+        self._buffer = bytearray(batch_size * CAN_FRAME_SIZE)
+        view = memoryview(self._buffer)
+        # One preallocated slot view per frame so recv_into() never slices.
+        self._slots = [
+            view[i * CAN_FRAME_SIZE:(i + 1) * CAN_FRAME_SIZE] for i in range(batch_size)
+        ]
+
+    @classmethod
+    def open(cls, channel, filters=(), receive_own_messages=True, batch_size=64):
+        """Bind a raw CAN socket to channel (e.g. "can0") and apply filters."""
+        sock = socket.socket(socket.AF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
+        if filters:
+            sock.setsockopt(socket.SOL_CAN_RAW, socket.CAN_RAW_FILTER, pack_filters(filters))
+        if receive_own_messages:
+            sock.setsockopt(socket.SOL_CAN_RAW, socket.CAN_RAW_RECV_OWN_MSGS, 1)
+        sock.bind((channel,))
+        return cls(sock, batch_size=batch_size)
+
+    def recv_into_buffer(self, timeout=None):
+        """Wait for one frame, then drain whatever else is already queued.
+
+        Returns the number of bytes written to the internal buffer (a multiple
+        of CAN_FRAME_SIZE), or 0 when timeout expires with nothing received.
+        """
+        sock = self.sock
+        # The socket stays in blocking mode (it is shared with send()), so the
+        # timeout is applied with select() and draining uses MSG_DONTWAIT.
+        if timeout is not None and not select.select((sock,), (), (), timeout)[0]:
+            return 0
+        slots = self._slots
+        nbytes = sock.recv_into(slots[0], CAN_FRAME_SIZE)
+        for i in range(1, self.batch_size):
+            try:
+                received = sock.recv_into(slots[i], CAN_FRAME_SIZE, socket.MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                break
+            if received == 0:
+                break
+            nbytes += received
+        return nbytes
+
+    def recv_batch(self, timeout=None):
+        """Receive a batch of frames and return them as (arbitration_id, data) pairs.
+
+        The data views point into the internal buffer and are overwritten by
+        the next call.
+        """
+        return list(iter_frames(self._buffer, self.recv_into_buffer(timeout)))
+
+    def send(self, message):
+        """Send a can.Message (or anything with arbitration_id/data/is_extended_id)."""
+        self.sock.send(pack_frame(message.arbitration_id, message.data, message.is_extended_id))
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def shutdown(self):
+        self.sock.close()
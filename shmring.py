@@ -0,0 +1,135 @@
+"""Lock-free single-producer/single-consumer ring buffer in shared memory.
+
+Used by the split-process deployment of can2mqtt (see run_split() there): the
+CAN process pushes received frames into one ring and the MQTT process pushes
+frames to transmit into another. Each ring has exactly one writer of ``head``
+and one writer of ``tail``, so no lock is needed; a full ring rejects the
+record instead of blocking the producer.
+
+Segment layout
+─────────────────────────────────────────────────────────────
+Offset  Field
+─────────────────────────────────────────────────────────────
+0       magic b"DOBRING1", record_size (u32), capacity (u32)
+64      head    (u64)  records ever pushed     — producer only
+72      dropped (u64)  records rejected (full) — producer only
+128     tail    (u64)  records ever popped     — consumer only
+192     capacity x record_size record slots
+─────────────────────────────────────────────────────────────
+
+head and tail sit on separate cache lines and are 8-byte aligned, and the
+counters are packed in native format ("Q"), which struct stores with one
+8-byte copy, so on 64-bit CPUs a reader never sees a torn value. A producer
+writes the record before publishing it by advancing head; the consumer reads
+the record before releasing the slot by advancing tail. Because both counters
+live in the segment, a restarted producer or consumer resumes exactly where
+its predecessor stopped.
+
+Python issues no memory barriers, so the lock-free claim relies on the CPU
+keeping stores in program order: it holds on x86-64, whose stores are seen
+in order by other cores. On weakly ordered CPUs (ARM, aarch64) the consumer
+may see head advance before the record's bytes, and the split-process
+deployment should not be used there.
+"""
+
+import struct
+from multiprocessing import resource_tracker, shared_memory
+
+MAGIC = b"DOBRING1"
+
+_HEADER = struct.Struct("=8sII")
+_U64 = struct.Struct("Q")  # native: aligned, one 8-byte store
+
+_HEAD_OFFSET = 64
+_DROPPED_OFFSET = 72
+_TAIL_OFFSET = 128
+_DATA_OFFSET = 192
+
+
+class ShmRing:
+    """Fixed-size records in a multiprocessing.shared_memory ring.
+
+    Create the ring once in the supervising process, then attach to it by
+    name from the producer and the consumer::
+
+        ring = ShmRing.create(record_size=24, capacity=4096)
+        ...
+        producer = ShmRing.attach(ring.name)
+        producer.push(FRAME_RECORD, timestamp, arbitration_id, dlc, data)
+        ...
+        consumer = ShmRing.attach(ring.name)
+        record = consumer.pop(FRAME_RECORD)  # tuple, or None when empty
+    """
+
+    def __init__(self, shm, owner=False):
+        self._shm = shm
+        self._owner = owner
+        self._buf = shm.buf
+        magic, self.record_size, self.capacity = _HEADER.unpack_from(self._buf, 0)
+        if magic != MAGIC:
+            raise ValueError(f"shared memory block {shm.name!r} is not a ShmRing")
+        self._mask = self.capacity - 1
+
+    @classmethod
+    def create(cls, record_size, capacity, name=None):
+        """Allocate a new ring; capacity must be a power of two."""
+        if capacity <= 0 or capacity & (capacity - 1):
+            raise ValueError("capacity must be a power of two")
+        size = _DATA_OFFSET + record_size * capacity
+        shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        shm.buf[:_DATA_OFFSET] = bytes(_DATA_OFFSET)
+        _HEADER.pack_into(shm.buf, 0, MAGIC, record_size, capacity)
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        """Attach to a ring created by another process."""
+        shm = shared_memory.SharedMemory(name=name)
+        # Only the creator may unlink the segment; stop the resource tracker
+        # from destroying it when an attached process exits or crashes.
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return cls(shm)
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    @property
+    def dropped(self):
+        """Number of records rejected because the ring was full."""
+        return _U64.unpack_from(self._buf, _DROPPED_OFFSET)[0]
+
+    def __len__(self):
+        return _U64.unpack_from(self._buf, _HEAD_OFFSET)[0] - _U64.unpack_from(self._buf, _TAIL_OFFSET)[0]
+
+    def push(self, record, *values):
+        """Pack values with the struct.Struct record into the next free slot.
+
+        Returns False (and counts a drop) instead of blocking when the ring
+        is full.
+        """
+        buf = self._buf
+        head = _U64.unpack_from(buf, _HEAD_OFFSET)[0]
+        if head - _U64.unpack_from(buf, _TAIL_OFFSET)[0] >= self.capacity:
+            _U64.pack_into(buf, _DROPPED_OFFSET, _U64.unpack_from(buf, _DROPPED_OFFSET)[0] + 1)
+            return False
+        record.pack_into(buf, _DATA_OFFSET + (head & self._mask) * self.record_size, *values)
+        _U64.pack_into(buf, _HEAD_OFFSET, head + 1)
+        return True
+
+    def pop(self, record):
+        """Unpack and release the oldest record, or return None when empty."""
+        buf = self._buf
+        tail = _U64.unpack_from(buf, _TAIL_OFFSET)[0]
+        if tail == _U64.unpack_from(buf, _HEAD_OFFSET)[0]:
+            return None
+        values = record.unpack_from(buf, _DATA_OFFSET + (tail & self._mask) * self.record_size)
+        _U64.pack_into(buf, _TAIL_OFFSET, tail + 1)
+        return values
+
+    def close(self):
+        """Detach from the segment; the creator also unlinks it."""
+        self._buf = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
@@ -0,0 +1,173 @@
+"""Relay state table exported to shared memory for local readers.
+
+The bridge (see start_state_export() in can2mqtt) mirrors its RelayTable
+states into a ``multiprocessing.shared_memory`` block. Other processes on the
+gateway attach to the block by name and read states straight from the
+mapping: no MQTT subscription, no copies and no system calls per read.
+
+Segment layout
+─────────────────────────────────────────────────────────────
+Offset  Field
+─────────────────────────────────────────────────────────────
+0       magic b"DOBSTAT1", slot count (u32)
+64      seq (u64)  even: stable, odd: write in progress — writer only
+128     states, one byte per relay at module << 8 | relay
+        (0 = OFF, 1 = ON, 0xFF = unknown)
+─────────────────────────────────────────────────────────────
+
+Each state is a single byte, so reading one relay is always consistent. The
+sequence counter is a seqlock for readers that need several relays from the
+same instant: the writer makes seq odd, stores, then makes it even again,
+and a reader retries until it sees the same even value before and after its
+reads. Readers that poll can also compare seq with the last value they saw
+to skip unchanged tables.
+
+seq is 8-byte aligned and packed in native format ("Q"), which struct
+stores with one 8-byte copy, so it is never read torn on 64-bit CPUs.
+Python issues no memory barriers, so the seqlock relies on the CPU keeping
+stores and loads in program order: it holds on x86-64. On weakly ordered
+CPUs (ARM, aarch64) a multi-relay read may mix states from before and after
+a write; single-relay reads stay consistent there too.
+"""
+
+import struct
+from multiprocessing import resource_tracker, shared_memory
+
+MAGIC = b"DOBSTAT1"
+SLOTS = 1 << 16
+UNKNOWN = 0xFF
+
+_HEADER = struct.Struct("=8sI")
+_U64 = struct.Struct("Q")  # native: aligned, one 8-byte store
+
+_SEQ_OFFSET = 64
+_STATES_OFFSET = 128
+
+
+class StateExport:
+    """Writer side; exactly one per block, owned by the bridge.
+
+    Usage::
+
+        export = StateExport.create("dobiss_states")
+        export.load(relays.states)
+        relays.listeners.append(export.set)
+    """
+
+    def __init__(self, shm):
+        self._shm = shm
+        self._buf = shm.buf
+        self.states = shm.buf[_STATES_OFFSET:_STATES_OFFSET + SLOTS]
+
+    @classmethod
+    def create(cls, name=None):
+        """Allocate a new block with every state unknown.
+
+        A block of the same name left behind by a crashed bridge is reused.
+        """
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=_STATES_OFFSET + SLOTS)
+        except FileExistsError:
+            shm = shared_memory.SharedMemory(name=name)
+        shm.buf[:_STATES_OFFSET] = bytes(_STATES_OFFSET)
+        shm.buf[_STATES_OFFSET:_STATES_OFFSET + SLOTS] = bytes([UNKNOWN]) * SLOTS
+        _HEADER.pack_into(shm.buf, 0, MAGIC, SLOTS)
+        return cls(shm)
+
+    @property
+    def name(self):
+        return self._shm.name
+
+    @property
+    def seq(self):
+        return _U64.unpack_from(self._buf, _SEQ_OFFSET)[0]
+
+    def set(self, key, state):
+        """Store one relay state (usable directly as a RelayTable listener)."""
+        buf = self._buf
+        seq = _U64.unpack_from(buf, _SEQ_OFFSET)[0]
+        _U64.pack_into(buf, _SEQ_OFFSET, seq + 1)
+        self.states[key] = state
+        _U64.pack_into(buf, _SEQ_OFFSET, seq + 2)
+
+    def load(self, states):
+        """Copy a whole 65,536-byte state table, e.g. RelayTable.states."""
+        buf = self._buf
+        seq = _U64.unpack_from(buf, _SEQ_OFFSET)[0]
+        _U64.pack_into(buf, _SEQ_OFFSET, seq + 1)
+        self.states[:] = states
+        _U64.pack_into(buf, _SEQ_OFFSET, seq + 2)
+
+    def close(self):
+        """Release and unlink the block."""
+        self.states.release()
+        self.states = self._buf = None
+        self._shm.close()
+        self._shm.unlink()
+
+
+class StateReader:
+    """Read-only view of a block created by StateExport.
+
+    Usage::
+
+        reader = StateReader.attach("dobiss_states")
+        if reader.state(0x0107) == 1:
+            ...
+        kitchen, hall = reader.read([0x0107, 0x0200])  # same instant
+    """
+
+    def __init__(self, shm):
+        self._shm = shm
+        self._buf = shm.buf
+        magic, slots = _HEADER.unpack_from(self._buf, 0)
+        if magic != MAGIC:
+            raise ValueError(f"shared memory block {shm.name!r} is not a relay state table")
+        #: memoryview over the state bytes; index with module << 8 | relay
+        self.states = shm.buf[_STATES_OFFSET:_STATES_OFFSET + slots]
+
+    @classmethod
+    def attach(cls, name):
+        shm = shared_memory.SharedMemory(name=name)
+        # The bridge owns the block; stop the resource tracker from
+        # destroying it when this reader exits.
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return cls(shm)
+
+    @property
+    def seq(self):
+        """Change counter; even while the table is stable."""
+        return _U64.unpack_from(self._buf, _SEQ_OFFSET)[0]
+
+    def state(self, key):
+        """Current state byte of relay key."""
+        return self.states[key]
+
+    def read(self, keys):
+        """Return the states of keys as one consistent list."""
+        buf = self._buf
+        states = self.states
+        while True:
+            before = _U64.unpack_from(buf, _SEQ_OFFSET)[0]
+            if before & 1:
+                continue
+            values = [states[key] for key in keys]
+            if _U64.unpack_from(buf, _SEQ_OFFSET)[0] == before:
+                return values
+
+    def snapshot(self):
+        """Return a consistent copy of the whole table as bytes."""
+        buf = self._buf
+        states = self.states
+        while True:
+            before = _U64.unpack_from(buf, _SEQ_OFFSET)[0]
+            if before & 1:
+                continue
+            values = states.tobytes()
+            if _U64.unpack_from(buf, _SEQ_OFFSET)[0] == before:
+                return values
+
+    def close(self):
+        self.states.release()
+        self.states = self._buf = None
+        self._shm.close()
@@ -14,10 +14,13 @@ SET reply  0x0002FF01          [module, relay, state]
 ─────────────────────────────────────────────────────────────
 
 State values: 0 = OFF, 1 = ON, 2 = TOGGLE (SET req only)
+Byte 5 of a SET request is the dimmer level, 0-100 (0x64 = full)
 Bitrate: 125 kbit/s, 29-bit extended frames, CAN mask 0x1FFFFFFF
 """
 
 import threading
+from collections import deque
+
 import can
 
 # Arbitration IDs
@@ -40,17 +43,24 @@ class DobissSimulator:
 
     The simulator tracks the state of every (module, relay) pair it has
     ever seen and keeps a log of every message it has received so tests
-    can make assertions on interactions.
+    can make assertions on interactions. Long-running users (the soak test)
+    pass log_limit to keep only the most recent messages.
     """
 
-    def __init__(self, channel: str = "dobiss_test"):
+    def __init__(self, channel: str = "dobiss_test", log_limit: int | None = None):
         self.channel = channel
         # (module, relay) -> 0|1
         self._relay_states: dict[tuple[int, int], int] = {}
+        # (module, relay) -> 0..100, for relays that received a dimmer level
+        self._levels: dict[tuple[int, int], int] = {}
         # All CAN messages received by the simulator
-        self.received_messages: list[can.Message] = []
+        self.received_messages: list[can.Message] | deque[can.Message] = (
+            [] if log_limit is None else deque(maxlen=log_limit)
+        )
         # All CAN messages sent by the simulator
-        self.sent_messages: list[can.Message] = []
+        self.sent_messages: list[can.Message] | deque[can.Message] = (
+            [] if log_limit is None else deque(maxlen=log_limit)
+        )
 
         self._bus = can.Bus(interface="virtual", channel=channel)
         self._running = False
@@ -68,6 +78,10 @@ class DobissSimulator:
         """Return the current simulated state of a relay (0 or 1)."""
         return self._relay_states.get((module, relay), 0)
 
+    def get_level(self, module: int, relay: int) -> int | None:
+        """Return the last dimmer level a SET request carried, or None."""
+        return self._levels.get((module, relay))
+
     # ------------------------------------------------------------------
     # Lifecycle
     # ------------------------------------------------------------------
@@ -127,6 +141,8 @@ class DobissSimulator:
             state = 1 - self.get_state(module, relay)
 
         self.set_state(module, relay, state)
+        if len(msg.data) > 5 and msg.data[5] <= 100:
+            self._levels[(module, relay)] = msg.data[5]
 
         reply = can.Message(
             arbitration_id=ARBIT_SET_REPLY,
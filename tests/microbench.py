@@ -0,0 +1,246 @@
+"""Microbenchmarks for the per-message protocol functions, with a stored baseline.
+
+Each case calls one hot function with realistic inputs built from the real
+config.yaml and is measured in ns/op (best of several timed rounds) and in
+bytes allocated per op (tracemalloc peak of a single call, best of several
+calls). Results are compared with microbench_baseline.json; a case fails
+when its time grows beyond the tolerance or it allocates more than before.
+
+Times depend on the machine and on whatever else it is doing, so the rounds
+of every case alternate with rounds of a fixed pure-Python reference loop,
+and the case's baseline time is scaled by the ratio of the two reference
+timings before comparing.
+
+Run with:  python3 -m tests.microbench [--update] [--tolerance 0.5]
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import timeit
+import tracemalloc
+from collections import deque
+
+import can
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from can2mqtt import (
+    ARBIT_GET_REPLY,
+    ARBIT_GET_REQUEST,
+    ARBIT_SET_REPLY,
+    RelayTable,
+    build_lookup_tables,
+    build_set_message,
+    handle_can_message,
+    handle_mqtt_message,
+    load_config,
+    parse_address,
+    parse_state,
+)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONFIG_PATH = os.path.join(ROOT, "config.yaml")
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "microbench_baseline.json")
+
+TOLERANCE = 0.5      # relative slowdown allowed against the scaled baseline
+ALLOC_SLACK = 64     # bytes per op a case may allocate beyond its baseline
+ROUND_SECONDS = 0.02  # target duration of one timed round
+ROUNDS = 7
+
+
+class _NullClient:
+    def publish(self, topic, payload, retain=False):
+        pass
+
+
+class _NullBus:
+    def send(self, message):
+        pass
+
+
+def _reference():
+    # Fixed mix of calls, attribute and subscript work similar to the cases.
+    total = 0
+    for i in range(100):
+        total += len(str(i)) + (i & 7)
+    return total
+
+
+def build_cases(config_path=CONFIG_PATH):
+    """Return {case name: zero-argument callable} over the lights in config_path."""
+    config = load_config(config_path)
+    can_to_mqtt, mqtt_to_can = build_lookup_tables(config)
+    relays = RelayTable(can_to_mqtt)
+    client = _NullClient()
+    bus = _NullBus()
+    light = config[len(config) // 2]
+    address = light["address"]
+    module, relay = parse_address(address)
+    set_topic = f"dobiss/light/{address}/state/set"
+    get_request = can.Message(arbitration_id=ARBIT_GET_REQUEST, data=[module, relay], is_extended_id=True)
+    set_reply = can.Message(arbitration_id=ARBIT_SET_REPLY, data=[module, relay, 1], is_extended_id=True)
+    get_reply = can.Message(arbitration_id=ARBIT_GET_REPLY, data=[1], is_extended_id=True)
+    # Bounded, so that the GET request case does not grow it without end.
+    requests = deque(maxlen=64)
+    replies = deque()
+    key = module << 8 | relay
+
+    def reply():
+        replies.append(key)  # the snooped request each reply is paired with
+        handle_can_message(get_reply, relays, client, replies)
+
+    return {
+        "parse_address": lambda: parse_address(address),
+        "parse_state": lambda: parse_state(b"ON"),
+        "build_set_message": lambda: build_set_message(module, relay, 1),
+        "build_lookup_tables": lambda: build_lookup_tables(config),
+        "handle_mqtt_message": lambda: handle_mqtt_message(set_topic, b"ON", mqtt_to_can, bus),
+        "handle_can_message[get_request]": lambda: handle_can_message(get_request, relays, client, requests),
+        "handle_can_message[set_reply]": lambda: handle_can_message(set_reply, relays, client, requests),
+        "handle_can_message[get_reply]": reply,
+    }
+
+
+def _calibrate(timer, round_seconds):
+    number = 1
+    while timer.timeit(number) < round_seconds / 10:
+        number *= 10
+    return max(1, int(number * round_seconds / max(timer.timeit(number), 1e-9)))
+
+
+def time_ns(func, reference=_reference, rounds=ROUNDS, round_seconds=ROUND_SECONDS):
+    """Best ns/op of func and of reference, timed in alternating rounds."""
+    timers = [timeit.Timer(func), timeit.Timer(reference)]
+    numbers = [_calibrate(timer, round_seconds) for timer in timers]
+    best = [float("inf"), float("inf")]
+    for _ in range(rounds):
+        for i, timer in enumerate(timers):
+            best[i] = min(best[i], timer.timeit(numbers[i]) / numbers[i] * 1e9)
+    return best[0], best[1]
+
+
+def alloc_bytes(func, calls=20):
+    """Fewest bytes a single call of func allocated at its peak, over calls calls."""
+    func()  # warm caches and free lists
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    try:
+        best = None
+        for _ in range(calls):
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            func()
+            peak = tracemalloc.get_traced_memory()[1] - current
+            best = peak if best is None else min(best, peak)
+        return max(0, best)
+    finally:
+        if started:
+            tracemalloc.stop()
+
+
+def measure(cases, rounds=ROUNDS, runs=1):
+    """Return {"results": {name: {"ns", "reference_ns", "alloc_bytes"}}} for cases.
+
+    With several runs, each case keeps the run in which it was fastest
+    relative to the reference.
+    """
+    results = {}
+    for _ in range(runs):
+        for name, func in cases.items():
+            ns, reference_ns = time_ns(func, rounds=rounds)
+            best = results.get(name)
+            if best is None or ns / reference_ns < best["ns"] / best["reference_ns"]:
+                results[name] = {"ns": round(ns, 1), "reference_ns": round(reference_ns, 1),
+                                 "alloc_bytes": alloc_bytes(func)}
+    return {"results": results}
+
+
+def scaled_baseline(result, expected):
+    """Baseline ns/op of a case adjusted to the speed the machine ran result at."""
+    return expected["ns"] * result["reference_ns"] / expected["reference_ns"]
+
+
+def compare(measured, baseline, tolerance=TOLERANCE, alloc_slack=ALLOC_SLACK):
+    """Return a failure message for every case that regressed against baseline.
+
+    Cases missing from either side are ignored here; see missing().
+    """
+    failures = []
+    for name, result in measured["results"].items():
+        expected = baseline["results"].get(name)
+        if expected is None:
+            continue
+        scale = result["reference_ns"] / expected["reference_ns"]
+        limit = scaled_baseline(result, expected) * (1 + tolerance)
+        if result["ns"] > limit:
+            failures.append(f"{name}: {result['ns']:.0f} ns/op, limit {limit:.0f} "
+                            f"(baseline {expected['ns']:.0f} x {scale:.2f} machine speed)")
+        if result["alloc_bytes"] > expected["alloc_bytes"] + alloc_slack:
+            failures.append(f"{name}: {result['alloc_bytes']} bytes/op, baseline {expected['alloc_bytes']}")
+    return failures
+
+
+def missing(cases, baseline):
+    """Case names that have no baseline entry."""
+    return sorted(set(cases) - set(baseline["results"]))
+
+
+def environment_mismatch(baseline):
+    """Describe how this interpreter differs from the one baseline was recorded on, or None.
+
+    Allocation sizes and the relative cost of the cases change between Python
+    versions, so baselines only compare within one version and architecture.
+    """
+    here = {"python": platform.python_version(), "machine": platform.machine()}
+    differences = [f"{name} {baseline.get(name)}, running {value}" for name, value in here.items()
+                   if baseline.get(name) != value]
+    return "baseline recorded on " + "; ".join(differences) if differences else None
+
+
+def load_baseline(path=BASELINE_PATH):
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+def save_baseline(measured, path=BASELINE_PATH):
+    baseline = dict(measured, python=platform.python_version(), machine=platform.machine(),
+                    recorded=time.strftime("%Y-%m-%d"))
+    with open(path, "w") as file:
+        json.dump(baseline, file, indent=2, sort_keys=True)
+        file.write("\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--update", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="relative slowdown allowed")
+    args = parser.parse_args(argv)
+    cases = build_cases()
+    baseline = None if args.update or not os.path.exists(BASELINE_PATH) else load_baseline()
+    if baseline is not None and environment_mismatch(baseline):
+        print(f"WARNING: {environment_mismatch(baseline)}; record a new baseline with --update")
+    measured = measure(cases, runs=1 if baseline else 3)
+    print(f"{'case':<34}{'ns/op':>10}{'baseline':>10}{'bytes/op':>10}")
+    for name, result in measured["results"].items():
+        expected = baseline["results"].get(name) if baseline else None
+        scaled = f"{scaled_baseline(result, expected):.0f}" if expected else "-"
+        print(f"{name:<34}{result['ns']:>10.0f}{scaled:>10}{result['alloc_bytes']:>10}")
+    if baseline is None:
+        save_baseline(measured)
+        print(f"baseline written to {BASELINE_PATH}")
+        return 0
+    failures = compare(measured, baseline, args.tolerance) + [
+        f"{name}: no baseline (run with --update)" for name in missing(cases, baseline)
+    ]
+    for failure in failures:
+        print("FAIL: " + failure)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,303 @@
+"""Soak test: run the bridge for a long time and watch for drift.
+
+The bridge pieces (RelayTable, TxScheduler, timers, rules, refresh, state
+history and the trace rings) run against a DobissSimulator on a python-can
+virtual bus. MQTTStandIn plays the broker: commands are injected straight
+into the on_message callback and published states are recorded. A load
+thread mixes set commands, refresh requests and wall-panel GET requests.
+
+Every interval the harness samples RSS, tracemalloc's traced memory, the
+depths of every queue the bridge owns and the p99 command latency (MQTT
+command in, state publish out). After a warm-up, the median of the last
+third of the samples is compared with the median of the first third; a
+metric that grew beyond its threshold fails the run, and the allocation
+sites that grew the most are reported.
+
+Run with:  python3 -m tests.soak --duration 3600 [--rate 50] [--interval 10]
+"""
+
+import argparse
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import deque
+from dataclasses import dataclass, field
+
+import can
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from can2mqtt import (
+    ARBIT_GET_REQUEST,
+    TX_BACKGROUND,
+    TX_BATCH,
+    TX_INTERACTIVE,
+    RefreshCoordinator,
+    RelayTable,
+    RuleEngine,
+    StateHistory,
+    TimerScheduler,
+    TxScheduler,
+    build_lookup_tables,
+    build_refresh_table,
+    compile_rules,
+    handle_can_message,
+    make_on_message,
+    parse_address,
+)
+from profiling import TraceRing
+from tests.dobiss_simulator import DobissSimulator
+
+CONFIG = [
+    {"name": "Light %02X" % relay, "address": "01%02X" % relay, "auto_off": 2} if relay % 4 == 0 else
+    {"name": "Light %02X" % relay, "address": "01%02X" % relay}
+    for relay in range(16)
+]
+CONFIG[1]["rules"] = [{"when": "ON", "then": [{"address": "0102", "state": "ON"}]}]
+
+SIM_LOG_LIMIT = 256  # simulator messages kept; must fill up during the warm-up
+
+# metric -> (relative growth allowed, absolute growth always allowed)
+THRESHOLDS = {
+    "rss_kib": (0.10, 2048),
+    "traced_kib": (0.10, 512),
+    "pending_gets": (0.50, 16),
+    "tx_queued": (0.50, 16),
+    "timers": (0.50, 16),
+    "latency_backlog": (0.50, 16),
+    "sim_log": (0.50, 16),
+    "p99_ms": (1.00, 20.0),
+}
+
+
+def rss_kib():
+    """Current resident set size in KiB."""
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class _Message:
+    __slots__ = ("topic", "payload")
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class MQTTStandIn:
+    """Broker stand-in: keeps retained states and measures command latency."""
+
+    def __init__(self):
+        self.retained = {}
+        self.published = 0
+        self.latencies = []
+        self._sent_at = {}
+        self._lock = threading.Lock()
+
+    def command(self, topic, at):
+        with self._lock:
+            self._sent_at.setdefault(topic, at)
+
+    def publish(self, topic, payload, retain=False):
+        now = time.perf_counter()
+        with self._lock:
+            self.published += 1
+            if retain:
+                self.retained[topic] = payload
+            sent_at = self._sent_at.pop(topic + "/set", None)
+            if sent_at is not None:
+                self.latencies.append(now - sent_at)
+
+    def take_latencies(self):
+        with self._lock:
+            latencies, self.latencies = self.latencies, []
+            return latencies
+
+    @property
+    def backlog(self):
+        return len(self._sent_at)
+
+
+@dataclass
+class SoakResult:
+    samples: list = field(default_factory=list)
+    failures: list = field(default_factory=list)
+    growth: list = field(default_factory=list)
+
+    @property
+    def ok(self):
+        return not self.failures
+
+
+def check_drift(samples, thresholds=THRESHOLDS, warmup=0.2):
+    """Return a failure message for every metric whose last third outgrew its first third."""
+    samples = samples[int(len(samples) * warmup):]
+    third = len(samples) // 3
+    if third == 0:
+        return []
+    failures = []
+    for metric, (relative, absolute) in thresholds.items():
+        first = statistics.median(s[metric] for s in samples[:third])
+        last = statistics.median(s[metric] for s in samples[-third:])
+        if last > first * (1 + relative) + absolute:
+            failures.append(f"{metric} grew from {first:g} to {last:g}")
+    return failures
+
+
+class Bridge:
+    """The bridge's components wired as in __main__, on stoppable threads."""
+
+    def __init__(self, channel, timer_path):
+        can_to_mqtt, self.mqtt_to_can = build_lookup_tables(CONFIG)
+        self.relays = RelayTable(can_to_mqtt)
+        self.client = MQTTStandIn()
+        self.bus = can.Bus(interface="virtual", channel=channel, receive_own_messages=True)
+        self.tx = TxScheduler(self.bus)
+        self.timers = TimerScheduler(CONFIG, self.relays, self.tx.lane(TX_BATCH), path=timer_path)
+        self.rules = RuleEngine(compile_rules(CONFIG), self.relays, self.tx.lane(TX_INTERACTIVE))
+        self.history = StateHistory(self.relays)
+        self.refresher = RefreshCoordinator(self.relays, self.tx.lane(TX_BACKGROUND), self.client)
+        # Small rings so that they are full before the warm-up ends.
+        self.traces = {"can": TraceRing(256), "mqtt": TraceRing(256)}
+        self.on_message = make_on_message(
+            self.mqtt_to_can, self.tx.lane(TX_INTERACTIVE), build_refresh_table(CONFIG),
+            self.refresher, self.timers, self.traces["mqtt"],
+        )
+        self.pending_gets = deque()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def _receive(self):
+        trace = self.traces["can"]
+        clock = time.perf_counter
+        while not self._stop.is_set():
+            message = self.bus.recv(timeout=0.05)
+            if message is not None:
+                started = clock()
+                handle_can_message(message, self.relays, self.client, self.pending_gets)
+                trace.record(message.arbitration_id, started)
+
+    def start(self):
+        self.tx.start()
+        self.timers.start()
+        thread = threading.Thread(target=self._receive, daemon=True, name="soak-can")
+        thread.start()
+        self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout=2)
+        self.timers.stop()
+        self.tx.stop()
+        self.bus.shutdown()
+
+
+def _load(bridge, panel_bus, rate, stop, seed):
+    """Mixed load: 70% set commands, 20% refresh requests, 10% panel GETs."""
+    rng = random.Random(seed)
+    addresses = [light["address"] for light in CONFIG]
+    period = 1.0 / rate
+    next_at = time.perf_counter()
+    while not stop.is_set():
+        address = rng.choice(addresses)
+        pick = rng.random()
+        if pick < 0.7:
+            topic = f"dobiss/light/{address}/state/set"
+            bridge.client.command(topic, time.perf_counter())
+            bridge.on_message(None, None, _Message(topic, rng.choice((b"ON", b"OFF"))))
+        elif pick < 0.9:
+            bridge.on_message(None, None, _Message(f"dobiss/light/{address}/state/get", b""))
+        else:
+            module, relay = parse_address(address)
+            panel_bus.send(can.Message(arbitration_id=ARBIT_GET_REQUEST, data=[module, relay], is_extended_id=True))
+        # The panel hears all bus traffic too; unread frames would pile up in
+        # its virtual bus queue.
+        while panel_bus.recv(timeout=0) is not None:
+            pass
+        next_at += period
+        delay = next_at - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            next_at = time.perf_counter()
+
+
+def run_soak(duration, rate=50.0, interval=10.0, thresholds=THRESHOLDS, seed=0, report=print,
+             sim_log_limit=SIM_LOG_LIMIT):
+    """Run the bridge under load for duration seconds and return a SoakResult."""
+    channel = f"soak_{os.getpid()}_{time.monotonic_ns()}"
+    result = SoakResult()
+    tracemalloc.start(10)
+    sim = DobissSimulator(channel=channel, log_limit=sim_log_limit)
+    sim.start()
+    panel_bus = can.Bus(interface="virtual", channel=channel)
+    with tempfile.TemporaryDirectory() as directory:
+        bridge = Bridge(channel, os.path.join(directory, "timers.json"))
+        bridge.start()
+        stop = threading.Event()
+        load = threading.Thread(target=_load, args=(bridge, panel_bus, rate, stop, seed), daemon=True, name="soak-load")
+        load.start()
+        baseline = None
+        started = time.monotonic()
+        try:
+            while time.monotonic() - started < duration:
+                time.sleep(interval)
+                latencies = sorted(bridge.client.take_latencies())
+                sample = {
+                    "elapsed": time.monotonic() - started,
+                    "rss_kib": rss_kib(),
+                    "traced_kib": tracemalloc.get_traced_memory()[0] // 1024,
+                    "pending_gets": len(bridge.pending_gets),
+                    "tx_queued": sum(bridge.tx.pending()),
+                    "timers": len(bridge.timers.wheel),
+                    "latency_backlog": bridge.client.backlog,
+                    "sim_log": len(sim.received_messages),
+                    "p99_ms": latencies[len(latencies) * 99 // 100] * 1000 if latencies else 0.0,
+                    "commands": len(latencies),
+                }
+                result.samples.append(sample)
+                report("  ".join(f"{k}={v:.1f}" if isinstance(v, float) else f"{k}={v}" for k, v in sample.items()))
+                if baseline is None and sample["elapsed"] >= duration * 0.2:
+                    baseline = tracemalloc.take_snapshot()
+        finally:
+            stop.set()
+            load.join(timeout=2)
+            final = tracemalloc.take_snapshot()
+            bridge.stop()
+            panel_bus.shutdown()
+            sim.stop()
+            tracemalloc.stop()
+    if baseline is not None:
+        result.growth = [str(stat) for stat in final.compare_to(baseline, "lineno")[:5]]
+    result.failures = check_drift(result.samples, thresholds)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--duration", type=float, default=600.0, help="seconds to run (default 600)")
+    parser.add_argument("--rate", type=float, default=50.0, help="load messages per second (default 50)")
+    parser.add_argument("--interval", type=float, default=10.0, help="seconds between samples (default 10)")
+    args = parser.parse_args(argv)
+    result = run_soak(args.duration, args.rate, args.interval)
+    print("top allocation growth since warm-up:")
+    for line in result.growth:
+        print("  " + line)
+    for failure in result.failures:
+        print("FAIL: " + failure)
+    print("soak " + ("passed" if result.ok else "FAILED"))
+    return 0 if result.ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,164 @@
+"""Tests for bustop.py (live bus console view).
+
+The aggregator is fed frames directly; the end-to-end test runs bustop's
+main() against a DobissSimulator on a python-can virtual bus.
+"""
+import io
+import os
+import sys
+import threading
+import time
+
+import can
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bustop import FRAME_OVERHEAD_BITS, BridgeFeed, BusTop, describe, load_names, main, render
+from can2mqtt import ARBIT_GET_REPLY, ARBIT_GET_REQUEST, ARBIT_SET_REPLY, build_set_message
+from tests.dobiss_simulator import DobissSimulator
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "config.yaml")
+
+
+def _set(top, module, relay, state, requested, replied):
+    message = build_set_message(module, relay, state)
+    top.add(message.arbitration_id, message.data, requested)
+    top.add(ARBIT_SET_REPLY, bytes([module, relay, state]), replied)
+
+
+class TestDescribe:
+    def test_known_frames(self):
+        assert describe(ARBIT_GET_REQUEST) == "GET request"
+        assert describe(ARBIT_GET_REPLY) == "GET reply"
+        assert describe(ARBIT_SET_REPLY) == "SET reply"
+        assert describe(build_set_message(0x12, 0, 1).arbitration_id) == "SET request 12"
+
+    def test_unknown_frame(self):
+        assert describe(0x123) == ""
+
+
+class TestBusTop:
+    def test_rates_cover_the_time_since_the_last_snapshot(self):
+        top = BusTop()
+        top.snapshot(now=0.0)
+        for _ in range(10):
+            top.add(ARBIT_GET_REQUEST, bytes([1, 0]), 0.0)
+        snapshot = top.snapshot(now=2.0)
+        assert snapshot["fps"] == 5.0
+        assert snapshot["ids"][0][:3] == (ARBIT_GET_REQUEST, "GET request", 5.0)
+        assert snapshot["utilisation"] == 10 * (FRAME_OVERHEAD_BITS + 16) / 2.0 / top.bitrate
+        assert top.snapshot(now=3.0)["fps"] == 0.0
+        assert top.snapshot(now=4.0)["frames"] == 10
+
+    def test_set_latency_per_module(self):
+        top = BusTop()
+        _set(top, 1, 0, 1, 10.0, 10.010)
+        _set(top, 1, 1, 1, 11.0, 11.030)
+        _set(top, 2, 0, 1, 12.0, 12.005)
+        latency = top.snapshot()["latency"]
+        assert latency[1]["count"] == 2
+        assert round(latency[1]["max_ms"]) == 30
+        assert round(latency[2]["p50_ms"]) == 5
+
+    def test_unrequested_reply_has_no_latency(self):
+        top = BusTop()
+        top.add(ARBIT_SET_REPLY, bytes([1, 0, 1]), 1.0)
+        assert top.snapshot()["latency"] == {}
+
+    def test_get_balance(self):
+        top = BusTop()
+        top.add(ARBIT_GET_REQUEST, bytes([1, 0]), 0.0)
+        top.add(ARBIT_GET_REQUEST, bytes([1, 1]), 0.0)
+        top.add(ARBIT_GET_REPLY, bytes([1]), 0.0)
+        assert top.snapshot()["get"] == {"requests": 2, "replies": 1, "waiting": 1}
+
+    def test_hot_relays_named_and_first_state_not_counted(self):
+        top = BusTop({0x0107: "Kitchen Spots"})
+        for state in (1, 0, 1, 0):
+            _set(top, 1, 7, state, 0.0, 0.0)
+        _set(top, 1, 0, 1, 0.0, 0.0)
+        assert top.snapshot()["hot"] == [(0x0107, "Kitchen Spots", 3)]
+
+    def test_bridge_ids_count_bits_by_frame_type(self):
+        top = BusTop()
+        top.snapshot(now=0.0)
+        top.add_id(ARBIT_GET_REPLY)
+        assert top.snapshot(now=1.0)["utilisation"] == (FRAME_OVERHEAD_BITS + 8) / top.bitrate
+
+
+class TestRender:
+    def test_table(self):
+        top = BusTop({0x0107: "Kitchen Spots"})
+        _set(top, 1, 7, 1, 0.0, 0.012)
+        _set(top, 1, 7, 0, 1.0, 1.012)
+        text = render(top.snapshot())
+        assert "0002FF01   SET reply" in text
+        assert "GET  0 requests  0 replies  0 waiting" in text
+        assert "01              2      12.0" in text
+        assert "0107            1  Kitchen Spots" in text
+
+
+class TestLoadNames:
+    def test_names_from_config(self):
+        names = load_names(CONFIG_PATH)
+        assert names and all(isinstance(key, int) for key in names)
+
+    def test_missing_config(self):
+        assert load_names("/nonexistent/config.yaml") == {}
+
+
+class TestBridgeFeed:
+    def test_counts_only_new_trace_entries(self):
+        top = BusTop()
+        feed = BridgeFeed("http://bridge", top)
+        responses = {
+            "/debug/trace": {"can": {"entries": [
+                {"timestamp": feed.started - 1, "duration_us": 5.0, "label": "0002FF01"},
+                {"timestamp": feed.started + 1, "duration_us": 5.0, "label": "01FDFF01"},
+            ]}},
+            "/snoop.json": {"modules": {"01": {"panel": 2, "bridge": 1,
+                                               "latency_ms": {"p50": 10.0, "p99": 20.0, "max": 30.0}}},
+                            "unpaired_replies": 0},
+        }
+        responses[f"/history?from={feed.started}"] = [{"address": "0107", "toggles": 4}]
+        feed._get = responses.get
+        feed.poll()
+        feed.poll()
+        snapshot = top.snapshot()
+        assert snapshot["frames"] == 1
+        assert snapshot["hot"] == [(0x0107, "", 4)]
+        assert feed.latency[1] == {"count": 3, "p50_ms": 10.0, "p99_ms": 20.0, "max_ms": 30.0}
+
+    def test_unreachable_bridge(self):
+        feed = BridgeFeed("http://127.0.0.1:1", BusTop(), timeout=0.5)
+        feed.poll()
+        assert feed.latency == {}
+
+
+class TestMain:
+    def test_watches_a_virtual_bus(self):
+        channel = f"bustop_{os.getpid()}_{time.monotonic_ns()}"
+        sim = DobissSimulator(channel=channel)
+        sim.start()
+        wall = can.Bus(interface="virtual", channel=channel)
+        out = io.StringIO()
+        thread = threading.Thread(target=main, args=(
+            ["--interface", "virtual", "--channel", channel, "--interval", "0.5", "--iterations", "2",
+             "--config", CONFIG_PATH],
+            out,
+        ))
+        thread.start()
+        try:
+            time.sleep(0.1)
+            for state in (1, 0, 1):
+                wall.send(build_set_message(1, 7, state))
+                time.sleep(0.02)
+            thread.join(timeout=5)
+        finally:
+            wall.shutdown()
+            sim.stop()
+        assert not thread.is_alive()
+        text = out.getvalue()
+        assert text.count("bus top") == 2
+        assert "SET reply" in text and "SET request 01" in text
+        assert "0107            2" in text
@@ -2,13 +2,22 @@
 
 Run with:  pytest tests/
 """
+import gzip
 import http.client
+import io
+import json
+import multiprocessing
 import os
+import signal
+import socket
 import sys
 import tempfile
 import threading
+import time
 from collections import deque
 
+import can
+import paho.mqtt.client as mqtt
 import pytest
 from unittest.mock import MagicMock, call, patch
 
@@ -19,18 +28,73 @@ from can2mqtt import (
     ARBIT_GET_REPLY,
     ARBIT_GET_REQUEST,
     ARBIT_SET_REPLY,
+    ARBIT_SET_REQUEST,
+    AVAILABILITY_TOPIC,
+    CAN_FILTERS,
+    FRAME_RECORD,
+    CanReceiver,
+    CommandFreshness,
+    DimmerStreamer,
+    RELAY_SPACE,
+    SET_TOGGLE,
+    STATE_UNKNOWN,
+    PAYLOAD_SCHEMAS,
+    SOURCE_CACHE,
+    SOURCE_GET,
+    SOURCE_SET,
+    TX_BACKGROUND,
+    TX_BATCH,
+    TX_INTERACTIVE,
+    REFRESH_TOPIC,
+    ConfigCache,
+    DiscoveryPublisher,
+    RefreshCoordinator,
+    RelayTable,
     RequestHandler,
+    RingBus,
+    LeaderElection,
+    PassiveClient,
+    RuleEngine,
+    SetSnooper,
+    StateBroadcaster,
+    StateHistory,
+    apply_payload_schemas,
+    Supervisor,
+    TimerScheduler,
+    TxScheduler,
+    Watchdog,
+    build_can_filters,
+    wait_for_leadership,
+    build_discovery,
+    build_get_message,
     build_lookup_tables,
+    build_refresh_table,
     build_set_message,
+    compile_rules,
+    dump_traces,
+    dispatch_can_frame,
+    graceful_shutdown,
+    handle_bulk_command,
     handle_can_message,
     handle_mqtt_message,
+    handle_refresh_message,
+    install_shutdown_signals,
     load_config,
+    load_relay_states,
+    make_probe,
     make_on_connect,
     make_on_message,
     parse_address,
+    parse_command,
     parse_state,
+    relay_key,
+    run_can_loop,
+    run_can_side,
+    save_relay_states,
+    sd_notify,
 )
-from http.server import HTTPServer
+from http.server import HTTPServer, ThreadingHTTPServer
+from profiling import SamplingProfiler, TraceRing
 
 # ---------------------------------------------------------------------------
 # Shared fixtures
@@ -42,6 +106,7 @@ SAMPLE_CONFIG = [
     {"name": "Hallway Light", "address": "0200"},
 ]
 SAMPLE_CAN_TO_MQTT, SAMPLE_MQTT_TO_CAN = build_lookup_tables(SAMPLE_CONFIG)
+SAMPLE_RELAYS = RelayTable(SAMPLE_CAN_TO_MQTT)
 
 
 # ---------------------------------------------------------------------------
@@ -114,6 +179,51 @@ class TestParseState:
         assert parse_state(b"\x00\x01") is None
 
 
+# ---------------------------------------------------------------------------
+# parse_command
+# ---------------------------------------------------------------------------
+
+class TestParseCommand:
+    def test_plain_payload(self):
+        assert parse_command(b"ON") == (1, {})
+
+    def test_json_state_only(self):
+        assert parse_command(b'{"state": "OFF"}') == (0, {})
+
+    def test_json_auto_off(self):
+        assert parse_command(b'{"state": "ON", "auto_off": 300}') == (1, {"auto_off": 300.0})
+
+    def test_json_delay(self):
+        assert parse_command(b'{"state": "OFF", "delay": 2.5}') == (0, {"delay": 2.5})
+
+    def test_non_positive_options_ignored(self):
+        assert parse_command(b'{"state": "ON", "delay": 0, "auto_off": -1}') == (1, {})
+
+    def test_json_brightness(self):
+        assert parse_command(b'{"state": "ON", "brightness": 40}') == (1, {"brightness": 40.0})
+
+    def test_infinite_brightness_rejected(self):
+        assert parse_command(b'{"state": "ON", "brightness": Infinity}') == (None, {})
+
+    def test_json_issue_timestamp(self):
+        assert parse_command(b'{"state": "ON", "ts": 1700000000.5}') == (1, {"ts": 1700000000.5})
+
+    def test_invalid_json_returns_none(self):
+        assert parse_command(b"{nope") == (None, {})
+
+    def test_infinite_delay_rejected(self):
+        assert parse_command(b'{"state": "ON", "delay": Infinity}') == (None, {})
+
+    def test_delay_beyond_limit_rejected(self):
+        assert parse_command(b'{"state": "ON", "auto_off": 1e300}') == (None, {})
+
+    def test_nan_option_ignored(self):
+        assert parse_command(b'{"state": "ON", "delay": NaN}') == (1, {})
+
+    def test_invalid_state_returns_none(self):
+        assert parse_command(b'{"state": "TOGGLE"}')[0] is None
+
+
 # ---------------------------------------------------------------------------
 # build_set_message
 # ---------------------------------------------------------------------------
@@ -131,6 +241,10 @@ class TestBuildSetMessage:
         msg = build_set_message(module=1, relay=5, state=1)
         assert list(msg.data) == [1, 5, 1, 0xFF, 0xFF]
 
+    def test_dimmer_level(self):
+        msg = build_set_message(module=1, relay=5, state=1, level=40)
+        assert list(msg.data) == [1, 5, 1, 0xFF, 0xFF, 40, 0xFF, 0xFF]
+
     def test_data_bytes_off(self):
         msg = build_set_message(module=1, relay=5, state=0)
         assert list(msg.data) == [1, 5, 0, 0xFF, 0xFF]
@@ -190,6 +304,36 @@ class TestBuildLookupTables:
             assert can_to_mqtt[key] == state_topic
 
 
+# ---------------------------------------------------------------------------
+# RelayTable
+# ---------------------------------------------------------------------------
+
+class TestRelayTable:
+    def test_relay_key_packs_module_and_relay(self):
+        assert relay_key(1, 7) == 0x0107
+        assert relay_key(0xFF, 0xFF) == RELAY_SPACE - 1
+
+    def test_covers_whole_address_space(self):
+        relays = RelayTable({})
+        assert len(relays.topics) == RELAY_SPACE
+        assert len(relays.states) == RELAY_SPACE
+
+    def test_topics_indexed_by_relay_key(self):
+        relays = RelayTable(SAMPLE_CAN_TO_MQTT)
+        assert relays.topics[0x0100] == "dobiss/light/0100/state"
+        assert relays.topics[0x0107] == "dobiss/light/0107/state"
+        assert relays.topics[0x0200] == "dobiss/light/0200/state"
+
+    def test_unconfigured_addresses_have_no_topic(self):
+        relays = RelayTable(SAMPLE_CAN_TO_MQTT)
+        assert relays.topics[0x0101] is None
+        assert sum(topic is not None for topic in relays.topics) == len(SAMPLE_CONFIG)
+
+    def test_states_start_unknown(self):
+        relays = RelayTable(SAMPLE_CAN_TO_MQTT)
+        assert set(relays.states) == {STATE_UNKNOWN}
+
+
 # ---------------------------------------------------------------------------
 # handle_mqtt_message
 # ---------------------------------------------------------------------------
@@ -280,14 +424,14 @@ class TestHandleCanMessageSetReply:
 
     def test_publishes_on(self):
         msg = _mock_can_message(0x0002FF01, [1, 0, 1, 0, 0])
-        handle_can_message(msg, SAMPLE_CAN_TO_MQTT, self.client)
+        handle_can_message(msg, SAMPLE_RELAYS, self.client)
         self.client.publish.assert_called_once_with(
             "dobiss/light/0100/state", "ON", retain=True
         )
 
     def test_publishes_off(self):
         msg = _mock_can_message(0x0002FF01, [1, 0, 0, 0, 0])
-        handle_can_message(msg, SAMPLE_CAN_TO_MQTT, self.client)
+        handle_can_message(msg, SAMPLE_RELAYS, self.client)
         self.client.publish.assert_called_once_with(
             "dobiss/light/0100/state", "OFF", retain=True
         )
@@ -295,7 +439,7 @@ class TestHandleCanMessageSetReply:
     def test_matches_correct_light_by_module_and_relay(self):
         # module=1, relay=7 → address "0107" = Kitchen Spots
         msg = _mock_can_message(0x0002FF01, [1, 7, 1, 0, 0])
-        handle_can_message(msg, SAMPLE_CAN_TO_MQTT, self.client)
+        handle_can_message(msg, SAMPLE_RELAYS, self.client)
         self.client.publish.assert_called_once_with(
             "dobiss/light/0107/state", "ON", retain=True
         )
@@ -303,13 +447,13 @@ class TestHandleCanMessageSetReply:
     def test_no_publish_for_unmatched_module_relay(self):
         # module=9, relay=9 not in config
         msg = _mock_can_message(0x0002FF01, [9, 9, 1, 0, 0])
-        handle_can_message(msg, SAMPLE_CAN_TO_MQTT, self.client)
+        handle_can_message(msg, SAMPLE_RELAYS, self.client)
         self.client.publish.assert_not_called()
 
     def test_data_byte2_nonzero_but_not_1_is_off(self):
         # Only data[2] == 1 means ON; anything else is OFF
         msg = _mock_can_message(0x0002FF01, [1, 0, 2, 0, 0])
-        handle_can_message(msg, SAMPLE_CAN_TO_MQTT, self.client)
+        handle_can_message(msg, SAMPLE_RELAYS, self.client)
         self.client.publish.assert_called_once_with(
             "dobiss/light/0100/state", "OFF", retain=True
         )
@@ -326,33 +470,33 @@ class TestHandleCanMessageGetRequest:
     def test_adds_module_relay_to_pending_gets(self):
         pending = deque()
         msg = _mock_can_message(ARBIT_GET_REQUEST, [1, 0])
-        handle_can_message(msg, SAMPLE_CAN_TO_MQTT, MagicMock(), pending_gets=pending)
-        assert list(pending) == [(1, 0)]
+        handle_can_message(msg, SAMPLE_RELAYS, MagicMock(), pending_gets=pending)
+        assert list(pending) == [0x0100]
 
     def test_does_not_publish(self):
         client = MagicMock()
         msg = _mock_can_message(ARBIT_GET_REQUEST, [1, 0])
-        handle_can_message(msg, SAMPLE_CAN_TO_MQTT, client, pending_gets=deque())
+        handle_can_message(msg, SAMPLE_RELAYS, client, pending_gets=deque())
         client.publish.assert_not_called()
 
     def test_no_pending_gets_param_does_not_crash(self):
         msg = _mock_can_message(ARBIT_GET_REQUEST, [1, 0])
-        handle_can_message(msg, SAMPLE_CAN_TO_MQTT, MagicMock())  # pending_gets omitted
+        handle_can_message(msg, SAMPLE_RELAYS, MagicMock())  # pending_gets omitted
 
     def test_fifo_ordering_preserved(self):
         pending = deque()
-        handle_can_message(_mock_can_message(ARBIT_GET_REQUEST, [1, 0]), SAMPLE_CAN_TO_MQTT, MagicMock(), pending)
-        handle_can_message(_mock_can_message(ARBIT_GET_REQUEST, [1, 7]), SAMPLE_CAN_TO_MQTT, MagicMock(), pending)
-        assert list(pending) == [(1, 0), (1, 7)]
+        handle_can_message(_mock_can_message(ARBIT_GET_REQUEST, [1, 0]), SAMPLE_RELAYS, MagicMock(), pending)
+        handle_can_message(_mock_can_message(ARBIT_GET_REQUEST, [1, 7]), SAMPLE_RELAYS, MagicMock(), pending)
+        assert list(pending) == [0x0100, 0x0107]
 
     def test_full_get_cycle_publishes_correct_light(self):
         """Snoop request + process reply → only the queried light is updated."""
         pending = deque()
         client = MagicMock()
         # Step 1: snoop the GET request for Kitchen Spots (module=1, relay=7)
-        handle_can_message(_mock_can_message(ARBIT_GET_REQUEST, [1, 7]), SAMPLE_CAN_TO_MQTT, client, pending)
+        handle_can_message(_mock_can_message(ARBIT_GET_REQUEST, [1, 7]), SAMPLE_RELAYS, client, pending)
         # Step 2: process the GET reply (state=ON)
-        handle_can_message(_mock_can_message(ARBIT_GET_REPLY, [1]), SAMPLE_CAN_TO_MQTT, client, pending)
+        handle_can_message(_mock_can_message(ARBIT_GET_REPLY, [1]), SAMPLE_RELAYS, client, pending)
         client.publish.assert_called_once_with("dobiss/light/0107/state", "ON", retain=True)
         assert len(pending) == 0
 
@@ -370,75 +514,297 @@ class TestHandleCanMessageGetReply:
 
     def test_no_pending_gets_param_does_not_publish(self):
         msg = _mock_can_message(ARBIT_GET_REPLY, [1])
-        handle_can_message(msg, SAMPLE_CAN_TO_MQTT, self.client)  # pending_gets omitted
+        handle_can_message(msg, SAMPLE_RELAYS, self.client)  # pending_gets omitted
         self.client.publish.assert_not_called()
 
     def test_empty_pending_gets_does_not_publish(self):
         msg = _mock_can_message(ARBIT_GET_REPLY, [1])
-        handle_can_message(msg, SAMPLE_CAN_TO_MQTT, self.client, pending_gets=deque())
+        handle_can_message(msg, SAMPLE_RELAYS, self.client, pending_gets=deque())
         self.client.publish.assert_not_called()
 
     def test_publishes_on_for_pending_light(self):
-        pending = deque([(1, 0)])
+        pending = deque([0x0100])
         msg = _mock_can_message(ARBIT_GET_REPLY, [1])
-        handle_can_message(msg, SAMPLE_CAN_TO_MQTT, self.client, pending_gets=pending)
+        handle_can_message(msg, SAMPLE_RELAYS, self.client, pending_gets=pending)
         self.client.publish.assert_called_once_with(
             "dobiss/light/0100/state", "ON", retain=True
         )
 
     def test_publishes_off_for_pending_light(self):
-        pending = deque([(1, 0)])
+        pending = deque([0x0100])
         msg = _mock_can_message(ARBIT_GET_REPLY, [0])
-        handle_can_message(msg, SAMPLE_CAN_TO_MQTT, self.client, pending_gets=pending)
+        handle_can_message(msg, SAMPLE_RELAYS, self.client, pending_gets=pending)
         self.client.publish.assert_called_once_with(
             "dobiss/light/0100/state", "OFF", retain=True
         )
 
     def test_publishes_only_to_queried_light_not_all(self):
-        pending = deque([(1, 7)])  # queried Kitchen Spots, not all lights
+        pending = deque([0x0107])  # queried Kitchen Spots, not all lights
         msg = _mock_can_message(ARBIT_GET_REPLY, [1])
-        handle_can_message(msg, SAMPLE_CAN_TO_MQTT, self.client, pending_gets=pending)
+        handle_can_message(msg, SAMPLE_RELAYS, self.client, pending_gets=pending)
         self.client.publish.assert_called_once_with(
             "dobiss/light/0107/state", "ON", retain=True
         )
 
     def test_retain_flag_is_set(self):
-        pending = deque([(1, 0)])
+        pending = deque([0x0100])
         msg = _mock_can_message(ARBIT_GET_REPLY, [1])
-        handle_can_message(msg, SAMPLE_CAN_TO_MQTT, self.client, pending_gets=pending)
+        handle_can_message(msg, SAMPLE_RELAYS, self.client, pending_gets=pending)
         assert self.client.publish.call_args[1]["retain"] is True
 
     def test_pending_request_consumed_after_reply(self):
-        pending = deque([(1, 0)])
+        pending = deque([0x0100])
         msg = _mock_can_message(ARBIT_GET_REPLY, [1])
-        handle_can_message(msg, SAMPLE_CAN_TO_MQTT, self.client, pending_gets=pending)
+        handle_can_message(msg, SAMPLE_RELAYS, self.client, pending_gets=pending)
         assert len(pending) == 0
 
     def test_unconfigured_pending_light_does_not_publish(self):
-        pending = deque([(9, 9)])  # not in config
+        pending = deque([0x0909])  # not in config
         msg = _mock_can_message(ARBIT_GET_REPLY, [1])
-        handle_can_message(msg, SAMPLE_CAN_TO_MQTT, self.client, pending_gets=pending)
+        handle_can_message(msg, SAMPLE_RELAYS, self.client, pending_gets=pending)
         self.client.publish.assert_not_called()
 
     def test_fifo_queue_processes_in_order(self):
         """Two consecutive GET replies must update lights in request order."""
-        pending = deque([(1, 0), (1, 7)])  # 0100 asked first, then 0107
+        pending = deque([0x0100, 0x0107])  # 0100 asked first, then 0107
         client = MagicMock()
-        handle_can_message(_mock_can_message(ARBIT_GET_REPLY, [1]), SAMPLE_CAN_TO_MQTT, client, pending)
-        handle_can_message(_mock_can_message(ARBIT_GET_REPLY, [0]), SAMPLE_CAN_TO_MQTT, client, pending)
+        handle_can_message(_mock_can_message(ARBIT_GET_REPLY, [1]), SAMPLE_RELAYS, client, pending)
+        handle_can_message(_mock_can_message(ARBIT_GET_REPLY, [0]), SAMPLE_RELAYS, client, pending)
         calls = client.publish.call_args_list
         assert calls[0][0] == ("dobiss/light/0100/state", "ON")
         assert calls[1][0] == ("dobiss/light/0107/state", "OFF")
 
 
+class TestHandleCanMessageRelayState:
+    """handle_can_message records every reported state in the RelayTable."""
+
+    def setup_method(self):
+        self.relays = RelayTable(SAMPLE_CAN_TO_MQTT)
+
+    def test_set_reply_records_state(self):
+        handle_can_message(_mock_can_message(ARBIT_SET_REPLY, [1, 7, 1]), self.relays, MagicMock())
+        assert self.relays.states[0x0107] == 1
+
+    def test_get_reply_records_state(self):
+        pending = deque([0x0200])
+        handle_can_message(_mock_can_message(ARBIT_GET_REPLY, [0]), self.relays, MagicMock(), pending)
+        assert self.relays.states[0x0200] == 0
+
+    def test_unconfigured_relay_state_recorded_without_publish(self):
+        client = MagicMock()
+        handle_can_message(_mock_can_message(ARBIT_SET_REPLY, [9, 9, 1]), self.relays, client)
+        assert self.relays.states[0x0909] == 1
+        client.publish.assert_not_called()
+
+
+class TestDispatchCanFrame:
+    def test_accepts_raw_bytes(self):
+        client = MagicMock()
+        dispatch_can_frame(ARBIT_SET_REPLY, b"\x01\x00\x01", RelayTable(SAMPLE_CAN_TO_MQTT), client)
+        client.publish.assert_called_once_with("dobiss/light/0100/state", "ON", retain=True)
+
+    def test_accepts_memoryview(self):
+        client = MagicMock()
+        data = memoryview(bytearray([1, 7, 0, 0xFF, 0xFF]))
+        dispatch_can_frame(ARBIT_SET_REPLY, data, RelayTable(SAMPLE_CAN_TO_MQTT), client)
+        client.publish.assert_called_once_with("dobiss/light/0107/state", "OFF", retain=True)
+
+    def test_unknown_arbitration_id_ignored(self):
+        client = MagicMock()
+        dispatch_can_frame(0xDEADBEEF, b"\x01\x00\x01", RelayTable(SAMPLE_CAN_TO_MQTT), client)
+        client.publish.assert_not_called()
+
+
 class TestHandleCanMessageUnknown:
     def test_unrecognised_arbitration_id_does_not_publish(self):
         client = MagicMock()
         msg = _mock_can_message(0xDEADBEEF, [0, 0, 0, 0, 0])
-        handle_can_message(msg, SAMPLE_CAN_TO_MQTT, client)
+        handle_can_message(msg, SAMPLE_RELAYS, client)
         client.publish.assert_not_called()
 
 
+class TestPayloadSchemas:
+    def setup_method(self):
+        self.config = [
+            {"name": "Plain", "address": "0100"},
+            {"name": "Json", "address": "0107", "schema": "json"},
+            {"name": "Stamped", "address": "0200", "schema": "timestamped"},
+        ]
+        self.relays = RelayTable(build_lookup_tables(self.config)[0])
+        apply_payload_schemas(self.relays, self.config)
+        self.client = MagicMock()
+
+    def _payload(self):
+        return self.client.publish.call_args[0][1]
+
+    def test_plain_encoder_is_none(self):
+        assert PAYLOAD_SCHEMAS["plain"]() is None
+
+    def test_json_encoder(self):
+        encode = PAYLOAD_SCHEMAS["json"]()
+        assert json.loads(encode(1, SOURCE_GET, 12.5)) == {"state": "ON", "source": "get"}
+        assert json.loads(encode(0, SOURCE_CACHE, 0.0)) == {"state": "OFF", "source": "cache"}
+
+    def test_timestamped_encoder(self):
+        encode = PAYLOAD_SCHEMAS["timestamped"]()
+        payload = json.loads(encode(1, SOURCE_SET, 1700000000.25))
+        assert payload == {"state": "ON", "source": "set", "timestamp": 1700000000.25}
+
+    def test_plain_light_keeps_plain_payload(self):
+        assert self.relays.topics[0x0100] == "dobiss/light/0100/state"
+        handle_can_message(_mock_can_message(ARBIT_SET_REPLY, [1, 0, 1]), self.relays, self.client)
+        self.client.publish.assert_called_once_with("dobiss/light/0100/state", "ON", retain=True)
+
+    def test_json_light_set_reply(self):
+        handle_can_message(_mock_can_message(ARBIT_SET_REPLY, [1, 7, 0]), self.relays, self.client)
+        assert self.client.publish.call_args[0][0] == "dobiss/light/0107/state"
+        assert json.loads(self._payload()) == {"state": "OFF", "source": "set"}
+
+    def test_timestamped_light_carries_frame_timestamp(self):
+        msg = _mock_can_message(ARBIT_SET_REPLY, [2, 0, 1])
+        msg.timestamp = 1700000123.5
+        handle_can_message(msg, self.relays, self.client)
+        assert json.loads(self._payload())["timestamp"] == 1700000123.5
+
+    def test_get_reply_source(self):
+        pending = deque()
+        handle_can_message(_mock_can_message(ARBIT_GET_REQUEST, [1, 7]), self.relays, self.client, pending)
+        handle_can_message(_mock_can_message(ARBIT_GET_REPLY, [1]), self.relays, self.client, pending)
+        assert json.loads(self._payload()) == {"state": "ON", "source": "get"}
+
+    def test_cached_refresh_reports_cache_and_frame_time(self):
+        self.relays.states[0x0200] = 1
+        self.relays.updated[0x0200] = time.monotonic() - 2.0
+        refresher = RefreshCoordinator(self.relays, MagicMock(), self.client, max_age=5.0)
+        assert refresher.request(0x0200) == "cached"
+        payload = json.loads(self._payload())
+        assert payload["source"] == "cache"
+        assert time.time() - payload["timestamp"] == pytest.approx(2.0, abs=0.5)
+
+    def test_unconfigured_relay_not_published(self):
+        handle_can_message(_mock_can_message(ARBIT_SET_REPLY, [9, 9, 1]), self.relays, self.client)
+        self.client.publish.assert_not_called()
+
+    def test_schemas_share_one_encoder(self):
+        config = [{"name": "A", "address": "0101", "schema": "json"}, {"name": "B", "address": "0102", "schema": "json"}]
+        relays = RelayTable(build_lookup_tables(config)[0])
+        apply_payload_schemas(relays, config)
+        assert relays.encoded[0x0101][1] is relays.encoded[0x0102][1]
+
+    def test_default_schema_applies_to_lights_without_key(self):
+        config = [{"name": "A", "address": "0101"}]
+        relays = RelayTable(build_lookup_tables(config)[0])
+        apply_payload_schemas(relays, config, default="json")
+        assert relays.topics[0x0101] is None
+        assert relays.encoded[0x0101][0] == "dobiss/light/0101/state"
+
+    def test_unknown_schema_rejected(self):
+        config = [{"name": "A", "address": "0101", "schema": "xml"}]
+        with pytest.raises(ValueError, match="xml"):
+            apply_payload_schemas(RelayTable(build_lookup_tables(config)[0]), config)
+
+
+# ---------------------------------------------------------------------------
+# On-demand refresh (state/get and dobiss/refresh)
+# ---------------------------------------------------------------------------
+
+class TestBuildGetMessage:
+    def test_arbitration_id(self):
+        assert build_get_message(1, 7).arbitration_id == ARBIT_GET_REQUEST
+
+    def test_data_bytes(self):
+        assert list(build_get_message(1, 7).data) == [1, 7]
+
+    def test_is_extended_id(self):
+        assert build_get_message(1, 7).is_extended_id is True
+
+
+class TestBuildRefreshTable:
+    def test_maps_get_topics_to_relay_keys(self):
+        table = build_refresh_table(SAMPLE_CONFIG)
+        assert table == {
+            "dobiss/light/0100/state/get": 0x0100,
+            "dobiss/light/0107/state/get": 0x0107,
+            "dobiss/light/0200/state/get": 0x0200,
+        }
+
+
+class TestRefreshCoordinator:
+    def setup_method(self):
+        self.relays = RelayTable(SAMPLE_CAN_TO_MQTT)
+        self.bus = MagicMock()
+        self.client = MagicMock()
+        self.refresher = RefreshCoordinator(self.relays, self.bus, self.client, max_age=5.0, timeout=1.0)
+
+    def _report(self, key, state):
+        self.relays.states[key] = state
+        self.relays.updated[key] = time.monotonic()
+
+    def test_unknown_state_sends_get(self):
+        assert self.refresher.request(0x0107) == "sent"
+        msg = self.bus.send.call_args[0][0]
+        assert msg.arbitration_id == ARBIT_GET_REQUEST
+        assert list(msg.data) == [1, 7]
+
+    def test_concurrent_requests_share_one_get(self):
+        results = [self.refresher.request(0x0107) for _ in range(5)]
+        assert results == ["sent"] + ["joined"] * 4
+        assert self.bus.send.call_count == 1
+
+    def test_fresh_state_served_from_cache(self):
+        self._report(0x0100, 1)
+        assert self.refresher.request(0x0100) == "cached"
+        self.bus.send.assert_not_called()
+        self.client.publish.assert_called_once_with("dobiss/light/0100/state", "ON", retain=True)
+
+    def test_stale_state_sends_get(self):
+        self.relays.states[0x0100] = 1
+        self.relays.updated[0x0100] = time.monotonic() - 10
+        assert self.refresher.request(0x0100) == "sent"
+
+    def test_reply_ends_the_flight(self):
+        self.refresher.request(0x0100)
+        self._report(0x0100, 0)  # GET reply arrived
+        assert self.refresher.request(0x0100) == "cached"
+        assert self.bus.send.call_count == 1
+
+    def test_unanswered_get_resent_after_timeout(self):
+        self.refresher.request(0x0100)
+        self.refresher.in_flight[0x0100] -= 2.0
+        assert self.refresher.request(0x0100) == "sent"
+        assert self.bus.send.call_count == 2
+
+    def test_relays_are_independent(self):
+        self.refresher.request(0x0100)
+        assert self.refresher.request(0x0107) == "sent"
+
+
+class TestHandleRefreshMessage:
+    def setup_method(self):
+        self.table = build_refresh_table(SAMPLE_CONFIG)
+        self.refresher = MagicMock()
+
+    def test_single_light_get_topic(self):
+        assert handle_refresh_message("dobiss/light/0107/state/get", b"", self.table, self.refresher) is True
+        self.refresher.request.assert_called_once_with(0x0107)
+
+    def test_bulk_refresh_all(self):
+        assert handle_refresh_message(REFRESH_TOPIC, b"", self.table, self.refresher) is True
+        assert [c[0][0] for c in self.refresher.request.call_args_list] == [0x0100, 0x0107, 0x0200]
+
+    def test_bulk_refresh_listed_addresses(self):
+        handle_refresh_message(REFRESH_TOPIC, b"0100, 0200", self.table, self.refresher)
+        assert [c[0][0] for c in self.refresher.request.call_args_list] == [0x0100, 0x0200]
+
+    def test_bulk_refresh_skips_unknown_addresses(self):
+        handle_refresh_message(REFRESH_TOPIC, b"0100,9999", self.table, self.refresher)
+        self.refresher.request.assert_called_once_with(0x0100)
+
+    def test_unknown_topic_returns_false(self):
+        assert handle_refresh_message("dobiss/light/9999/state/get", b"", self.table, self.refresher) is False
+        self.refresher.request.assert_not_called()
+
+
 # ---------------------------------------------------------------------------
 # make_on_connect
 # ---------------------------------------------------------------------------
@@ -466,12 +832,42 @@ class TestMakeOnConnect:
         on_connect(mock_client, None, None, 0)
         mock_client.subscribe.assert_not_called()
 
+    def test_extra_topics_subscribed_after_lights(self):
+        mock_client = MagicMock()
+        on_connect = make_on_connect(SAMPLE_CONFIG, extra_topics=("dobiss/light/+/state/get", REFRESH_TOPIC))
+        on_connect(mock_client, None, None, 0)
+        assert mock_client.subscribe.call_args_list[-2:] == [
+            call("dobiss/light/+/state/get"),
+            call(REFRESH_TOPIC),
+        ]
+
+    def test_availability_published_online(self):
+        mock_client = MagicMock()
+        make_on_connect(SAMPLE_CONFIG, availability_topic=AVAILABILITY_TOPIC)(mock_client, None, None, 0)
+        mock_client.publish.assert_called_once_with(AVAILABILITY_TOPIC, "online", qos=1, retain=True)
+
+    def test_no_availability_by_default(self):
+        mock_client = MagicMock()
+        make_on_connect(SAMPLE_CONFIG)(mock_client, None, None, 0)
+        mock_client.publish.assert_not_called()
+
 
 # ---------------------------------------------------------------------------
 # make_on_message
 # ---------------------------------------------------------------------------
 
 class TestMakeOnMessage:
+    def test_records_trace(self):
+        trace = TraceRing(capacity=4)
+        on_message = make_on_message(SAMPLE_MQTT_TO_CAN, MagicMock(), trace=trace)
+
+        msg = MagicMock()
+        msg.topic = "dobiss/light/0100/state/set"
+        msg.payload = b"ON"
+        on_message(None, None, msg)
+
+        assert [label for _, _, label in trace.entries()] == ["dobiss/light/0100/state/set"]
+
     def test_delegates_to_bus_send_on_valid_message(self):
         mock_bus = MagicMock()
         on_message = make_on_message(SAMPLE_MQTT_TO_CAN, mock_bus)
@@ -505,6 +901,46 @@ class TestMakeOnMessage:
 
         mock_bus.send.assert_not_called()
 
+    def test_get_topic_routed_to_refresher(self):
+        refresher = MagicMock()
+        on_message = make_on_message(SAMPLE_MQTT_TO_CAN, MagicMock(), build_refresh_table(SAMPLE_CONFIG), refresher)
+
+        msg = MagicMock()
+        msg.topic = "dobiss/light/0200/state/get"
+        msg.payload = b""
+        on_message(None, None, msg)
+
+        refresher.request.assert_called_once_with(0x0200)
+
+    def test_set_topic_not_routed_to_refresher(self):
+        refresher = MagicMock()
+        on_message = make_on_message(SAMPLE_MQTT_TO_CAN, MagicMock(), build_refresh_table(SAMPLE_CONFIG), refresher)
+
+        msg = MagicMock()
+        msg.topic = "dobiss/light/0200/state/set"
+        msg.payload = b"ON"
+        on_message(None, None, msg)
+
+        refresher.request.assert_not_called()
+
+    def test_stale_message_dropped_before_handling(self):
+        mock_bus = MagicMock()
+        freshness = CommandFreshness()
+        on_message = make_on_message(SAMPLE_MQTT_TO_CAN, mock_bus, freshness=freshness)
+
+        on_message(None, None, _command(b"ON", retain=True))
+
+        mock_bus.send.assert_not_called()
+        assert freshness.dropped["retained"] == 1
+
+    def test_fresh_message_handled(self):
+        mock_bus = MagicMock()
+        on_message = make_on_message(SAMPLE_MQTT_TO_CAN, mock_bus, freshness=CommandFreshness())
+
+        on_message(None, None, _command(b"ON"))
+
+        mock_bus.send.assert_called_once()
+
 
 # ---------------------------------------------------------------------------
 # load_config
@@ -596,3 +1032,2000 @@ class TestRequestHandler:
         response = conn.getresponse()
         assert response.status == 404
         conn.close()
+
+
+class TestConfigCache:
+    def test_returns_body_and_lights(self, tmp_path):
+        cfg_file = tmp_path / "config.yaml"
+        cfg_file.write_text("- name: Test\n  address: '0107'\n")
+        body, gzipped, etag, lights = ConfigCache(str(cfg_file)).get()
+        assert body == cfg_file.read_bytes()
+        assert gzip.decompress(gzipped) == body
+        assert etag.startswith('"') and etag.endswith('"')
+        assert lights == [({"name": "Test", "address": "0107"}, 0x0107)]
+
+    def test_unchanged_file_not_reread(self, tmp_path):
+        cfg_file = tmp_path / "config.yaml"
+        cfg_file.write_text("- name: Test\n  address: '0107'\n")
+        cache = ConfigCache(str(cfg_file))
+        first = cache.get()
+        with patch("builtins.open", side_effect=AssertionError("config reread")):
+            assert cache.get() is first
+
+    def test_changed_file_reloaded(self, tmp_path):
+        cfg_file = tmp_path / "config.yaml"
+        cfg_file.write_text("- name: Test\n  address: '0107'\n")
+        cache = ConfigCache(str(cfg_file))
+        old_etag = cache.get()[2]
+        cfg_file.write_text("- name: Test\n  address: '0107'\n- name: Other\n  address: '0200'\n")
+        body, _, etag, lights = cache.get()
+        assert etag != old_etag
+        assert b"0200" in body
+        assert len(lights) == 2
+
+
+class TestRequestHandlerCaching:
+    """ETag, gzip, /lights.json and concurrent clients on a ThreadingHTTPServer."""
+
+    @pytest.fixture()
+    def server(self, tmp_path):
+        cfg_file = tmp_path / "config.yaml"
+        cfg_file.write_text("- name: Test\n  address: '0100'\n- name: Other\n  address: '0107'\n")
+        relays = RelayTable(SAMPLE_CAN_TO_MQTT)
+        RequestHandler.config_path = str(cfg_file)
+        RequestHandler.relays = relays
+        httpd = ThreadingHTTPServer(("127.0.0.1", 0), RequestHandler)
+        httpd.daemon_threads = True
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        yield httpd.server_address[1], relays
+        httpd.shutdown()
+        RequestHandler.config_path = "config.yaml"
+        RequestHandler.relays = None
+
+    def _get(self, port, path, headers=None):
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+        conn.request("GET", path, headers=headers or {})
+        response = conn.getresponse()
+        body = response.read()
+        conn.close()
+        return response, body
+
+    def test_etag_header_present(self, server):
+        response, _ = self._get(server[0], "/config.yaml")
+        assert response.getheader("ETag")
+
+    def test_matching_if_none_match_returns_304(self, server):
+        port, _ = server
+        etag = self._get(port, "/config.yaml")[0].getheader("ETag")
+        response, body = self._get(port, "/config.yaml", {"If-None-Match": etag})
+        assert response.status == 304
+        assert body == b""
+
+    def test_stale_if_none_match_returns_200(self, server):
+        response, _ = self._get(server[0], "/config.yaml", {"If-None-Match": '"stale"'})
+        assert response.status == 200
+
+    def test_gzip_when_accepted(self, server):
+        response, body = self._get(server[0], "/config.yaml", {"Accept-Encoding": "gzip, deflate"})
+        assert response.getheader("Content-Encoding") == "gzip"
+        assert b"0107" in gzip.decompress(body)
+
+    def test_identity_when_gzip_not_accepted(self, server):
+        response, body = self._get(server[0], "/config.yaml")
+        assert response.getheader("Content-Encoding") is None
+        assert b"0107" in body
+
+    def test_keep_alive_serves_several_requests(self, server):
+        conn = http.client.HTTPConnection("127.0.0.1", server[0], timeout=5)
+        for _ in range(3):
+            conn.request("GET", "/config.yaml")
+            response = conn.getresponse()
+            assert response.status == 200
+            response.read()
+        conn.close()
+
+    def test_lights_json_merges_states(self, server):
+        port, relays = server
+        relays.states[0x0107] = 1
+        response, body = self._get(port, "/lights.json")
+        assert response.status == 200
+        assert response.getheader("Content-type") == "application/json"
+        assert json.loads(body) == [
+            {"name": "Test", "address": "0100", "state": None},
+            {"name": "Other", "address": "0107", "state": "ON"},
+        ]
+
+    def test_slow_client_does_not_block_others(self, server):
+        port, _ = server
+        slow = socket.create_connection(("127.0.0.1", port))
+        slow.sendall(b"GET /config.yaml HTTP/1.1\r\n")  # never finishes its headers
+        try:
+            response, _ = self._get(port, "/config.yaml")
+            assert response.status == 200
+        finally:
+            slow.close()
+
+
+# ---------------------------------------------------------------------------
+# Bulk control (POST /lights)
+# ---------------------------------------------------------------------------
+
+class _ReplyingBus:
+    """Bus stand-in that answers every SET frame with a SET reply in the RelayTable."""
+
+    def __init__(self, relays, reply_state=None, silent=()):
+        self.relays = relays
+        self.reply_state = reply_state
+        self.silent = silent
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(message)
+        module, relay, state = message.data[:3]
+        if (module, relay) in self.silent:
+            return
+        if self.reply_state is not None:
+            state = self.reply_state
+        handle_can_message(_mock_can_message(ARBIT_SET_REPLY, [module, relay, state]), self.relays, MagicMock())
+
+
+class TestHandleBulkCommand:
+    def setup_method(self):
+        self.relays = RelayTable(SAMPLE_CAN_TO_MQTT)
+
+    def test_all_confirmed(self):
+        bus = _ReplyingBus(self.relays)
+        results = handle_bulk_command(
+            [{"address": "0100", "state": "ON"}, {"address": "0200", "state": "OFF"}],
+            SAMPLE_MQTT_TO_CAN, self.relays, bus, timeout=0.5,
+        )
+        assert [r["result"] for r in results] == ["ok", "ok"]
+        assert [list(m.data[:3]) for m in bus.sent] == [[1, 0, 1], [2, 0, 0]]
+
+    def test_unknown_address_not_sent(self):
+        bus = _ReplyingBus(self.relays)
+        results = handle_bulk_command([{"address": "9999", "state": "ON"}], SAMPLE_MQTT_TO_CAN, self.relays, bus)
+        assert results == [{"address": "9999", "state": "ON", "result": "unknown_address"}]
+        assert bus.sent == []
+
+    def test_invalid_state_not_sent(self):
+        bus = _ReplyingBus(self.relays)
+        results = handle_bulk_command([{"address": "0100", "state": "DIM"}], SAMPLE_MQTT_TO_CAN, self.relays, bus)
+        assert results[0]["result"] == "invalid_state"
+        assert bus.sent == []
+
+    def test_numeric_states_accepted(self):
+        bus = _ReplyingBus(self.relays)
+        results = handle_bulk_command([{"address": "0107", "state": 1}], SAMPLE_MQTT_TO_CAN, self.relays, bus, timeout=0.5)
+        assert results[0]["result"] == "ok"
+
+    def test_missing_reply_times_out(self):
+        bus = _ReplyingBus(self.relays, silent={(1, 7)})
+        results = handle_bulk_command(
+            [{"address": "0100", "state": "ON"}, {"address": "0107", "state": "ON"}],
+            SAMPLE_MQTT_TO_CAN, self.relays, bus, timeout=0.05,
+        )
+        assert [r["result"] for r in results] == ["ok", "timeout"]
+
+    def test_reply_with_other_state_is_mismatch(self):
+        bus = _ReplyingBus(self.relays, reply_state=0)
+        results = handle_bulk_command([{"address": "0100", "state": "ON"}], SAMPLE_MQTT_TO_CAN, self.relays, bus, timeout=0.5)
+        assert results[0]["result"] == "mismatch"
+
+    def test_malformed_entry_reported(self):
+        results = handle_bulk_command(["0100"], SAMPLE_MQTT_TO_CAN, self.relays, _ReplyingBus(self.relays))
+        assert results[0]["result"] == "unknown_address"
+
+
+class TestBulkControlEndpoint:
+    @pytest.fixture()
+    def server(self):
+        relays = RelayTable(SAMPLE_CAN_TO_MQTT)
+        RequestHandler.relays = relays
+        RequestHandler.bus = _ReplyingBus(relays)
+        RequestHandler.mqtt_to_can = SAMPLE_MQTT_TO_CAN
+        httpd = ThreadingHTTPServer(("127.0.0.1", 0), RequestHandler)
+        httpd.daemon_threads = True
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        yield httpd.server_address[1]
+        httpd.shutdown()
+        RequestHandler.relays = RequestHandler.bus = RequestHandler.mqtt_to_can = None
+
+    def _post(self, port, body):
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+        conn.request("POST", "/lights", body=body, headers={"Content-Type": "application/json"})
+        response = conn.getresponse()
+        data = response.read()
+        conn.close()
+        return response, data
+
+    def test_batch_in_one_round_trip(self, server):
+        commands = [{"address": "0100", "state": "ON"}, {"address": "0107", "state": "ON"}, {"address": "0200", "state": "OFF"}]
+        response, body = self._post(server, json.dumps(commands))
+        assert response.status == 200
+        assert [r["result"] for r in json.loads(body)] == ["ok", "ok", "ok"]
+        assert len(RequestHandler.bus.sent) == 3
+
+    def test_malformed_json_returns_400(self, server):
+        response, _ = self._post(server, "{not json")
+        assert response.status == 400
+
+    def test_non_list_returns_400(self, server):
+        response, _ = self._post(server, json.dumps({"address": "0100", "state": "ON"}))
+        assert response.status == 400
+
+    def test_other_path_returns_404(self, server):
+        conn = http.client.HTTPConnection("127.0.0.1", server, timeout=5)
+        conn.request("POST", "/config.yaml", body="[]")
+        assert conn.getresponse().status == 404
+        conn.close()
+
+
+# ---------------------------------------------------------------------------
+# Split-process mode: RingBus and Supervisor
+# ---------------------------------------------------------------------------
+
+def _exit_immediately():
+    pass
+
+
+def _sleep_forever():
+    time.sleep(60)
+
+
+def _ignore_sigterm_until(stop):
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    stop.wait(60)
+
+
+def _ignore_sigterm_forever():
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    time.sleep(60)
+
+
+class TestRingBus:
+    def test_send_pushes_frame_record(self):
+        ring = MagicMock()
+        RingBus(ring).send(build_set_message(1, 7, 1))
+        record, _timestamp, arbitration_id, dlc, data = ring.push.call_args[0]
+        assert arbitration_id == 0x01FC0102
+        assert dlc == 5
+        assert data == bytes([1, 7, 1, 0xFF, 0xFF])
+
+    def test_full_ring_does_not_raise(self):
+        ring = MagicMock()
+        ring.push.return_value = False
+        RingBus(ring).send(build_set_message(1, 7, 1))
+
+
+class TestRunCanSide:
+    def test_commands_queued_at_stop_are_still_sent(self):
+        bus = MagicMock()
+        bus.recv.return_value = None
+        del bus.recv_batch
+        commands = MagicMock()
+        commands.pop.side_effect = [
+            (0.0, 0x01FC0102, 5, bytes([1, relay, 1, 0xFF, 0xFF, 0, 0, 0])) for relay in range(3)
+        ] + [None]
+        stop = threading.Event()
+        stop.set()
+        run_can_side(bus, MagicMock(), commands, stop)
+        assert [message.data[1] for (message,), _ in bus.send.call_args_list] == [0, 1, 2]
+        commands.pop.assert_called_with(FRAME_RECORD)
+
+
+class TestSupervisor:
+    def test_restarts_exited_child(self):
+        supervisor = Supervisor({"short": (_exit_immediately, ()), "long": (_sleep_forever, ())})
+        supervisor.start()
+        try:
+            supervisor.processes["short"].join(timeout=5)
+            assert supervisor.poll() == ["short"]
+            assert supervisor.restarts == {"short": 1, "long": 0}
+        finally:
+            supervisor.stop()
+
+    def test_live_children_are_left_alone(self):
+        supervisor = Supervisor({"long": (_sleep_forever, ())})
+        supervisor.start()
+        try:
+            pid = supervisor.processes["long"].pid
+            assert supervisor.poll() == []
+            assert supervisor.processes["long"].pid == pid
+        finally:
+            supervisor.stop()
+
+    def test_child_with_stop_event_ignores_sigterm_and_stops_on_event(self):
+        stop = multiprocessing.Event()
+        supervisor = Supervisor({"can": (_ignore_sigterm_until, (stop,))}, stops={"can": stop})
+        supervisor.start()
+        process = supervisor.processes["can"]
+        time.sleep(0.2)
+        process.terminate()
+        process.join(timeout=0.2)
+        assert process.is_alive()
+        supervisor.stop(timeout=5)
+        assert process.exitcode == 0
+
+    def test_child_ignoring_its_stop_event_is_killed(self):
+        stop = multiprocessing.Event()
+        supervisor = Supervisor({"can": (_ignore_sigterm_forever, ())}, stops={"can": stop})
+        supervisor.start()
+        time.sleep(0.2)
+        supervisor.stop(timeout=0.2)
+        assert stop.is_set()
+        assert supervisor.processes["can"].exitcode == -signal.SIGKILL
+
+
+# ---------------------------------------------------------------------------
+# StateBroadcaster (/events Server-Sent Events stream)
+# ---------------------------------------------------------------------------
+
+class _ClosingWriter(io.BytesIO):
+    """wfile stand-in that raises once `limit` writes have happened."""
+
+    def __init__(self, limit):
+        super().__init__()
+        self.limit = limit
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        if self.writes > self.limit:
+            raise BrokenPipeError
+        return super().write(data)
+
+
+def _set_reply(relays, module, relay, state):
+    handle_can_message(_mock_can_message(ARBIT_SET_REPLY, [module, relay, state]), relays, MagicMock())
+
+
+def _wait_until(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class TestStateBroadcaster:
+    def setup_method(self):
+        self.relays = RelayTable(SAMPLE_CAN_TO_MQTT)
+        self.broadcaster = StateBroadcaster(self.relays, backlog=4)
+        self.broadcaster.start()
+
+    def teardown_method(self):
+        self.broadcaster.stop()
+
+    def test_registers_as_relay_listener(self):
+        assert self.broadcaster.notify in self.relays.listeners
+
+    def test_listener_called_only_on_transitions(self):
+        seen = []
+        self.relays.listeners.append(lambda key, state: seen.append((key, state)))
+        _set_reply(self.relays, 1, 0, 1)
+        _set_reply(self.relays, 1, 0, 1)
+        _set_reply(self.relays, 1, 0, 0)
+        assert seen == [(0x0100, 1), (0x0100, 0)]
+
+    def test_snapshot_lists_known_configured_states(self):
+        _set_reply(self.relays, 1, 7, 1)
+        _set_reply(self.relays, 9, 9, 1)  # unconfigured
+        snapshot = self.broadcaster.snapshot().decode()
+        assert snapshot.startswith("event: snapshot\n")
+        assert json.loads(snapshot.split("data: ")[1]) == {"0107": "ON"}
+
+    def test_snapshot_includes_encoded_lights(self):
+        apply_payload_schemas(self.relays, [{"name": "Json", "address": "0100", "schema": "json"}])
+        _set_reply(self.relays, 1, 0, 1)
+        _set_reply(self.relays, 1, 7, 0)
+        snapshot = self.broadcaster.snapshot().decode()
+        assert json.loads(snapshot.split("data: ")[1]) == {"0100": "ON", "0107": "OFF"}
+
+    def test_stream_sends_snapshot_then_transitions(self):
+        wfile = _ClosingWriter(limit=2)
+        thread = threading.Thread(target=self.broadcaster.stream, args=(wfile,), kwargs={"keepalive": 0.05})
+        thread.start()
+        assert _wait_until(lambda: self.broadcaster.clients == 1)
+        _set_reply(self.relays, 1, 7, 1)
+        thread.join(timeout=2)
+        body = wfile.getvalue().decode()
+        assert body.startswith("event: snapshot")
+        assert "event: state" in body
+        assert '"address": "0107", "state": "ON"' in body
+
+    def test_idle_stream_sends_keepalive(self):
+        wfile = _ClosingWriter(limit=2)
+        self.broadcaster.stream(wfile, keepalive=0.01)
+        assert wfile.getvalue().endswith(b": keepalive\n\n")
+
+    def test_client_count_restored_after_disconnect(self):
+        self.broadcaster.stream(_ClosingWriter(limit=1), keepalive=0.01)
+        assert self.broadcaster.clients == 0
+
+    def test_lagging_client_is_dropped(self):
+        wfile = _ClosingWriter(limit=100)
+        thread = threading.Thread(target=self.broadcaster.stream, args=(wfile,), kwargs={"keepalive": 0.05})
+        thread.start()
+        assert _wait_until(lambda: self.broadcaster.clients == 1)
+        # Six events land before the client wakes up; the backlog only holds four.
+        with self.broadcaster._cond:
+            for _ in range(6):
+                self.broadcaster._seq += 1
+                self.broadcaster._events.append(b"x")
+        thread.join(timeout=2)
+        assert not thread.is_alive()
+        assert self.broadcaster.dropped_clients == 1
+
+
+class TestEventStreamEndpoint:
+    @pytest.fixture()
+    def server(self):
+        relays = RelayTable(SAMPLE_CAN_TO_MQTT)
+        _set_reply(relays, 1, 0, 1)
+        RequestHandler.events = StateBroadcaster(relays)
+        RequestHandler.events.start()
+        httpd = ThreadingHTTPServer(("127.0.0.1", 0), RequestHandler)
+        httpd.daemon_threads = True
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        yield httpd.server_address[1], relays
+        httpd.shutdown()
+        RequestHandler.events.stop()
+        RequestHandler.events = None
+
+    def test_streams_snapshot_and_changes(self, server):
+        port, relays = server
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+        conn.request("GET", "/events")
+        response = conn.getresponse()
+        assert response.status == 200
+        assert response.getheader("Content-type") == "text/event-stream"
+        assert response.readline() == b"event: snapshot\n"
+        assert json.loads(response.readline()[len(b"data: "):]) == {"0100": "ON"}
+        response.readline()
+
+        _set_reply(relays, 2, 0, 1)
+        assert response.readline().startswith(b"id: ")
+        assert response.readline() == b"event: state\n"
+        assert json.loads(response.readline()[len(b"data: "):])["address"] == "0200"
+        conn.close()
+
+    def test_events_404_without_broadcaster(self):
+        RequestHandler.events = None
+        httpd = HTTPServer(("127.0.0.1", 0), RequestHandler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", httpd.server_address[1], timeout=5)
+            conn.request("GET", "/events")
+            assert conn.getresponse().status == 404
+            conn.close()
+        finally:
+            httpd.shutdown()
+
+
+# ---------------------------------------------------------------------------
+# TimerScheduler
+# ---------------------------------------------------------------------------
+
+TIMER_CONFIG = [
+    {"name": "Entrance Outdoor Light", "address": "0100", "auto_off": 60},
+    {"name": "Kitchen Spots", "address": "0107"},
+]
+
+
+class TestTimerScheduler:
+    def setup_method(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "timers.json")
+        can_to_mqtt, self.mqtt_to_can = build_lookup_tables(TIMER_CONFIG)
+        self.relays = RelayTable(can_to_mqtt)
+        self.bus = MagicMock()
+        self.timers = TimerScheduler(TIMER_CONFIG, self.relays, self.bus, path=self.path)
+
+    def teardown_method(self):
+        self.tmpdir.cleanup()
+
+    def _sent(self):
+        return [(m.data[0], m.data[1], m.data[2]) for (m,), _ in self.bus.send.call_args_list]
+
+    def test_reads_auto_off_from_config(self):
+        assert self.timers.auto_off == {0x0100: 60.0}
+
+    def test_delayed_command_fires_later(self):
+        handle_mqtt_message("dobiss/light/0107/state/set", b'{"state": "ON", "delay": 5}',
+                            self.mqtt_to_can, self.bus, self.timers)
+        self.bus.send.assert_not_called()
+        assert self.timers.run_pending(time.time() + 1) == []
+        assert self.timers.run_pending(time.time() + 6) == [(0x0107, 1)]
+        assert self._sent() == [(1, 7, 1)]
+
+    def test_infinite_delay_is_dropped(self):
+        handle_mqtt_message("dobiss/light/0107/state/set", b'{"state": "ON", "delay": Infinity}',
+                            self.mqtt_to_can, self.bus, self.timers)
+        self.bus.send.assert_not_called()
+        assert 0x0107 not in self.timers.wheel
+
+    def test_manual_on_arms_configured_auto_off(self):
+        handle_mqtt_message("dobiss/light/0100/state/set", b"ON", self.mqtt_to_can, self.bus, self.timers)
+        assert self._sent() == [(1, 0, 1)]
+        assert self.timers.run_pending(time.time() + 61) == [(0x0100, 0)]
+        assert self._sent()[-1] == (1, 0, 0)
+
+    def test_payload_auto_off_overrides_config(self):
+        handle_mqtt_message("dobiss/light/0107/state/set", b'{"state": "ON", "auto_off": 10}',
+                            self.mqtt_to_can, self.bus, self.timers)
+        assert self.timers.run_pending(time.time() + 11) == [(0x0107, 0)]
+
+    def test_manual_command_cancels_pending_timer(self):
+        self.timers.schedule(0x0107, 1, 30)
+        handle_mqtt_message("dobiss/light/0107/state/set", b"OFF", self.mqtt_to_can, self.bus, self.timers)
+        assert 0x0107 not in self.timers.wheel
+        assert self.timers.run_pending(time.time() + 31) == []
+
+    def test_wall_panel_on_arms_auto_off(self):
+        _set_reply(self.relays, 1, 0, 1)
+        assert 0x0100 in self.timers.wheel
+        assert self.timers.wheel.timers[0x0100][1] == 0
+
+    def test_off_transition_cancels_auto_off(self):
+        _set_reply(self.relays, 1, 0, 1)
+        _set_reply(self.relays, 1, 0, 0)
+        assert 0x0100 not in self.timers.wheel
+
+    def test_off_transition_keeps_delayed_on(self):
+        self.timers.schedule(0x0107, 1, 30)
+        _set_reply(self.relays, 1, 7, 1)
+        _set_reply(self.relays, 1, 7, 0)
+        assert self.timers.wheel.timers[0x0107][1] == 1
+
+    def test_save_and_load_round_trip(self):
+        self.timers.schedule(0x0107, 1, 30)
+        self.timers.save()
+        restored = TimerScheduler(TIMER_CONFIG, RelayTable({}), MagicMock(), path=self.path)
+        restored.load()
+        assert restored.wheel.timers[0x0107][1] == 1
+        assert restored.run_pending(time.time() + 31) == [(0x0107, 1)]
+
+    def test_overdue_timer_fires_after_restart(self):
+        with open(self.path, "w") as f:
+            json.dump([{"address": "0107", "state": "OFF", "due": time.time() - 100}], f)
+        bus = MagicMock()
+        restored = TimerScheduler(TIMER_CONFIG, RelayTable({}), bus, path=self.path)
+        restored.start()
+        try:
+            assert _wait_until(lambda: bus.send.called)
+        finally:
+            restored.stop()
+        assert bus.send.call_args[0][0].data[:3] == bytearray([1, 7, 0])
+
+    def test_stop_persists_pending_timers(self):
+        self.timers.start()
+        self.timers.schedule(0x0107, 0, 300)
+        self.timers.stop()
+        with open(self.path) as f:
+            assert json.load(f)[0]["address"] == "0107"
+
+    def test_missing_snapshot_is_ignored(self):
+        self.timers.load()
+        assert len(self.timers.wheel) == 0
+
+
+# ---------------------------------------------------------------------------
+# Rules
+# ---------------------------------------------------------------------------
+
+def _rule_light(address, *rules):
+    return {"name": address, "address": address, "rules": list(rules)}
+
+
+def _rule(when, *actions, **extra):
+    return dict(extra, when=when, then=[{"address": a, "state": s} for a, s in actions])
+
+
+class TestCompileRules:
+    def test_compiles_trigger_and_actions(self):
+        (rule,) = compile_rules([_rule_light("0105", _rule("ON", ("0100", "ON"), ("0101", "OFF")))])
+        assert (rule.trigger_key, rule.trigger_state) == (0x0105, 1)
+        assert rule.actions == [(0x0100, 1), (0x0101, 0)]
+        assert rule.name == "0105#1"
+
+    def test_lights_without_rules_are_ignored(self):
+        assert compile_rules(SAMPLE_CONFIG) == []
+
+    def test_window(self):
+        (rule,) = compile_rules([_rule_light("0105", _rule("ON", ("0100", "ON"), between=["19:00", "07:00"]))])
+        assert rule.window == (19 * 60, 7 * 60)
+        assert rule.active(23 * 60) and rule.active(60)
+        assert not rule.active(12 * 60)
+
+    def test_invalid_trigger_state(self):
+        with pytest.raises(ValueError):
+            compile_rules([_rule_light("0105", _rule("TOGGLE", ("0100", "ON")))])
+
+    def test_rule_without_actions(self):
+        with pytest.raises(ValueError):
+            compile_rules([_rule_light("0105", _rule("ON"))])
+
+    def test_oscillating_rules_rejected(self):
+        config = [
+            _rule_light("0105", _rule("ON", ("0100", "ON")), _rule("OFF", ("0100", "OFF"))),
+            _rule_light("0100", _rule("ON", ("0105", "OFF")), _rule("OFF", ("0105", "ON"))),
+        ]
+        with pytest.raises(ValueError, match="loop"):
+            compile_rules(config)
+
+    def test_chain_that_settles_allowed(self):
+        config = [
+            _rule_light("0105", _rule("ON", ("0100", "ON"))),
+            _rule_light("0100", _rule("ON", ("0105", "OFF"))),
+        ]
+        assert len(compile_rules(config)) == 2
+
+    def test_two_way_link_allowed(self):
+        config = [
+            _rule_light("0105", _rule("ON", ("0100", "ON"))),
+            _rule_light("0100", _rule("ON", ("0105", "ON"))),
+        ]
+        assert len(compile_rules(config)) == 2
+
+
+class TestRuleEngine:
+    def setup_method(self):
+        self.relays = RelayTable(SAMPLE_CAN_TO_MQTT)
+        self.bus = MagicMock()
+
+    def _engine(self, *lights):
+        return RuleEngine(compile_rules(list(lights)), self.relays, self.bus)
+
+    def _sent(self):
+        return [tuple(m.data[:3]) for (m,), _ in self.bus.send.call_args_list]
+
+    def test_transition_sends_action(self):
+        engine = self._engine(_rule_light("0105", _rule("ON", ("0100", "ON"))))
+        _set_reply(self.relays, 1, 5, 1)
+        assert self._sent() == [(1, 0, 1)]
+        assert engine.stats() == [{"name": "0105#1", "hits": 1}]
+
+    def test_other_state_does_not_match(self):
+        engine = self._engine(_rule_light("0105", _rule("ON", ("0100", "ON"))))
+        _set_reply(self.relays, 1, 5, 0)
+        self.bus.send.assert_not_called()
+        assert engine.rules[0].hits == 0
+
+    def test_repeated_reply_is_not_a_transition(self):
+        engine = self._engine(_rule_light("0105", _rule("ON", ("0100", "ON"))))
+        _set_reply(self.relays, 1, 5, 1)
+        _set_reply(self.relays, 1, 5, 1)
+        assert engine.rules[0].hits == 1
+
+    def test_action_skipped_when_target_already_in_state(self):
+        self._engine(_rule_light("0105", _rule("ON", ("0100", "ON"))))
+        _set_reply(self.relays, 1, 0, 1)
+        _set_reply(self.relays, 1, 5, 1)
+        self.bus.send.assert_not_called()
+
+    def test_inactive_window_skips_rule(self):
+        engine = self._engine(_rule_light("0105", _rule("ON", ("0100", "ON"), between=["00:00", "00:00"])))
+        _set_reply(self.relays, 1, 5, 1)
+        self.bus.send.assert_not_called()
+        assert engine.rules[0].hits == 0
+
+    def test_no_rules_registers_no_listener(self):
+        self._engine()
+        assert self.relays.listeners == []
+
+    def test_rules_endpoint_reports_hits(self):
+        engine = self._engine(_rule_light("0105", _rule("ON", ("0100", "ON"), name="porch")))
+        _set_reply(self.relays, 1, 5, 1)
+        RequestHandler.rules = engine
+        server = HTTPServer(("127.0.0.1", 0), RequestHandler)
+        threading.Thread(target=server.handle_request, daemon=True).start()
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=5)
+            conn.request("GET", "/rules.json")
+            response = conn.getresponse()
+            assert response.status == 200
+            assert json.loads(response.read()) == [{"name": "porch", "hits": 1}]
+            conn.close()
+        finally:
+            RequestHandler.rules = None
+            server.server_close()
+
+
+# ---------------------------------------------------------------------------
+# TxScheduler
+# ---------------------------------------------------------------------------
+
+class _RecordingBus:
+    """Bus whose send() records frames and can be held until released."""
+
+    def __init__(self, hold=False):
+        self.sent = []
+        self.release = threading.Event()
+        if not hold:
+            self.release.set()
+
+    def send(self, message):
+        self.release.wait(5)
+        self.sent.append(message.data[1])
+
+
+class TestTxScheduler:
+    def _run(self, tx, count):
+        tx.start()
+        assert _wait_until(lambda: len(tx.bus.sent) == count)
+        tx.stop()
+
+    def test_sends_in_priority_order(self):
+        tx = TxScheduler(_RecordingBus(), frame_time=0)
+        tx.send(build_get_message(1, 1), TX_BACKGROUND)
+        tx.send(build_set_message(1, 2, 1), TX_BATCH)
+        tx.send(build_set_message(1, 3, 1), TX_INTERACTIVE)
+        self._run(tx, 3)
+        assert tx.bus.sent == [3, 2, 1]
+
+    def test_fifo_within_class(self):
+        tx = TxScheduler(_RecordingBus(), frame_time=0)
+        for relay in range(5):
+            tx.lane(TX_BATCH).send(build_set_message(1, relay, 1))
+        self._run(tx, 5)
+        assert tx.bus.sent == [0, 1, 2, 3, 4]
+
+    def test_starving_frame_sent_out_of_turn_but_not_twice_in_a_row(self):
+        tx = TxScheduler(_RecordingBus(), frame_time=0, starvation_limit=0)
+        for relay in (10, 11):
+            tx.send(build_get_message(1, relay), TX_BACKGROUND)
+        for relay in range(4):
+            tx.send(build_set_message(1, relay, 1), TX_INTERACTIVE)
+        self._run(tx, 6)
+        assert tx.bus.sent == [10, 0, 11, 1, 2, 3]
+        assert tx.promoted[TX_BACKGROUND] == 2
+
+    def test_interactive_waits_behind_at_most_one_background_frame(self):
+        bus = _RecordingBus(hold=True)
+        tx = TxScheduler(bus, frame_time=0, starvation_limit=0)
+        tx.start()
+        for relay in range(10, 20):
+            tx.send(build_get_message(1, relay), TX_BACKGROUND)
+        time.sleep(0.05)  # first background frame is now stuck "on the wire"
+        tx.send(build_set_message(1, 1, 1), TX_INTERACTIVE)
+        bus.release.set()
+        assert _wait_until(lambda: len(bus.sent) == 11)
+        tx.stop()
+        assert bus.sent.index(1) <= 2
+
+    def test_wait_histogram_and_stats(self):
+        tx = TxScheduler(_RecordingBus(), frame_time=0)
+        tx.send(build_set_message(1, 1, 1), TX_INTERACTIVE)
+        self._run(tx, 1)
+        stats = tx.stats()
+        assert stats["interactive"]["sent"] == 1
+        assert sum(stats["interactive"]["wait"].values()) == 1
+        assert stats["background"]["sent"] == 0
+
+    def test_stop_drains_queue(self):
+        tx = TxScheduler(_RecordingBus(), frame_time=0)
+        for relay in range(3):
+            tx.send(build_set_message(1, relay, 1), TX_BATCH)
+        tx.start()
+        tx.stop()
+        assert len(tx.bus.sent) == 3
+        assert tx.pending() == [0, 0, 0]
+
+    def test_collapses_queued_sets_per_relay(self):
+        tx = TxScheduler(_RecordingBus(), frame_time=0)
+        seen = []
+        tx.listeners.append(lambda message, priority: seen.append(bytes(message.data[:3])))
+        for state in (1, 0, 1, 0):
+            tx.send(build_set_message(1, 2, state))
+        tx.send(build_set_message(1, 3, 1))
+        tx.send(build_get_message(1, 2))
+        tx.send(build_get_message(1, 2))
+        self._run(tx, 4)
+        assert seen[:2] == [bytes([1, 2, 0]), bytes([1, 3, 1])]
+        assert tx.collapsed[TX_INTERACTIVE] == 3
+        assert tx.stats()["interactive"]["collapsed"] == 3
+
+    def test_newer_set_of_higher_class_moves_to_its_class(self):
+        tx = TxScheduler(_RecordingBus(), frame_time=0)
+        tx.send(build_set_message(1, 2, 1), TX_BATCH)
+        tx.send(build_set_message(1, 2, 0), TX_INTERACTIVE)
+        assert tx.pending() == [1, 0, 0]
+        assert tx.collapsed == [1, 0, 0]
+        assert tx.stats()["batch"]["queued"] == 0
+
+    def test_newer_set_of_lower_class_keeps_its_place(self):
+        tx = TxScheduler(_RecordingBus(), frame_time=0)
+        tx.send(build_set_message(1, 2, 1), TX_INTERACTIVE)
+        tx.send(build_set_message(1, 2, 0), TX_BATCH)
+        assert tx.pending() == [1, 0, 0]
+        assert tx.collapsed == [0, 1, 0]
+
+    def test_interactive_set_does_not_wait_behind_batch_backlog(self):
+        tx = TxScheduler(_RecordingBus(), frame_time=0)
+        seen = []
+        tx.listeners.append(lambda message, priority: seen.append((message.data[1], message.data[2], priority)))
+        for relay in range(200):
+            tx.send(build_set_message(1, relay, 1), TX_BATCH)
+        tx.send(build_set_message(1, 199, 0), TX_INTERACTIVE)
+        self._run(tx, 200)
+        assert seen[0] == (199, 0, TX_INTERACTIVE)
+        assert [relay for relay, _, _ in seen[1:]] == list(range(199))
+        assert tx.pending() == [0, 0, 0]
+
+    def test_set_queued_again_once_sent(self):
+        tx = TxScheduler(_RecordingBus(), frame_time=0)
+        tx.send(build_set_message(1, 2, 1))
+        self._run(tx, 1)
+        tx.send(build_set_message(1, 2, 0))
+        assert tx.pending() == [1, 0, 0]
+        assert tx.collapsed == [0, 0, 0]
+
+    def test_set_that_waited_too_long_is_dropped(self):
+        tx = TxScheduler(_RecordingBus(), frame_time=0, max_age=0.05)
+        tx.send(build_set_message(1, 2, 1), TX_BATCH)
+        tx.send(build_get_message(1, 3), TX_BACKGROUND)
+        time.sleep(0.1)
+        tx.send(build_set_message(1, 4, 1), TX_INTERACTIVE)
+        self._run(tx, 2)
+        assert tx.bus.sent == [4, 3]
+        assert tx.expired == [0, 1, 0]
+        assert tx.stats()["batch"]["expired"] == 1
+
+    def test_fresh_set_replacing_a_stale_one_is_sent(self):
+        tx = TxScheduler(_RecordingBus(), frame_time=0, max_age=0.05)
+        tx.send(build_set_message(1, 2, 1), TX_BATCH)
+        time.sleep(0.1)
+        tx.send(build_set_message(1, 2, 0), TX_BATCH)
+        self._run(tx, 1)
+        assert tx.bus.sent == [2]
+        assert tx.expired == [0, 0, 0]
+
+    def test_collapse_disabled(self):
+        tx = TxScheduler(_RecordingBus(), frame_time=0, collapse=False)
+        for state in (1, 0, 1):
+            tx.send(build_set_message(1, 2, state))
+        self._run(tx, 3)
+        assert tx.collapsed == [0, 0, 0]
+
+    def test_send_error_does_not_stop_sender(self):
+        bus = MagicMock()
+        bus.send.side_effect = [can.CanError("tx buffer full"), None]
+        tx = TxScheduler(bus, frame_time=0)
+        tx.send(build_set_message(1, 1, 1))
+        tx.send(build_set_message(1, 2, 1))
+        tx.start()
+        tx.stop()
+        assert bus.send.call_count == 2
+
+    def test_tx_endpoint_reports_stats(self):
+        RequestHandler.tx = TxScheduler(_RecordingBus(), frame_time=0)
+        server = HTTPServer(("127.0.0.1", 0), RequestHandler)
+        threading.Thread(target=server.handle_request, daemon=True).start()
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=5)
+            conn.request("GET", "/tx.json")
+            response = conn.getresponse()
+            assert response.status == 200
+            assert set(json.loads(response.read())) == {"interactive", "batch", "background"}
+            conn.close()
+        finally:
+            RequestHandler.tx = None
+            server.server_close()
+
+
+# ---------------------------------------------------------------------------
+# StateHistory
+# ---------------------------------------------------------------------------
+
+class TestStateHistory:
+    def setup_method(self):
+        self.relays = RelayTable(SAMPLE_CAN_TO_MQTT)
+        self.history = StateHistory(self.relays, depth=4, max_relays=2)
+
+    def test_records_transitions_from_can(self):
+        _set_reply(self.relays, 1, 0, 1)
+        _set_reply(self.relays, 1, 0, 1)
+        _set_reply(self.relays, 1, 0, 0)
+        assert [state for _, _, state in self.history.events(0x0100)] == [1, 0]
+
+    def test_ring_keeps_latest_depth_events(self):
+        for i in range(6):
+            self.history.record(0x0100, i & 1, timestamp=float(i))
+        assert [index for index, _, _ in self.history.events(0x0100)] == [2, 3, 4, 5]
+        assert [ts for _, ts, _ in self.history.events(0x0100)] == [2.0, 3.0, 4.0, 5.0]
+
+    def test_relays_beyond_capacity_are_dropped(self):
+        for key in (0x0100, 0x0101, 0x0102):
+            self.history.record(key, 1, timestamp=1.0)
+        assert self.history.events(0x0102) == []
+        assert self.history.dropped == 1
+
+    def test_unknown_relay_has_no_events(self):
+        assert self.history.events(0x0200) == []
+
+    def test_query_on_time_and_toggles(self):
+        self.history.record(0x0100, 1, timestamp=10.0)  # first observation
+        self.history.record(0x0100, 0, timestamp=40.0)
+        self.history.record(0x0100, 1, timestamp=50.0)
+        summary = self.history.query(0x0100, 0.0, 100.0, now=60.0)
+        assert summary["on_time"] == pytest.approx(40.0)
+        assert summary["toggles"] == 2
+        assert summary["last_change"] == {"timestamp": 50.0, "state": "ON"}
+        assert summary["events"] == [[10.0, "ON"], [40.0, "OFF"], [50.0, "ON"]]
+
+    def test_query_clips_to_range_using_prior_state(self):
+        self.history.record(0x0100, 1, timestamp=10.0)
+        self.history.record(0x0100, 0, timestamp=40.0)
+        summary = self.history.query(0x0100, 20.0, 30.0, now=100.0)
+        assert summary["on_time"] == pytest.approx(10.0)
+        assert summary["toggles"] == 0
+        assert summary["events"] == []
+        assert summary["last_change"]["timestamp"] == 10.0
+
+    def test_depth_must_be_power_of_two(self):
+        with pytest.raises(ValueError):
+            StateHistory(RelayTable(SAMPLE_CAN_TO_MQTT), depth=6)
+
+
+class TestHistoryEndpoint:
+    def setup_method(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.config_path = os.path.join(self.tmpdir.name, "config.yaml")
+        with open(self.config_path, "w") as f:
+            f.write("- name: Entrance Outdoor Light\n  address: '0100'\n- name: Kitchen Spots\n  address: '0107'\n")
+        self.history = StateHistory(RelayTable(SAMPLE_CAN_TO_MQTT), depth=8, max_relays=4)
+        now = time.time()
+        self.history.record(0x0100, 1, timestamp=now - 30)
+        self.history.record(0x0100, 0, timestamp=now - 10)
+        RequestHandler.history = self.history
+        RequestHandler.config_path = self.config_path
+
+    def teardown_method(self):
+        RequestHandler.history = None
+        RequestHandler.config_path = "config.yaml"
+        self.tmpdir.cleanup()
+
+    def _get(self, path):
+        server = HTTPServer(("127.0.0.1", 0), RequestHandler)
+        threading.Thread(target=server.handle_request, daemon=True).start()
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=5)
+            conn.request("GET", path)
+            response = conn.getresponse()
+            return response.status, json.loads(response.read())
+        finally:
+            server.server_close()
+
+    def test_single_address(self):
+        status, body = self._get("/history?address=0100")
+        assert status == 200
+        (summary,) = body
+        assert summary["address"] == "0100"
+        assert summary["toggles"] == 1
+        assert summary["on_time"] == pytest.approx(20.0, abs=0.5)
+
+    def test_all_configured_lights(self):
+        status, body = self._get("/history")
+        assert status == 200
+        assert [s["address"] for s in body] == ["0100", "0107"]
+        assert body[1]["events"] == []
+
+    def test_range(self):
+        status, body = self._get("/history?address=0100&from=%f" % (time.time() - 5))
+        assert status == 200
+        assert body[0]["events"] == []
+        assert body[0]["on_time"] == 0
+
+    def test_bad_parameters(self):
+        assert self._get("/history?address=zz")[0] == 400
+        assert self._get("/history?from=yesterday")[0] == 400
+        assert self._get("/history?address=10000")[0] == 400
+        assert self._get("/history?address=-0101")[0] == 400
+
+
+# ---------------------------------------------------------------------------
+# Diagnostics endpoints
+# ---------------------------------------------------------------------------
+
+class TestDebugEndpoints:
+    def setup_method(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.traces = {"can": TraceRing(capacity=4), "mqtt": TraceRing(capacity=4)}
+        self.traces["can"].record(ARBIT_SET_REPLY, time.perf_counter())
+        self.profiler = SamplingProfiler(interval=0.001, directory=self.tmpdir.name)
+        RequestHandler.traces = self.traces
+        RequestHandler.profiler = self.profiler
+
+    def teardown_method(self):
+        RequestHandler.traces = None
+        RequestHandler.profiler = None
+        self.profiler.join(5)
+        self.tmpdir.cleanup()
+
+    def _request(self, method, path):
+        server = HTTPServer(("127.0.0.1", 0), RequestHandler)
+        threading.Thread(target=server.handle_request, daemon=True).start()
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=5)
+            conn.request(method, path)
+            response = conn.getresponse()
+            return response.status, json.loads(response.read())
+        finally:
+            server.server_close()
+
+    def test_trace_dump(self):
+        status, body = self._request("GET", "/debug/trace")
+        assert status == 200
+        assert body["can"]["count"] == 1
+        assert body["can"]["entries"][0]["label"] == "0002FF01"
+        assert body["mqtt"]["entries"] == []
+        assert body == json.loads(json.dumps(dump_traces(self.traces)))
+
+    def test_profile_starts_capture(self):
+        status, body = self._request("POST", "/debug/profile?seconds=0.1")
+        assert status == 202
+        self.profiler.join(5)
+        assert os.path.exists(body["path"])
+
+    def test_profile_conflict_while_running(self):
+        self.profiler.start(1)
+        status, _ = self._request("POST", "/debug/profile?seconds=0.1")
+        assert status == 409
+
+    def test_profile_rejects_bad_duration(self):
+        assert self._request("POST", "/debug/profile?seconds=abc")[0] == 400
+        assert self._request("POST", "/debug/profile?seconds=99999")[0] == 400
+
+
+# ---------------------------------------------------------------------------
+# Home Assistant discovery
+# ---------------------------------------------------------------------------
+
+class TestBuildDiscovery:
+    def test_document_per_light(self):
+        documents = build_discovery(SAMPLE_CONFIG, SAMPLE_CAN_TO_MQTT, SAMPLE_MQTT_TO_CAN)
+        assert len(documents) == len(SAMPLE_CONFIG)
+        document = json.loads(documents["homeassistant/light/dobiss_0107/config"])
+        assert document["state_topic"] == "dobiss/light/0107/state"
+        assert document["command_topic"] == "dobiss/light/0107/state/set"
+        assert document["unique_id"] == "dobiss_0107"
+        assert document["name"] == "Kitchen Spots"
+
+    def test_payload_is_stable(self):
+        first = build_discovery(SAMPLE_CONFIG, SAMPLE_CAN_TO_MQTT, SAMPLE_MQTT_TO_CAN)
+        second = build_discovery(list(reversed(SAMPLE_CONFIG)), SAMPLE_CAN_TO_MQTT, SAMPLE_MQTT_TO_CAN)
+        assert first == second
+
+    def test_schema_lights_get_value_template(self):
+        config = [dict(SAMPLE_CONFIG[0], schema="json"), SAMPLE_CONFIG[1]]
+        documents = build_discovery(config, SAMPLE_CAN_TO_MQTT, SAMPLE_MQTT_TO_CAN)
+        assert json.loads(documents["homeassistant/light/dobiss_0100/config"])["state_value_template"] == \
+            "{{ value_json.state }}"
+        assert "state_value_template" not in json.loads(documents["homeassistant/light/dobiss_0107/config"])
+
+    def test_dimmers_get_brightness_topics(self):
+        config = [dict(SAMPLE_CONFIG[0], dimmer=True), SAMPLE_CONFIG[1]]
+        documents = build_discovery(config, SAMPLE_CAN_TO_MQTT, SAMPLE_MQTT_TO_CAN)
+        document = json.loads(documents["homeassistant/light/dobiss_0100/config"])
+        assert document["brightness_command_topic"] == "dobiss/light/0100/brightness/set"
+        assert document["brightness_state_topic"] == "dobiss/light/0100/brightness"
+        assert document["brightness_scale"] == 100
+        assert "brightness_command_topic" not in json.loads(documents["homeassistant/light/dobiss_0107/config"])
+
+
+class TestDiscoveryPublisher:
+    def setup_method(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.config_path = os.path.join(self.tmpdir.name, "config.yaml")
+        self.cache_path = os.path.join(self.tmpdir.name, "discovery.json")
+        self._write_config(SAMPLE_CONFIG)
+
+    def teardown_method(self):
+        self.tmpdir.cleanup()
+
+    def _write_config(self, config):
+        import yaml
+        with open(self.config_path, "w") as f:
+            yaml.safe_dump(config, f)
+        # Make sure ConfigCache sees a new stamp even within one mtime tick.
+        os.utime(self.config_path, ns=(time.time_ns(), time.time_ns() + len(config)))
+
+    def _publisher(self, client):
+        return DiscoveryPublisher(client, self.config_path, self.cache_path, rate=1000, check_interval=0.05)
+
+    def _run_until_idle(self, publisher):
+        publisher.start()
+        assert _wait_until(lambda: publisher._etag is not None and publisher.pending() == 0)
+        time.sleep(0.05)
+        publisher.stop()
+
+    def _published_topics(self, client):
+        return {c.args[0]: c.args[1] for c in client.publish.call_args_list}
+
+    def test_first_run_publishes_everything_retained(self):
+        client = MagicMock()
+        self._run_until_idle(self._publisher(client))
+        assert len(client.publish.call_args_list) == len(SAMPLE_CONFIG)
+        assert all(c.kwargs == {"qos": 1, "retain": True} for c in client.publish.call_args_list)
+        with open(self.cache_path) as f:
+            assert len(json.load(f)) == len(SAMPLE_CONFIG)
+
+    def test_restart_with_same_config_publishes_nothing(self):
+        self._run_until_idle(self._publisher(MagicMock()))
+        client = MagicMock()
+        self._run_until_idle(self._publisher(client))
+        client.publish.assert_not_called()
+
+    def test_only_differences_are_published(self):
+        self._run_until_idle(self._publisher(MagicMock()))
+        changed = [dict(light) for light in SAMPLE_CONFIG[1:]]
+        changed[0]["name"] = "Renamed"
+        changed.append({"name": "New Light", "address": "0300"})
+        self._write_config(changed)
+        client = MagicMock()
+        publisher = self._publisher(client)
+        publisher.check()
+        assert publisher.pending() == 3
+        self._run_until_idle(publisher)
+        published = self._published_topics(client)
+        assert published["homeassistant/light/dobiss_0100/config"] == ""
+        assert json.loads(published["homeassistant/light/dobiss_0107/config"])["name"] == "Renamed"
+        assert "homeassistant/light/dobiss_0300/config" in published
+        assert len(published) == 3
+
+    def test_sync_counts(self):
+        publisher = self._publisher(MagicMock())
+        documents = build_discovery(SAMPLE_CONFIG, SAMPLE_CAN_TO_MQTT, SAMPLE_MQTT_TO_CAN)
+        assert publisher.sync(documents) == (len(SAMPLE_CONFIG), 0, 0)
+
+    def test_config_change_picked_up_while_running(self):
+        client = MagicMock()
+        publisher = self._publisher(client)
+        publisher.start()
+        try:
+            assert _wait_until(lambda: client.publish.call_count == len(SAMPLE_CONFIG))
+            self._write_config(SAMPLE_CONFIG + [{"name": "New Light", "address": "0300"}])
+            assert _wait_until(lambda: client.publish.call_count == len(SAMPLE_CONFIG) + 1)
+        finally:
+            publisher.stop()
+        assert client.publish.call_args.args[0] == "homeassistant/light/dobiss_0300/config"
+
+
+# ---------------------------------------------------------------------------
+# Graceful shutdown
+# ---------------------------------------------------------------------------
+
+class TestRelayStatePersistence:
+    def setup_method(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "states.json")
+
+    def teardown_method(self):
+        self.tmpdir.cleanup()
+
+    def test_round_trip(self):
+        relays = RelayTable(SAMPLE_CAN_TO_MQTT)
+        relays.states[0x0100] = 1
+        relays.states[0x0107] = 0
+        assert save_relay_states(relays, self.path) == 2
+        restored = RelayTable(SAMPLE_CAN_TO_MQTT)
+        assert load_relay_states(restored, self.path) == 2
+        assert restored.states == relays.states
+
+    def test_restored_states_are_stale(self):
+        relays = RelayTable(SAMPLE_CAN_TO_MQTT)
+        relays.states[0x0100] = 1
+        save_relay_states(relays, self.path)
+        restored = RelayTable(SAMPLE_CAN_TO_MQTT)
+        load_relay_states(restored, self.path)
+        assert restored.updated[0x0100] == 0.0
+
+    def test_missing_file(self):
+        assert load_relay_states(RelayTable(SAMPLE_CAN_TO_MQTT), self.path) == 0
+
+    def test_unreadable_file_ignored(self):
+        with open(self.path, "w") as file:
+            file.write("{not json")
+        relays = RelayTable(SAMPLE_CAN_TO_MQTT)
+        assert load_relay_states(relays, self.path) == 0
+        assert relays.states[0x0100] == STATE_UNKNOWN
+
+
+class TestGracefulShutdown:
+    def setup_method(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "states.json")
+        self.relays = RelayTable(SAMPLE_CAN_TO_MQTT)
+        self.client = MagicMock()
+        self.client.want_write.return_value = False
+
+    def teardown_method(self):
+        self.tmpdir.cleanup()
+
+    def _shutdown(self, **kwargs):
+        kwargs.setdefault("state_path", self.path)
+        return graceful_shutdown(self.client, self.relays, **kwargs)
+
+    def test_refuses_new_commands(self):
+        self.client.on_message = MagicMock()
+        self._shutdown()
+        assert self.client.on_message is None
+        assert self.client.on_connect is None
+
+    def test_publishes_offline_and_disconnects(self):
+        self._shutdown()
+        self.client.publish.assert_called_once_with(AVAILABILITY_TOPIC, "offline", qos=1, retain=True)
+        self.client.disconnect.assert_called_once()
+        self.client.loop_stop.assert_called_once()
+
+    def test_demoted_instance_keeps_lights_available(self):
+        report = self._shutdown(availability_topic=None)
+        self.client.publish.assert_not_called()
+        self.client.disconnect.assert_called_once()
+        assert report["mqtt_flushed"]
+
+    def test_drains_tx_queue(self):
+        tx = TxScheduler(_RecordingBus(), frame_time=0)
+        tx.start()
+        for relay in range(5):
+            tx.send(build_set_message(1, relay, 1), TX_BATCH)
+        report = self._shutdown(tx=tx)
+        assert tx.bus.sent == [0, 1, 2, 3, 4]
+        assert report["can_unsent"] == 0
+
+    def test_reports_frames_left_after_deadline(self):
+        bus = _RecordingBus(hold=True)
+        tx = TxScheduler(bus, frame_time=0)
+        tx.start()
+        for relay in range(3):
+            tx.send(build_set_message(1, relay, 1), TX_BATCH)
+        report = self._shutdown(tx=tx, timeout=0.2)
+        bus.release.set()
+        assert report["can_unsent"] == 2  # one is stuck in bus.send()
+
+    def test_waits_for_command_ring_to_empty(self):
+        commands = deque([b"frame"])
+        threading.Timer(0.05, commands.popleft).start()
+        report = self._shutdown(commands=commands, timeout=2.0)
+        assert report["can_unsent"] == 0
+
+    def test_reports_frames_left_in_command_ring(self):
+        report = self._shutdown(commands=deque([b"frame", b"frame"]), timeout=0.1)
+        assert report["can_unsent"] == 2
+
+    def test_waits_for_get_replies(self):
+        pending_gets = deque([0x0100])
+        threading.Timer(0.05, pending_gets.popleft).start()
+        report = self._shutdown(pending_gets=pending_gets, timeout=2.0)
+        assert report["gets_unanswered"] == 0
+
+    def test_reports_unanswered_gets(self):
+        report = self._shutdown(pending_gets=deque([0x0100]), timeout=0.1)
+        assert report["gets_unanswered"] == 1
+
+    def test_persists_states_and_timers(self):
+        self.relays.states[0x0107] = 1
+        timers = MagicMock()
+        report = self._shutdown(timers=timers)
+        timers.stop.assert_called_once()
+        timers.save.assert_called_once()
+        with open(self.path) as file:
+            assert json.load(file) == {"0107": "ON"}
+        assert report["states_saved"] == 1
+
+    def test_unflushed_publishes_reported(self):
+        self.client.want_write.return_value = True
+        assert self._shutdown(timeout=0.1)["mqtt_flushed"] is False
+
+    def test_stops_http_server(self):
+        httpd = MagicMock()
+        self._shutdown(httpd=httpd)
+        httpd.shutdown.assert_called_once()
+        httpd.server_close.assert_called_once()
+
+
+class TestShutdownSignals:
+    def test_sigterm_sets_event(self):
+        previous = signal.getsignal(signal.SIGTERM), signal.getsignal(signal.SIGINT)
+        stop = threading.Event()
+        try:
+            install_shutdown_signals(stop)
+            os.kill(os.getpid(), signal.SIGTERM)
+            assert stop.wait(1)
+        finally:
+            signal.signal(signal.SIGTERM, previous[0])
+            signal.signal(signal.SIGINT, previous[1])
+
+
+class TestRunCanLoop:
+    def test_returns_when_stopped(self):
+        channel = f"loop_{os.getpid()}_{time.monotonic_ns()}"
+        bus = can.Bus(interface="virtual", channel=channel)
+        sender = can.Bus(interface="virtual", channel=channel)
+        client = MagicMock()
+        stop = threading.Event()
+        relays = RelayTable(SAMPLE_CAN_TO_MQTT)
+        thread = threading.Thread(target=run_can_loop, args=(bus, relays, client, deque()), kwargs={"stop": stop})
+        thread.start()
+        try:
+            sender.send(can.Message(arbitration_id=ARBIT_SET_REPLY, data=[1, 0, 1], is_extended_id=True))
+            assert _wait_until(lambda: client.publish.called)
+            stop.set()
+            thread.join(timeout=2)
+            assert not thread.is_alive()
+        finally:
+            stop.set()
+            bus.shutdown()
+            sender.shutdown()
+
+
+# ---------------------------------------------------------------------------
+# Liveness watchdog
+# ---------------------------------------------------------------------------
+
+class TestSdNotify:
+    def test_no_socket_outside_systemd(self):
+        with patch.dict(os.environ, {}, clear=True):
+            assert sd_notify("WATCHDOG=1") is False
+
+    def test_sends_datagram(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "notify")
+            with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as server:
+                server.bind(path)
+                with patch.dict(os.environ, {"NOTIFY_SOCKET": path}):
+                    assert sd_notify("READY=1") is True
+                assert server.recv(64) == b"READY=1"
+
+
+class TestWatchdog:
+    def setup_method(self):
+        self.relays = RelayTable(SAMPLE_CAN_TO_MQTT)
+        self.client = MagicMock()
+        self.client.is_connected.return_value = True
+        self.tx = TxScheduler(_RecordingBus(), frame_time=0)
+        self.notify = MagicMock()
+        self.probe = MagicMock()
+        self.reopen = MagicMock()
+        self.watchdog = Watchdog(self.relays, self.tx, self.client, probe=self.probe, reopen=self.reopen,
+                                 can_timeout=10.0, backoff=1.0, max_backoff=4.0, notify=self.notify)
+        self.start = self.watchdog._since
+
+    def test_live_and_ready_after_start(self):
+        status = self.watchdog.status(self.start + 1)
+        assert status["live"] and status["ready"]
+
+    def test_recent_frame_keeps_can_live(self):
+        self.relays.received = self.start + 20
+        assert self.watchdog.status(self.start + 25)["can"]["ok"]
+
+    def test_stalled_can_not_live(self):
+        status = self.watchdog.status(self.start + 11)
+        assert not status["can"]["ok"]
+        assert not status["live"]
+
+    def test_failed_send_not_live_until_next_success(self):
+        self.tx.last_error = 5.0
+        self.tx.last_sent = 4.0
+        assert not self.watchdog.status(self.start)["send"]["ok"]
+        self.tx.last_sent = 6.0
+        assert self.watchdog.status(self.start)["send"]["ok"]
+
+    def test_disconnected_mqtt_live_but_not_ready(self):
+        self.client.is_connected.return_value = False
+        status = self.watchdog.status(self.start)
+        assert status["live"] and not status["ready"]
+
+    def test_notifies_only_while_live(self):
+        self.watchdog.check(self.start + 1)
+        self.notify.assert_called_once_with("WATCHDOG=1")
+        self.notify.reset_mock()
+        self.watchdog.check(self.start + 11)
+        self.notify.assert_not_called()
+
+    def test_idle_bus_probed_once_per_half_timeout(self):
+        self.watchdog.check(self.start + 4)
+        self.probe.assert_not_called()
+        self.watchdog.check(self.start + 6)
+        self.watchdog.check(self.start + 7)
+        assert self.probe.call_count == 1
+        self.watchdog.check(self.start + 11.5)
+        assert self.probe.call_count == 2
+
+    def test_stall_reopens_bus(self):
+        self.watchdog.check(self.start + 11)
+        self.reopen.assert_called_once()
+        assert self.watchdog.status(self.start + 12)["can"]["reopens"] == 1
+        # The reopened bus gets a full timeout to deliver frames.
+        assert self.watchdog.status(self.start + 15)["can"]["ok"]
+
+    def test_failed_reopen_retried_with_backoff(self):
+        self.reopen.side_effect = OSError("Network is down")
+        times = [self.start + 11 + t * 0.5 for t in range(16)]
+        for now in times:
+            self.watchdog.check(now)
+        # attempts at +0, +1, +3 and +7 seconds: the delay doubles up to max_backoff
+        assert self.reopen.call_count == 4
+        assert self.watchdog.reopen_failures == 4
+
+    def test_reopen_without_frames_backs_off(self):
+        watchdog = Watchdog(self.relays, reopen=self.reopen, can_timeout=10.0, backoff=1.0, max_backoff=60.0,
+                            notify=self.notify)
+        start = watchdog._since
+        reopened = []
+        self.reopen.side_effect = lambda: reopened.append(now - start)
+        for second in range(200):
+            now = start + second
+            watchdog.check(now)
+        # Each reopen succeeds, but no frame follows, so the delay keeps doubling.
+        assert reopened == [11, 22, 33, 44, 55, 71, 103, 163]
+        self.relays.received = start + 200
+        watchdog.check(start + 201)
+        assert watchdog._delay == 1.0
+
+    def test_standby_does_not_reopen_a_quiet_bus(self):
+        watchdog = Watchdog(self.relays, reopen=self.reopen, can_timeout=None, notify=self.notify)
+        for minute in range(10):
+            status = watchdog.check(watchdog._since + 60 * minute)
+        self.reopen.assert_not_called()
+        assert status["live"] and status["can"]["last_frame_age"] == 540
+        assert self.notify.call_count == 10
+
+    def test_no_reopen_without_callback(self):
+        watchdog = Watchdog(self.relays, notify=self.notify)
+        assert not watchdog.check(watchdog._since + 60)["live"]
+
+
+class TestMakeProbe:
+    def test_sends_get_for_first_light(self):
+        bus = MagicMock()
+        make_probe(SAMPLE_CONFIG, bus)()
+        message = bus.send.call_args[0][0]
+        assert message.arbitration_id == ARBIT_GET_REQUEST
+        assert list(message.data) == [1, 0]
+
+    def test_empty_config(self):
+        assert make_probe([], MagicMock()) is None
+
+
+class TestCanReceiver:
+    def test_reopen_switches_bus(self):
+        channel = f"reopen_{os.getpid()}_{time.monotonic_ns()}"
+        opened = []
+
+        def open_bus():
+            opened.append(can.Bus(interface="virtual", channel=channel))
+            return opened[-1]
+
+        client = MagicMock()
+        tx = TxScheduler(_RecordingBus(), frame_time=0)
+        receiver = CanReceiver(open_bus, RelayTable(SAMPLE_CAN_TO_MQTT), client, deque(), tx=tx)
+        sender = can.Bus(interface="virtual", channel=channel)
+        try:
+            receiver.start()
+            receiver.reopen()
+            assert len(opened) == 2 and tx.bus is opened[1]
+            assert receiver.reopens == 1
+            sender.send(can.Message(arbitration_id=ARBIT_SET_REPLY, data=[1, 0, 1], is_extended_id=True))
+            assert _wait_until(lambda: client.publish.called)
+        finally:
+            receiver.shutdown()
+            sender.shutdown()
+        assert receiver.bus is None
+
+    def test_attach_switches_from_passive_client(self):
+        channel = f"attach_{os.getpid()}_{time.monotonic_ns()}"
+        bus = can.Bus(interface="virtual", channel=channel)
+        sender = can.Bus(interface="virtual", channel=channel)
+        relays = RelayTable(SAMPLE_CAN_TO_MQTT)
+        receiver = CanReceiver(None, relays, PassiveClient(), deque(), bus=bus)
+        client = MagicMock()
+        tx = TxScheduler(_RecordingBus(), frame_time=0)
+        try:
+            receiver.start()
+            sender.send(can.Message(arbitration_id=ARBIT_SET_REPLY, data=[1, 0, 1], is_extended_id=True))
+            assert _wait_until(lambda: relays.states[0x0100] == 1)
+            receiver.attach(client, tx)
+            assert tx.bus is bus
+            sender.send(can.Message(arbitration_id=ARBIT_SET_REPLY, data=[1, 7, 1], is_extended_id=True))
+            assert _wait_until(lambda: client.publish.called)
+            client.publish.assert_called_once_with("dobiss/light/0107/state", "ON", retain=True)
+        finally:
+            receiver.shutdown()
+            sender.shutdown()
+
+
+def _get_json(path):
+    """Serve one request with RequestHandler; return (status, decoded JSON body)."""
+    server = HTTPServer(("127.0.0.1", 0), RequestHandler)
+    threading.Thread(target=server.handle_request, daemon=True).start()
+    try:
+        conn = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=5)
+        conn.request("GET", path)
+        response = conn.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        server.server_close()
+
+
+class TestHealthEndpoints:
+    def setup_method(self):
+        self.watchdog = MagicMock()
+        RequestHandler.watchdog = self.watchdog
+
+    def teardown_method(self):
+        RequestHandler.watchdog = None
+
+    def _get(self, path):
+        return _get_json(path)
+
+    def test_healthz_ok(self):
+        self.watchdog.status.return_value = {"live": True, "ready": False}
+        assert self._get("/healthz") == (200, {"live": True, "ready": False})
+
+    def test_readyz_unavailable(self):
+        self.watchdog.status.return_value = {"live": True, "ready": False}
+        assert self._get("/readyz")[0] == 503
+
+    def test_healthz_unavailable_when_stalled(self):
+        self.watchdog.status.return_value = {"live": False, "ready": False}
+        assert self._get("/healthz")[0] == 503
+
+
+# ---------------------------------------------------------------------------
+# Wall-panel SET request snooping
+# ---------------------------------------------------------------------------
+
+def _passes(arbitration_id, filters):
+    return any(arbitration_id & f["can_mask"] == f["can_id"] & f["can_mask"] for f in filters)
+
+
+class TestBuildCanFilters:
+    def test_disabled_keeps_fixed_filters(self):
+        assert build_can_filters(SAMPLE_CONFIG) == CAN_FILTERS
+
+    def test_admits_set_requests_of_configured_modules(self):
+        filters = build_can_filters(SAMPLE_CONFIG, snoop=True)
+        assert _passes(build_set_message(1, 7, 1).arbitration_id, filters)
+        assert _passes(build_set_message(2, 0, 1).arbitration_id, filters)
+
+    def test_mask_keeps_bits_shared_by_all_modules(self):
+        filters = build_can_filters([{"name": "A", "address": "0400"}, {"name": "B", "address": "0500"}], snoop=True)
+        assert _passes(build_set_message(5, 0, 1).arbitration_id, filters)
+        assert not _passes(build_set_message(6, 0, 1).arbitration_id, filters)
+        assert not _passes(build_set_message(0x14, 0, 1).arbitration_id, filters)
+
+    def test_does_not_admit_other_frames(self):
+        snoop_filter = build_can_filters(SAMPLE_CONFIG, snoop=True)[-1:]
+        assert not _passes(ARBIT_GET_REQUEST, snoop_filter)
+        assert not _passes(ARBIT_SET_REPLY, snoop_filter)
+
+
+class TestSetSnooper:
+    def setup_method(self):
+        self.relays = RelayTable(SAMPLE_CAN_TO_MQTT)
+        self.snooper = SetSnooper(SAMPLE_CONFIG, self.relays, echo_window=1.0)
+        self.client = MagicMock()
+
+    def _frame(self, message, timestamp):
+        message.timestamp = timestamp
+        handle_can_message(message, self.relays, self.client)
+
+    def _request(self, module, relay, state, timestamp=100.0):
+        self._frame(build_set_message(module, relay, state), timestamp)
+
+    def _reply(self, module, relay, state, timestamp=100.02):
+        self._frame(can.Message(arbitration_id=ARBIT_SET_REPLY, data=[module, relay, state], is_extended_id=True),
+                    timestamp)
+
+    def test_panel_request_publishes_pending(self):
+        self._request(1, 7, 1)
+        self.client.publish.assert_called_once_with("dobiss/light/0107/state/pending", "ON")
+
+    def test_reply_attributed_to_panel(self):
+        self._request(1, 7, 1)
+        self._reply(1, 7, 1)
+        assert call("dobiss/light/0107/state/source", "panel", retain=True) in self.client.publish.call_args_list
+        assert self.snooper.stats()["modules"]["01"]["panel"] == 1
+
+    def test_own_echo_attributed_to_bridge(self):
+        message = build_set_message(1, 7, 0)
+        self.snooper.on_sent(message, TX_INTERACTIVE)
+        self._request(1, 7, 0)
+        self._reply(1, 7, 0)
+        assert call("dobiss/light/0107/state/pending", "OFF") not in self.client.publish.call_args_list
+        assert call("dobiss/light/0107/state/source", "bridge", retain=True) in self.client.publish.call_args_list
+
+    def test_echo_of_other_state_is_a_panel(self):
+        self.snooper.on_sent(build_set_message(1, 7, 0), TX_INTERACTIVE)
+        self._request(1, 7, 1)
+        self.client.publish.assert_called_once_with("dobiss/light/0107/state/pending", "ON")
+
+    def test_stale_send_is_not_an_echo(self):
+        self.snooper.on_sent(build_set_message(1, 7, 1), TX_INTERACTIVE)
+        key, (state, sent_at) = next(iter(self.snooper._sent.items()))
+        self.snooper._sent[key] = (state, sent_at - 5)
+        self._request(1, 7, 1)
+        self._reply(1, 7, 1)
+        assert self.snooper.stats()["modules"]["01"]["panel"] == 1
+
+    def test_panel_toggle_resolved_against_known_state(self):
+        self._reply(1, 7, 0)
+        self.client.reset_mock()
+        self._request(1, 7, SET_TOGGLE)
+        self.client.publish.assert_called_once_with("dobiss/light/0107/state/pending", "ON")
+        self._reply(1, 7, 1)
+        assert call("dobiss/light/0107/state/source", "panel", retain=True) in self.client.publish.call_args_list
+
+    def test_panel_toggle_of_unknown_state_not_pending(self):
+        self._request(1, 7, SET_TOGGLE)
+        self.client.publish.assert_not_called()
+
+    def test_echo_compares_raw_state_byte(self):
+        self.snooper.on_sent(build_set_message(1, 7, SET_TOGGLE), TX_INTERACTIVE)
+        self._request(1, 7, SET_TOGGLE)
+        self._reply(1, 7, 1)
+        assert self.snooper.stats()["modules"]["01"]["bridge"] == 1
+
+    def test_latency_from_frame_timestamps(self):
+        self._request(2, 0, 1, timestamp=50.0)
+        self._reply(2, 0, 1, timestamp=50.015)
+        latency = self.snooper.stats()["modules"]["02"]["latency_ms"]
+        assert latency["p50"] == pytest.approx(15.0)
+        assert latency["max"] == pytest.approx(15.0)
+
+    def test_reply_without_request_counted(self):
+        self._reply(1, 0, 1)
+        assert self.snooper.stats()["unpaired_replies"] == 1
+
+    def test_unconfigured_module_ignored(self):
+        self._request(9, 1, 1)
+        self.client.publish.assert_not_called()
+        assert "09" not in self.snooper.stats()["modules"]
+
+    def test_ignored_without_snooper(self):
+        relays = RelayTable(SAMPLE_CAN_TO_MQTT)
+        handle_can_message(build_set_message(1, 7, 1), relays, self.client)
+        self.client.publish.assert_not_called()
+
+    def test_reply_still_updates_state(self):
+        self._request(1, 7, 1)
+        self._reply(1, 7, 1)
+        assert self.relays.states[0x0107] == 1
+        assert call("dobiss/light/0107/state", "ON", retain=True) in self.client.publish.call_args_list
+
+
+class TestTxSchedulerListeners:
+    def test_listener_sees_frame_before_it_is_sent(self):
+        bus = _RecordingBus()
+        tx = TxScheduler(bus, frame_time=0)
+        seen = []
+        tx.listeners.append(lambda message, priority: seen.append((len(bus.sent), priority)))
+        tx.start()
+        tx.send(build_set_message(1, 2, 1), TX_BATCH)
+        tx.stop()
+        assert seen == [(0, TX_BATCH)]
+        assert build_set_message(1, 2, 1).arbitration_id == ARBIT_SET_REQUEST | 1 << 8
+
+
+class TestSnoopEndpoint:
+    def teardown_method(self):
+        RequestHandler.snoop = None
+
+    def test_reports_stats(self):
+        snooper = SetSnooper(SAMPLE_CONFIG, RelayTable(SAMPLE_CAN_TO_MQTT))
+        RequestHandler.snoop = snooper
+        assert _get_json("/snoop.json") == (200, snooper.stats())
+
+
+# ---------------------------------------------------------------------------
+# Hot standby leader election
+# ---------------------------------------------------------------------------
+
+def _heartbeat(payload, retain=False):
+    return MagicMock(payload=payload.encode(), retain=retain)
+
+
+class TestLeaderElection:
+    def setup_method(self):
+        self.promoted = MagicMock()
+        self.demoted = MagicMock()
+        self.election = LeaderElection("b", topic="dobiss/leader", interval=1.0, timeout=5.0,
+                                       on_promote=self.promoted, on_demote=self.demoted)
+        self.client = MagicMock()
+        self.client.is_connected.return_value = True
+        self.election.client = self.client
+        self.election.on_connect(self.client, None, None, 0)
+
+    def test_subscribes_on_connect(self):
+        self.client.subscribe.assert_called_once_with("dobiss/leader", qos=1)
+
+    def test_stays_standby_while_heartbeats_arrive(self):
+        self.election.on_message(self.client, None, _heartbeat("a"))
+        self.election.check(time.monotonic() + 4)
+        assert not self.election.active
+        assert self.election.leader == "a"
+        self.promoted.assert_not_called()
+
+    def test_takes_over_after_timeout(self):
+        self.election.on_message(self.client, None, _heartbeat("a"))
+        self.election.check(time.monotonic() + 5)
+        assert self.election.active and self.election.takeovers == 1
+        self.promoted.assert_called_once_with()
+        self.client.publish.assert_called_once_with("dobiss/leader", "b", qos=1, retain=True)
+
+    def test_retained_heartbeat_is_no_sign_of_life(self):
+        self.election._heard -= 10
+        self.election.on_message(self.client, None, _heartbeat("a", retain=True))
+        self.election.check()
+        assert self.election.active
+
+    def test_leader_offline_takes_over_at_once(self):
+        self.election.on_message(self.client, None, _heartbeat("a"))
+        self.election.on_message(self.client, None, _heartbeat("a offline"))
+        self.election.check()
+        assert self.election.active
+
+    def test_other_standby_offline_ignored(self):
+        self.election.on_message(self.client, None, _heartbeat("a"))
+        self.election.on_message(self.client, None, _heartbeat("c offline"))
+        self.election.check()
+        assert not self.election.active
+
+    def test_no_takeover_without_broker(self):
+        self.client.is_connected.return_value = False
+        self.election.check(time.monotonic() + 60)
+        assert not self.election.active
+
+    def test_own_heartbeat_ignored(self):
+        self.election.on_message(self.client, None, _heartbeat("b"))
+        assert self.election.leader is None
+
+    def test_active_sends_heartbeat(self):
+        self.election.promote()
+        self.client.publish.reset_mock()
+        self.election.check()
+        self.client.publish.assert_called_once_with("dobiss/leader", "b", qos=1, retain=True)
+
+    def test_active_republishes_availability(self):
+        self.election.availability_topic = AVAILABILITY_TOPIC
+        self.election.promote()
+        self.client.publish.reset_mock()
+        self.election.check()
+        assert self.client.publish.call_args_list == [
+            call("dobiss/leader", "b", qos=1, retain=True),
+            call(AVAILABILITY_TOPIC, "online", qos=1, retain=True),
+        ]
+
+    def test_lower_id_wins_when_both_active(self):
+        self.election.promote()
+        self.election.on_message(self.client, None, _heartbeat("c"))
+        assert self.election.active
+        self.election.on_message(self.client, None, _heartbeat("a"))
+        assert not self.election.active
+        self.demoted.assert_called_once_with()
+
+    def test_stop_announces_offline_when_active(self):
+        self.election.promote()
+        self.election.stop()
+        self.client.publish.assert_called_with("dobiss/leader", "b offline", qos=1)
+
+    def test_stop_while_disconnected(self):
+        self.election.promote()
+        self.client.publish.return_value.wait_for_publish.side_effect = RuntimeError("not connected")
+        self.election.stop()
+        assert not self.election.active
+
+    def test_stop_silent_when_standby(self):
+        self.election.stop()
+        self.client.publish.assert_not_called()
+
+    def test_wait_for_leadership(self):
+        stop = threading.Event()
+        threading.Timer(0.05, self.election.promote).start()
+        assert wait_for_leadership(self.election, stop, poll=0.01)
+
+    def test_wait_for_leadership_stopped(self):
+        stop = threading.Event()
+        stop.set()
+        assert not wait_for_leadership(self.election, stop, poll=0.01)
+
+
+class TestPassiveClient:
+    def test_handlers_update_states_without_publishing(self):
+        relays = RelayTable(SAMPLE_CAN_TO_MQTT)
+        message = can.Message(arbitration_id=ARBIT_SET_REPLY, data=[1, 7, 1], is_extended_id=True)
+        handle_can_message(message, relays, PassiveClient())
+        assert relays.states[0x0107] == 1
+
+
+# ---------------------------------------------------------------------------
+# Command freshness
+# ---------------------------------------------------------------------------
+
+def _command(payload, retain=False, topic="dobiss/light/0100/state/set"):
+    """A paho message as delivered to on_message."""
+    msg = mqtt.MQTTMessage(topic=topic.encode())
+    msg.payload = payload
+    msg.retain = retain
+    msg.timestamp = time.monotonic()
+    return msg
+
+
+class TestCommandFreshness:
+    def setup_method(self):
+        self.freshness = CommandFreshness(max_age=5.0)
+
+    def test_live_command_accepted(self):
+        assert self.freshness.check(_command(b"ON"))
+
+    def test_retained_command_dropped(self):
+        assert not self.freshness.check(_command(b"ON", retain=True))
+        assert self.freshness.dropped["retained"] == 1
+
+    def test_no_max_age(self):
+        freshness = CommandFreshness(max_age=None)
+        assert freshness.issued_at(time.time() - 600, "t")
+
+    def test_issue_timestamp(self):
+        now = time.time()
+        assert self.freshness.issued_at(now - 1, "t", now=now)
+        assert not self.freshness.issued_at(now - 10, "t", now=now)
+        assert self.freshness.dropped["too_old"] == 1
+
+    def test_handle_mqtt_message_drops_old_issue_timestamp(self):
+        bus = MagicMock()
+        payload = json.dumps({"state": "ON", "ts": time.time() - 60}).encode()
+        assert handle_mqtt_message("dobiss/light/0100/state/set", payload, SAMPLE_MQTT_TO_CAN, bus,
+                                   freshness=self.freshness)
+        bus.send.assert_not_called()
+
+    def test_handle_mqtt_message_sends_recent_issue_timestamp(self):
+        bus = MagicMock()
+        payload = json.dumps({"state": "ON", "ts": time.time()}).encode()
+        handle_mqtt_message("dobiss/light/0100/state/set", payload, SAMPLE_MQTT_TO_CAN, bus, freshness=self.freshness)
+        bus.send.assert_called_once()
+
+    def test_commands_endpoint(self):
+        self.freshness.check(_command(b"ON", retain=True))
+        RequestHandler.freshness = self.freshness
+        try:
+            assert _get_json("/commands.json") == (
+                200, {"max_age": 5.0, "dropped": {"retained": 1, "too_old": 0}})
+        finally:
+            RequestHandler.freshness = None
+
+
+# ---------------------------------------------------------------------------
+# Dimmers
+# ---------------------------------------------------------------------------
+
+DIMMER_CONFIG = [dict(SAMPLE_CONFIG[0], dimmer=True), SAMPLE_CONFIG[1], SAMPLE_CONFIG[2]]
+
+
+class TestDimmerStreamer:
+    def setup_method(self):
+        self.relays = RelayTable(SAMPLE_CAN_TO_MQTT)
+        self.bus = MagicMock()
+        self.client = MagicMock()
+        self.dimmers = DimmerStreamer(DIMMER_CONFIG, self.relays, self.bus, min_interval=0.05, timeout=0.5)
+        self.now = 100.0
+
+    def _levels_sent(self):
+        return [(message.data[2], message.data[5]) for (message,), _ in self.bus.send.call_args_list]
+
+    def test_registers_on_relay_table(self):
+        assert self.relays.dimmers is self.dimmers
+
+    def test_first_level_sent_at_once(self):
+        assert self.dimmers.set(0x0100, 40)
+        assert self.dimmers._send_due(self.now) is None
+        assert self._levels_sent() == [(1, 40)]
+
+    def test_relay_is_not_a_dimmer(self):
+        assert not self.dimmers.set(0x0107, 40)
+
+    def test_newest_level_waits_for_reply(self):
+        self.dimmers.set(0x0100, 10)
+        self.dimmers._send_due(self.now)
+        for level in (20, 30, 40):
+            self.dimmers.set(0x0100, level)
+        assert self.dimmers._send_due(self.now + 0.1) == pytest.approx(0.4)
+        assert self.dimmers.coalesced == 2
+        self.dimmers.on_reply(0x0100, 1, self.client)
+        assert self.dimmers._send_due(self.now + 0.1) is None
+        assert self._levels_sent() == [(1, 10), (1, 40)]
+
+    def test_min_interval_after_reply(self):
+        self.dimmers.set(0x0100, 10)
+        self.dimmers._send_due(self.now)
+        self.dimmers.on_reply(0x0100, 1, self.client)
+        self.dimmers.set(0x0100, 20)
+        assert self.dimmers._send_due(self.now + 0.01) == pytest.approx(0.04)
+        self.dimmers._send_due(self.now + 0.05)
+        assert self._levels_sent() == [(1, 10), (1, 20)]
+
+    def test_unanswered_frame_times_out(self):
+        self.dimmers.set(0x0100, 10)
+        self.dimmers._send_due(self.now)
+        self.dimmers.set(0x0100, 20)
+        self.dimmers._send_due(self.now + 0.5)
+        assert self._levels_sent() == [(1, 10), (1, 20)]
+
+    def test_reply_publishes_confirmed_level(self):
+        self.dimmers.set(0x0100, 40)
+        self.dimmers._send_due(self.now)
+        handle_can_message(can.Message(arbitration_id=ARBIT_SET_REPLY, data=[1, 0, 1], is_extended_id=True),
+                           self.relays, self.client)
+        assert call("dobiss/light/0100/brightness", "40", retain=True) in self.client.publish.call_args_list
+        assert call("dobiss/light/0100/state", "ON", retain=True) in self.client.publish.call_args_list
+        assert self.dimmers.levels == {0x0100: 40}
+
+    def test_level_zero_switches_off(self):
+        self.dimmers.set(0x0100, 0)
+        self.dimmers._send_due(self.now)
+        self.dimmers.on_reply(0x0100, 0, self.client)
+        assert self._levels_sent() == [(0, 0)]
+        self.client.publish.assert_not_called()
+
+    def test_level_clamped(self):
+        self.dimmers.set(0x0100, 250)
+        self.dimmers._send_due(self.now)
+        assert self._levels_sent() == [(1, 100)]
+
+    def test_reply_from_panel_not_published(self):
+        self.dimmers.on_reply(0x0100, 1, self.client)
+        self.client.publish.assert_not_called()
+
+    def test_handle_brightness_topic(self):
+        assert self.dimmers.handle("dobiss/light/0100/brightness/set", b"55")
+        assert self.dimmers._pending == {0x0100: 55}
+        assert self.dimmers.handle("dobiss/light/0100/brightness/set", b"bright")
+        assert not self.dimmers.handle("dobiss/light/0107/brightness/set", b"55")
+
+    def test_non_finite_brightness_ignored(self):
+        for payload in (b"nan", b"inf", b"-Infinity"):
+            assert self.dimmers.handle("dobiss/light/0100/brightness/set", payload)
+        assert self.dimmers._pending == {}
+
+    def test_stop_sends_pending_levels(self):
+        self.dimmers.set(0x0100, 10)
+        self.dimmers._send_due(self.now)
+        self.dimmers.set(0x0100, 70)
+        self.dimmers.stop()
+        assert self._levels_sent() == [(1, 10), (1, 70)]
+
+    def test_thread_delivers_final_level(self):
+        self.dimmers.start()
+        try:
+            for level in range(1, 31):
+                self.dimmers.set(0x0100, level)
+            assert _wait_until(lambda: self._levels_sent()[-1:] == [(1, 30)])
+        finally:
+            self.dimmers.stop()
+        # At most the first level went out before the reply clocking held the rest back.
+        assert len(self._levels_sent()) <= 2
+
+    def test_json_brightness_command_routed(self):
+        handle_mqtt_message("dobiss/light/0100/state/set", b'{"state": "ON", "brightness": 25}',
+                            SAMPLE_MQTT_TO_CAN, self.bus, dimmers=self.dimmers)
+        self.bus.send.assert_not_called()
+        assert self.dimmers._pending == {0x0100: 25}
+
+    def test_json_brightness_for_relay_sends_plain_set(self):
+        handle_mqtt_message("dobiss/light/0107/state/set", b'{"state": "ON", "brightness": 25}',
+                            SAMPLE_MQTT_TO_CAN, self.bus, dimmers=self.dimmers)
+        assert list(self.bus.send.call_args[0][0].data) == [1, 7, 1, 0xFF, 0xFF]
+
+    def test_infinite_json_brightness_dropped(self):
+        on_message = make_on_message(SAMPLE_MQTT_TO_CAN, self.bus, dimmers=self.dimmers)
+        on_message(None, None, _command(b'{"state": "ON", "brightness": Infinity}'))
+        self.bus.send.assert_not_called()
+        assert self.dimmers._pending == {}
+
+    def test_on_message_routes_brightness_topic(self):
+        on_message = make_on_message(SAMPLE_MQTT_TO_CAN, self.bus, dimmers=self.dimmers)
+        on_message(None, None, _command(b"60", topic="dobiss/light/0100/brightness/set"))
+        assert self.dimmers._pending == {0x0100: 60}
@@ -17,6 +17,7 @@ import sys
 import time
 import threading
 from collections import deque
+from types import SimpleNamespace
 from unittest.mock import MagicMock, call
 
 import can
@@ -24,7 +25,29 @@ import pytest
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from can2mqtt import build_lookup_tables, handle_can_message, handle_mqtt_message
+from can2mqtt import (
+    AVAILABILITY_TOPIC,
+    FRAME_RECORD,
+    TX_INTERACTIVE,
+    CanReceiver,
+    DimmerStreamer,
+    LeaderElection,
+    PassiveClient,
+    RefreshCoordinator,
+    RelayTable,
+    RingBus,
+    RuleEngine,
+    SetSnooper,
+    TxScheduler,
+    compile_rules,
+    build_lookup_tables,
+    handle_bulk_command,
+    handle_can_message,
+    handle_mqtt_message,
+    run_can_side,
+    run_mqtt_side,
+)
+from shmring import ShmRing
 from tests.dobiss_simulator import (
     ARBIT_GET_REPLY,
     ARBIT_GET_REQUEST,
@@ -42,6 +65,7 @@ CONFIG = [
     {"name": "Hallway Light",           "address": "0200"},  # module=2, relay=0
 ]
 CONFIG_CAN_TO_MQTT, CONFIG_MQTT_TO_CAN = build_lookup_tables(CONFIG)
+CONFIG_RELAYS = RelayTable(CONFIG_CAN_TO_MQTT)
 
 
 # ---------------------------------------------------------------------------
@@ -148,7 +172,7 @@ class TestSetRoundTrip:
         assert reply is not None, "No CAN reply received from simulator"
         assert reply.arbitration_id == ARBIT_SET_REPLY
 
-        handle_can_message(reply, CONFIG_CAN_TO_MQTT, mqtt_client)
+        handle_can_message(reply, CONFIG_RELAYS, mqtt_client)
         mqtt_client.publish.assert_called_once_with(
             "dobiss/light/0100/state", "ON", retain=True
         )
@@ -160,7 +184,7 @@ class TestSetRoundTrip:
         handle_mqtt_message("dobiss/light/0100/state/set", b"OFF", CONFIG_MQTT_TO_CAN, app_bus)
         reply = recv_one(app_bus, timeout=1.0)
         assert reply is not None
-        handle_can_message(reply, CONFIG_CAN_TO_MQTT, mqtt_client)
+        handle_can_message(reply, CONFIG_RELAYS, mqtt_client)
 
         mqtt_client.publish.assert_called_once_with(
             "dobiss/light/0100/state", "OFF", retain=True
@@ -228,7 +252,7 @@ class TestGetRoundTrip:
 
         reply = recv_one(app_bus, timeout=1.0)
         assert reply is not None
-        handle_can_message(reply, CONFIG_CAN_TO_MQTT, mqtt_client)  # no pending_gets
+        handle_can_message(reply, CONFIG_RELAYS, mqtt_client)  # no pending_gets
 
         mqtt_client.publish.assert_not_called()
 
@@ -267,11 +291,11 @@ class TestGetRoundTripFixed:
             is_extended_id=True,
         ))
 
-    def _process_n(self, app_bus, can_to_mqtt, client, pending_gets, n, timeout=1.0):
+    def _process_n(self, app_bus, relays, client, pending_gets, n, timeout=1.0):
         for _ in range(n):
             msg = recv_one(app_bus, timeout=timeout)
             if msg:
-                handle_can_message(msg, can_to_mqtt, client, pending_gets)
+                handle_can_message(msg, relays, client, pending_gets)
 
     def test_only_queried_light_is_updated(self, sim_bus_and_panel):
         sim, app_bus, panel_bus = sim_bus_and_panel
@@ -282,7 +306,7 @@ class TestGetRoundTripFixed:
         self._panel_get(panel_bus, module=1, relay=0)
 
         # app_bus sees: (1) GET request from panel, (2) GET reply from simulator
-        self._process_n(app_bus, CONFIG_CAN_TO_MQTT, mqtt_client, pending_gets, n=2)
+        self._process_n(app_bus, CONFIG_RELAYS, mqtt_client, pending_gets, n=2)
 
         mqtt_client.publish.assert_called_once_with(
             "dobiss/light/0100/state", "ON", retain=True
@@ -295,7 +319,7 @@ class TestGetRoundTripFixed:
 
         sim.set_state(1, 7, 0)  # 0107 Kitchen Spots = OFF
         self._panel_get(panel_bus, module=1, relay=7)
-        self._process_n(app_bus, CONFIG_CAN_TO_MQTT, mqtt_client, pending_gets, n=2)
+        self._process_n(app_bus, CONFIG_RELAYS, mqtt_client, pending_gets, n=2)
 
         mqtt_client.publish.assert_called_once_with(
             "dobiss/light/0107/state", "OFF", retain=True
@@ -313,7 +337,7 @@ class TestGetRoundTripFixed:
         self._panel_get(panel_bus, module=1, relay=7)
 
         # 2 GET requests + 2 GET replies = 4 messages
-        self._process_n(app_bus, CONFIG_CAN_TO_MQTT, mqtt_client, pending_gets, n=4)
+        self._process_n(app_bus, CONFIG_RELAYS, mqtt_client, pending_gets, n=4)
 
         calls = mqtt_client.publish.call_args_list
         assert len(calls) == 2
@@ -325,7 +349,7 @@ class TestGetRoundTripFixed:
         pending_gets = deque()
 
         self._panel_get(panel_bus, module=1, relay=0)
-        self._process_n(app_bus, CONFIG_CAN_TO_MQTT, MagicMock(), pending_gets, n=2)
+        self._process_n(app_bus, CONFIG_RELAYS, MagicMock(), pending_gets, n=2)
 
         assert len(pending_gets) == 0
 
@@ -386,3 +410,469 @@ class TestSimulator:
         assert sim.get_state(1, 0) == 1
         assert sim.get_state(1, 7) == 0
         assert sim.get_state(2, 0) == 1
+
+
+# ---------------------------------------------------------------------------
+# Split-process mode (CAN side and MQTT side linked by shared-memory rings)
+# ---------------------------------------------------------------------------
+
+@pytest.fixture()
+def split_bridge(sim_and_bus):
+    """Run run_can_side and run_mqtt_side in threads linked by ShmRings.
+
+    Yields (simulator, mqtt_client, ring_bus, frames_ring).
+    """
+    sim, app_bus = sim_and_bus
+    frames = ShmRing.create(FRAME_RECORD.size, 64)
+    commands = ShmRing.create(FRAME_RECORD.size, 64)
+    can_stop, mqtt_stop = threading.Event(), threading.Event()
+    mqtt_client = MagicMock()
+    relays = RelayTable(CONFIG_CAN_TO_MQTT)
+
+    can_side = threading.Thread(target=run_can_side, args=(app_bus, frames, commands, can_stop), daemon=True)
+    mqtt_side = threading.Thread(
+        target=run_mqtt_side, args=(frames, relays, mqtt_client, deque(), mqtt_stop), daemon=True
+    )
+    can_side.start()
+    mqtt_side.start()
+    yield sim, mqtt_client, RingBus(commands), frames, mqtt_stop, mqtt_side
+    can_stop.set()
+    mqtt_stop.set()
+    can_side.join(timeout=2)
+    mqtt_side.join(timeout=2)
+    frames.close()
+    commands.close()
+
+
+def wait_for(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class TestSplitProcessRoundTrip:
+    def test_command_reaches_simulator_through_ring(self, split_bridge):
+        sim, _, ring_bus, *_ = split_bridge
+        handle_mqtt_message("dobiss/light/0107/state/set", b"ON", CONFIG_MQTT_TO_CAN, ring_bus)
+        assert wait_for(lambda: sim.get_state(1, 7) == 1)
+
+    def test_set_reply_published_by_mqtt_side(self, split_bridge):
+        _, mqtt_client, ring_bus, *_ = split_bridge
+        handle_mqtt_message("dobiss/light/0100/state/set", b"ON", CONFIG_MQTT_TO_CAN, ring_bus)
+        assert wait_for(lambda: mqtt_client.publish.called)
+        mqtt_client.publish.assert_called_once_with("dobiss/light/0100/state", "ON", retain=True)
+
+    def test_stalled_mqtt_side_does_not_block_can_side(self, split_bridge):
+        """With the consumer stopped, frames pile up (then drop) but commands still flow."""
+        sim, _, ring_bus, frames, mqtt_stop, mqtt_side = split_bridge
+        mqtt_stop.set()
+        mqtt_side.join(timeout=2)
+        for i in range(80):
+            handle_mqtt_message("dobiss/light/0100/state/set", b"ON" if i % 2 else b"OFF", CONFIG_MQTT_TO_CAN, ring_bus)
+            time.sleep(0.002)
+        handle_mqtt_message("dobiss/light/0200/state/set", b"ON", CONFIG_MQTT_TO_CAN, ring_bus)
+        assert wait_for(lambda: sim.get_state(2, 0) == 1)
+        assert wait_for(lambda: frames.dropped > 0)
+        assert len(frames) == frames.capacity
+
+
+# ---------------------------------------------------------------------------
+# On-demand refresh through the GET correlation path
+# ---------------------------------------------------------------------------
+
+@pytest.fixture()
+def sim_and_echo_bus():
+    """Like sim_and_bus, but the app bus also receives its own frames (as in production)."""
+    channel = _unique_channel()
+    sim = DobissSimulator(channel=channel)
+    sim.start()
+    app_bus = can.Bus(interface="virtual", channel=channel, receive_own_messages=True)
+    yield sim, app_bus
+    app_bus.shutdown()
+    sim.stop()
+
+
+class TestRefreshRoundTrip:
+    def _drain(self, app_bus, relays, client, pending_gets, timeout=0.5):
+        while True:
+            msg = recv_one(app_bus, timeout=timeout)
+            if msg is None:
+                return
+            handle_can_message(msg, relays, client, pending_gets)
+
+    def test_refresh_publishes_state_from_get_reply(self, sim_and_echo_bus):
+        sim, app_bus = sim_and_echo_bus
+        sim.set_state(1, 7, 1)
+        relays = RelayTable(CONFIG_CAN_TO_MQTT)
+        client = MagicMock()
+        refresher = RefreshCoordinator(relays, app_bus, client)
+
+        assert refresher.request(0x0107) == "sent"
+        self._drain(app_bus, relays, client, deque())
+
+        client.publish.assert_called_once_with("dobiss/light/0107/state", "ON", retain=True)
+
+    def test_many_requests_one_frame_then_cache(self, sim_and_echo_bus):
+        sim, app_bus = sim_and_echo_bus
+        relays = RelayTable(CONFIG_CAN_TO_MQTT)
+        client = MagicMock()
+        refresher = RefreshCoordinator(relays, app_bus, client)
+
+        for _ in range(10):
+            refresher.request(0x0200)
+        self._drain(app_bus, relays, client, deque())
+        assert refresher.request(0x0200) == "cached"
+
+        get_requests = [m for m in sim.received_messages if m.arbitration_id == ARBIT_GET_REQUEST]
+        assert len(get_requests) == 1
+
+
+# ---------------------------------------------------------------------------
+# Bulk control against the simulator
+# ---------------------------------------------------------------------------
+
+class TestBulkCommandRoundTrip:
+    def test_batch_confirmed_by_set_replies(self, sim_and_bus):
+        sim, app_bus = sim_and_bus
+        relays = RelayTable(CONFIG_CAN_TO_MQTT)
+        stop = threading.Event()
+
+        def receive():
+            while not stop.is_set():
+                msg = app_bus.recv(timeout=0.05)
+                if msg is not None:
+                    handle_can_message(msg, relays, MagicMock())
+
+        receiver = threading.Thread(target=receive, daemon=True)
+        receiver.start()
+        try:
+            results = handle_bulk_command(
+                [{"address": a, "state": "ON"} for a in ("0100", "0107", "0200")] + [{"address": "9999", "state": "ON"}],
+                CONFIG_MQTT_TO_CAN, relays, app_bus, timeout=2.0,
+            )
+        finally:
+            stop.set()
+            receiver.join(timeout=2)
+
+        assert [r["result"] for r in results] == ["ok", "ok", "ok", "unknown_address"]
+        assert sim.get_state(1, 0) == sim.get_state(1, 7) == sim.get_state(2, 0) == 1
+
+
+# ---------------------------------------------------------------------------
+# Rules reacting to wall-panel switching
+# ---------------------------------------------------------------------------
+
+class TestRulesRoundTrip:
+    def test_panel_switch_triggers_rule_on_simulator(self, sim_bus_and_panel):
+        sim, app_bus, panel_bus = sim_bus_and_panel
+        config = [dict(CONFIG[1], rules=[{"when": "ON", "then": [{"address": "0100", "state": "ON"}]}])]
+        relays = RelayTable(CONFIG_CAN_TO_MQTT)
+        engine = RuleEngine(compile_rules(config), relays, app_bus)
+
+        panel_bus.send(can.Message(
+            arbitration_id=0x01FC0102,
+            data=[1, 7, 1, 0xFF, 0xFF, 0x64, 0xFF, 0xFF],
+            is_extended_id=True,
+        ))
+        deadline = time.monotonic() + 2
+        while sim.get_state(1, 0) != 1 and time.monotonic() < deadline:
+            msg = app_bus.recv(timeout=0.05)
+            if msg is not None:
+                handle_can_message(msg, relays, MagicMock())
+
+        assert sim.get_state(1, 0) == 1
+        assert engine.rules[0].hits == 1
+
+
+# ---------------------------------------------------------------------------
+# Attributing changes to wall panels and to the bridge
+# ---------------------------------------------------------------------------
+
+class TestSetSnoopRoundTrip:
+    def test_panel_and_bridge_commands_told_apart(self):
+        channel = _unique_channel()
+        sim = DobissSimulator(channel=channel)
+        sim.start()
+        app_bus = can.Bus(interface="virtual", channel=channel, receive_own_messages=True)
+        panel_bus = can.Bus(interface="virtual", channel=channel)
+        relays = RelayTable(CONFIG_CAN_TO_MQTT)
+        snooper = SetSnooper(CONFIG, relays)
+        tx = TxScheduler(app_bus, frame_time=0)
+        tx.listeners.append(snooper.on_sent)
+        tx.start()
+        client = MagicMock()
+        try:
+            panel_bus.send(can.Message(arbitration_id=0x01FC0102, data=[1, 7, 1, 0xFF, 0xFF], is_extended_id=True))
+            handle_mqtt_message("dobiss/light/0100/state/set", b"ON", CONFIG_MQTT_TO_CAN, tx)
+            deadline = time.monotonic() + 2
+            while time.monotonic() < deadline:
+                msg = app_bus.recv(timeout=0.05)
+                if msg is not None:
+                    handle_can_message(msg, relays, client)
+                elif sum(snooper.modules[1][origin] for origin in ("panel", "bridge")) == 2:
+                    break
+        finally:
+            tx.stop()
+            panel_bus.shutdown()
+            app_bus.shutdown()
+            sim.stop()
+
+        stats = snooper.stats()["modules"]["01"]
+        assert stats["panel"] == 1
+        assert stats["bridge"] == 1
+        assert stats["latency_ms"]["max"] >= 0
+        published = client.publish.call_args_list
+        assert call("dobiss/light/0107/state/pending", "ON") in published
+        assert call("dobiss/light/0107/state/source", "panel", retain=True) in published
+        assert call("dobiss/light/0100/state/source", "bridge", retain=True) in published
+
+
+# ---------------------------------------------------------------------------
+# Hot standby: two bridge instances on one bus, one MQTT broker
+# ---------------------------------------------------------------------------
+
+class _Broker:
+    """In-process MQTT broker: delivers to subscribers at once and keeps retained messages."""
+
+    def __init__(self):
+        self.clients = []
+        self.retained = {}
+        self.lock = threading.RLock()
+
+    def publish(self, topic, payload, retain):
+        payload = payload.encode() if isinstance(payload, str) else payload
+        with self.lock:
+            if retain:
+                self.retained[topic] = payload
+            for client in list(self.clients):
+                if topic in client.subscriptions:
+                    client.on_message(client, None, SimpleNamespace(topic=topic, payload=payload, retain=False))
+
+
+class _BrokerClient:
+    def __init__(self, broker, election):
+        self.broker = broker
+        self.will = (election.topic, f"{election.instance} offline")
+        self.on_message = election.on_message
+        self.subscriptions = set()
+        self.published = []
+        election.client = self
+        with broker.lock:
+            broker.clients.append(self)
+            election.on_connect(self, None, None, 0)
+
+    def subscribe(self, topic, qos=0):
+        self.subscriptions.add(topic)
+        if topic in self.broker.retained:
+            self.on_message(self, None, SimpleNamespace(topic=topic, payload=self.broker.retained[topic], retain=True))
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        self.published.append((topic, payload))
+        self.broker.publish(topic, payload, retain)
+        return MagicMock()
+
+    def is_connected(self):
+        return self in self.broker.clients
+
+    def crash(self, will=True):
+        """Drop the connection; the broker sends the last will unless the host vanished."""
+        with self.broker.lock:
+            self.broker.clients.remove(self)
+        if will:
+            self.broker.publish(*self.will, retain=False)
+
+
+class _Instance:
+    """One bridge: passive CAN receiver until its election promotes it."""
+
+    def __init__(self, channel, broker, instance, interval=0.05, timeout=0.3):
+        self.bus = can.Bus(interface="virtual", channel=channel, receive_own_messages=True)
+        self.relays = RelayTable(CONFIG_CAN_TO_MQTT)
+        self.pending_gets = deque()
+        self.states = MagicMock()
+        self.tx = None
+        self.receiver = CanReceiver(None, self.relays, PassiveClient(), self.pending_gets, bus=self.bus)
+        self.promoted_at = None
+        self.election = LeaderElection(instance, interval=interval, timeout=timeout, on_promote=self._promote,
+                                       availability_topic=AVAILABILITY_TOPIC)
+        self.mqtt = _BrokerClient(broker, self.election)
+
+    def _promote(self):
+        self.promoted_at = time.monotonic()
+        self.tx = TxScheduler(self.bus, frame_time=0)
+        self.tx.start()
+        self.receiver.attach(self.states, self.tx)
+
+    def start(self):
+        self.receiver.start()
+        self.election.start()
+
+    def crash(self, will=True):
+        self.election._stop = True
+        self.election._wake.set()
+        self.election._thread.join(1)
+        self.mqtt.crash(will)
+        self.receiver.stop()
+        if self.tx is not None:
+            self.tx.stop()
+
+    def shutdown(self):
+        self.election.stop()
+        if self.tx is not None:
+            self.tx.stop()
+        self.receiver.shutdown()
+
+
+@pytest.fixture()
+def two_instances():
+    """Yield (simulator, active, standby); active has taken over before standby starts."""
+    channel = _unique_channel()
+    sim = DobissSimulator(channel=channel)
+    sim.start()
+    broker = _Broker()
+    active = _Instance(channel, broker, "a")
+    active.start()
+    deadline = time.monotonic() + 2
+    while active.promoted_at is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    standby = _Instance(channel, broker, "b")
+    standby.start()
+    yield sim, active, standby
+    standby.shutdown()
+    active.shutdown()
+    sim.stop()
+
+
+def _wait(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class TestHotStandby:
+    def test_standby_mirrors_the_bus_without_acting(self, two_instances):
+        sim, active, standby = two_instances
+        time.sleep(standby.election.timeout * 2)
+        assert active.election.active and not standby.election.active
+        assert standby.election.leader == "a"
+
+        handle_mqtt_message("dobiss/light/0107/state/set", b"ON", CONFIG_MQTT_TO_CAN, active.tx)
+        assert _wait(lambda: standby.relays.states[0x0107] == 1)
+        # A wall panel's GET is correlated with its reply on the standby too.
+        sim.set_state(2, 0, 1)
+        active.bus.send(can.Message(arbitration_id=ARBIT_GET_REQUEST, data=[2, 0], is_extended_id=True))
+        assert _wait(lambda: standby.relays.states[0x0200] == 1)
+        assert standby.tx is None
+        assert ("dobiss/leader", "b") not in standby.mqtt.published
+
+    def test_takes_over_within_timeout_when_heartbeat_stops(self, two_instances):
+        sim, active, standby = two_instances
+        active.crash(will=False)
+        crashed = time.monotonic()
+        assert _wait(lambda: standby.promoted_at is not None)
+        election = standby.election
+        assert standby.promoted_at - crashed <= election.timeout + election.interval + 0.2
+
+        handle_mqtt_message("dobiss/light/0100/state/set", b"ON", CONFIG_MQTT_TO_CAN, standby.tx)
+        assert _wait(lambda: sim.get_state(1, 0) == 1)
+        assert _wait(lambda: call("dobiss/light/0100/state", "ON", retain=True) in standby.states.publish.call_args_list)
+
+    def test_last_will_triggers_immediate_takeover(self, two_instances):
+        sim, active, standby = two_instances
+        active.crash(will=True)
+        crashed = time.monotonic()
+        assert _wait(lambda: standby.promoted_at is not None)
+        assert standby.promoted_at - crashed < standby.election.timeout
+
+    def test_late_last_will_does_not_leave_lights_unavailable(self, two_instances):
+        sim, active, standby = two_instances
+        broker = standby.mqtt.broker
+        active.crash(will=False)
+        assert _wait(lambda: standby.promoted_at is not None)
+        # The dead leader's bridge connection times out long after the takeover.
+        broker.publish(AVAILABILITY_TOPIC, "offline", retain=True)
+        assert _wait(lambda: broker.retained[AVAILABILITY_TOPIC] == b"online",
+                     timeout=standby.election.interval * 5)
+
+    def test_clean_stop_hands_over(self, two_instances):
+        sim, active, standby = two_instances
+        active.election.stop()
+        assert _wait(lambda: standby.promoted_at is not None, timeout=standby.election.timeout)
+
+
+# ---------------------------------------------------------------------------
+# A backlog of commands after a broker hiccup
+# ---------------------------------------------------------------------------
+
+class TestCommandBacklog:
+    def test_backlog_collapses_to_newest_state_per_relay(self, sim_and_bus):
+        sim, app_bus = sim_and_bus
+        tx = TxScheduler(app_bus)
+        for i in range(50):
+            for address in ("0100", "0107"):
+                handle_mqtt_message(f"dobiss/light/{address}/state/set", (b"ON", b"OFF")[i % 2],
+                                    CONFIG_MQTT_TO_CAN, tx.lane(TX_INTERACTIVE))
+        handle_mqtt_message("dobiss/light/0107/state/set", b"ON", CONFIG_MQTT_TO_CAN, tx.lane(TX_INTERACTIVE))
+        tx.start()
+        tx.stop()
+
+        assert sum(tx.sent) == 2
+        assert tx.collapsed[TX_INTERACTIVE] == 99
+        deadline = time.monotonic() + 1
+        while time.monotonic() < deadline and (sim.get_state(1, 0), sim.get_state(1, 7)) != (0, 1):
+            time.sleep(0.01)
+        assert (sim.get_state(1, 0), sim.get_state(1, 7)) == (0, 1)
+
+
+# ---------------------------------------------------------------------------
+# Dimmer brightness from a UI slider
+# ---------------------------------------------------------------------------
+
+class TestDimmerSlider:
+    def test_slider_burst_downsampled_and_final_level_delivered(self, sim_and_echo_bus):
+        sim, app_bus = sim_and_echo_bus
+        config = [dict(CONFIG[0], dimmer=True)] + CONFIG[1:]
+        relays = RelayTable(CONFIG_CAN_TO_MQTT)
+        client = MagicMock()
+        tx = TxScheduler(app_bus)
+        dimmers = DimmerStreamer(config, relays, tx.lane(TX_INTERACTIVE))
+        tx.start()
+        dimmers.start()
+        pending_gets = deque()
+        stop = threading.Event()
+
+        def receive():
+            while not stop.is_set():
+                msg = app_bus.recv(timeout=0.05)
+                if msg is not None:
+                    handle_can_message(msg, relays, client, pending_gets)
+
+        receiver = threading.Thread(target=receive, daemon=True)
+        receiver.start()
+        try:
+            # A slider dragged from 1% to 73% at about 200 updates per second.
+            for level in range(1, 74):
+                dimmers.handle("dobiss/light/0100/brightness/set", str(level).encode())
+                time.sleep(0.005)
+            deadline = time.monotonic() + 2
+            while time.monotonic() < deadline and sim.get_level(1, 0) != 73:
+                time.sleep(0.01)
+            assert sim.get_level(1, 0) == 73
+            assert sim.get_state(1, 0) == 1
+            published = call("dobiss/light/0100/brightness", "73", retain=True)
+            while time.monotonic() < deadline and published not in client.publish.call_args_list:
+                time.sleep(0.01)
+            assert published in client.publish.call_args_list
+        finally:
+            stop.set()
+            receiver.join(1)
+            dimmers.stop()
+            tx.stop()
+        assert dimmers.sent < 73
+        assert dimmers.sent + dimmers.coalesced == 73
@@ -0,0 +1,76 @@
+"""Regression gates for the protocol hot functions (tests/microbench.py).
+
+Each case is timed against tests/microbench_baseline.json; a case that looks
+slower is measured once more before it fails, so a burst of background load
+does not fail the suite. After an intended change, record a new baseline with
+python3 -m tests.microbench --update.
+
+Timings are only meaningful on a quiet machine and allocations depend on the
+interpreter, so the gates run only with MICROBENCH=1 set and on the Python
+version and architecture the baseline was recorded on.
+"""
+import os
+import platform
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tests.microbench import build_cases, compare, environment_mismatch, load_baseline, measure, missing
+
+CASES = build_cases()
+BASELINE = load_baseline()
+MISMATCH = environment_mismatch(BASELINE)
+
+
+def _result(ns, reference_ns=1000.0, alloc_bytes=0):
+    return {"ns": ns, "reference_ns": reference_ns, "alloc_bytes": alloc_bytes}
+
+
+class TestCompare:
+    def setup_method(self):
+        self.baseline = {"results": {"f": _result(100.0, alloc_bytes=32)}}
+
+    def test_within_tolerance_passes(self):
+        assert compare({"results": {"f": _result(120.0, alloc_bytes=32)}}, self.baseline, tolerance=0.25) == []
+
+    def test_slowdown_fails(self):
+        failures = compare({"results": {"f": _result(130.0, alloc_bytes=32)}}, self.baseline, tolerance=0.25)
+        assert len(failures) == 1 and failures[0].startswith("f: 130 ns/op")
+
+    def test_slower_machine_scales_the_baseline(self):
+        measured = {"results": {"f": _result(190.0, reference_ns=2000.0, alloc_bytes=32)}}
+        assert compare(measured, self.baseline, tolerance=0.0) == []
+
+    def test_extra_allocation_fails(self):
+        failures = compare({"results": {"f": _result(100.0, alloc_bytes=200)}}, self.baseline, alloc_slack=64)
+        assert failures == ["f: 200 bytes/op, baseline 32"]
+
+    def test_unknown_case_ignored(self):
+        assert compare({"results": {"g": _result(1e9)}}, self.baseline) == []
+
+
+class TestBaseline:
+    def test_every_case_has_a_baseline(self):
+        assert missing(CASES, BASELINE) == []
+
+
+class TestEnvironmentMismatch:
+    def test_same_environment(self):
+        assert environment_mismatch({"python": platform.python_version(), "machine": platform.machine()}) is None
+
+    def test_other_python(self):
+        mismatch = environment_mismatch({"python": "2.7.18", "machine": platform.machine()})
+        assert mismatch.startswith("baseline recorded on python 2.7.18")
+
+
+@pytest.mark.skipif(os.environ.get("MICROBENCH") != "1", reason="timing gates run with MICROBENCH=1")
+@pytest.mark.skipif(MISMATCH is not None, reason=str(MISMATCH))
+@pytest.mark.parametrize("name", sorted(CASES))
+def test_no_regression(name):
+    cases = {name: CASES[name]}
+    failures = compare(measure(cases), BASELINE)
+    if failures:
+        failures = compare(measure(cases, runs=2), BASELINE)
+    assert failures == []
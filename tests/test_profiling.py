@@ -0,0 +1,84 @@
+"""Tests for profiling.py (sampling profiler and trace rings)."""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from profiling import SamplingProfiler, TraceRing
+
+
+def _busy_worker(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+class TestTraceRing:
+    def test_records_duration_and_label(self):
+        ring = TraceRing(capacity=4)
+        started = time.perf_counter()
+        ring.record(0x0002FF01, started)
+        ((timestamp, duration, label),) = ring.entries()
+        assert label == 0x0002FF01
+        assert 0 <= duration < 1
+        assert abs(timestamp - time.time()) < 5
+
+    def test_keeps_last_capacity_entries(self):
+        ring = TraceRing(capacity=4)
+        for i in range(6):
+            ring.record("topic/%d" % i, time.perf_counter())
+        assert [label for _, _, label in ring.entries()] == ["topic/2", "topic/3", "topic/4", "topic/5"]
+        assert ring.count == 6
+
+    def test_summary(self):
+        ring = TraceRing(capacity=8)
+        assert ring.summary()["p99_us"] is None
+        for _ in range(5):
+            ring.record(1, time.perf_counter())
+        summary = ring.summary()
+        assert summary["count"] == summary["retained"] == 5
+        assert summary["p50_us"] <= summary["p99_us"] <= summary["max_us"]
+
+    def test_dump_formats_labels(self):
+        ring = TraceRing(capacity=4)
+        ring.record(0x0002FF01, time.perf_counter())
+        ring.record("dobiss/light/0100/state/set", time.perf_counter())
+        labels = [entry["label"] for entry in ring.dump()["entries"]]
+        assert labels == ["0002FF01", "dobiss/light/0100/state/set"]
+
+    def test_capacity_must_be_power_of_two(self):
+        with pytest.raises(ValueError):
+            TraceRing(capacity=100)
+
+
+class TestSamplingProfiler:
+    def test_sample_sees_other_threads(self):
+        stop = threading.Event()
+        worker = threading.Thread(target=_busy_worker, args=(stop,), name="busy")
+        worker.start()
+        try:
+            stacks = SamplingProfiler(interval=0.001).sample(0.2)
+        finally:
+            stop.set()
+            worker.join()
+        busy = [stack for stack in stacks if stack.startswith("busy;")]
+        assert busy
+        assert any("_busy_worker" in stack for stack in busy)
+        assert not any(stack.startswith("profiler;") for stack in stacks)
+
+    def test_start_writes_collapsed_stacks(self):
+        with tempfile.TemporaryDirectory() as directory:
+            profiler = SamplingProfiler(interval=0.001, directory=directory)
+            path = profiler.start(0.1)
+            assert profiler.start(0.1) is None  # one capture at a time
+            profiler.join(5)
+            assert profiler.last_path == path
+            with open(path) as file:
+                lines = file.read().splitlines()
+            assert lines
+            stack, count = lines[0].rsplit(" ", 1)
+            assert int(count) > 0 and ";" in stack
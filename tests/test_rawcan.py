@@ -0,0 +1,174 @@
+"""Tests for rawcan.py (raw SocketCAN backend).
+
+No vcan device is needed: frames are decoded from in-memory buffers and
+received through a SOCK_SEQPACKET socketpair standing in for the AF_CAN
+socket.
+"""
+import os
+import socket
+import sys
+from collections import deque
+from unittest.mock import MagicMock
+
+import can
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from can2mqtt import (
+    ARBIT_GET_REPLY,
+    ARBIT_GET_REQUEST,
+    ARBIT_SET_REPLY,
+    RelayTable,
+    build_lookup_tables,
+    dispatch_can_frame,
+)
+from rawcan import (
+    CAN_EFF_FLAG,
+    CAN_ERR_FLAG,
+    CAN_FRAME_SIZE,
+    CAN_RTR_FLAG,
+    RawCanBus,
+    iter_frames,
+    pack_filters,
+    pack_frame,
+)
+
+CONFIG = [
+    {"name": "Entrance Outdoor Light", "address": "0100"},
+    {"name": "Kitchen Spots", "address": "0107"},
+]
+CAN_TO_MQTT, _ = build_lookup_tables(CONFIG)
+
+
+@pytest.fixture()
+def socket_pair():
+    """Yield (sender, RawCanBus) connected through a seqpacket socketpair."""
+    left, right = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    bus = RawCanBus(right, batch_size=8)
+    yield left, bus
+    left.close()
+    bus.shutdown()
+
+
+# ---------------------------------------------------------------------------
+# pack_frame / pack_filters
+# ---------------------------------------------------------------------------
+
+class TestPackFrame:
+    def test_frame_is_16_bytes(self):
+        assert len(pack_frame(ARBIT_SET_REPLY, [1, 0, 1])) == CAN_FRAME_SIZE
+
+    def test_extended_flag_set(self):
+        frame = pack_frame(ARBIT_SET_REPLY, [1, 0, 1])
+        assert int.from_bytes(frame[:4], sys.byteorder) == ARBIT_SET_REPLY | CAN_EFF_FLAG
+
+    def test_length_and_data(self):
+        frame = pack_frame(ARBIT_SET_REPLY, [1, 7, 1])
+        assert frame[4] == 3
+        assert frame[8:11] == bytes([1, 7, 1])
+
+    def test_filters_carry_extended_flag(self):
+        packed = pack_filters([{"can_id": ARBIT_GET_REPLY, "can_mask": 0x1FFFFFFF, "extended": True}])
+        assert len(packed) == 8
+        assert int.from_bytes(packed[:4], sys.byteorder) == ARBIT_GET_REPLY | CAN_EFF_FLAG
+        assert int.from_bytes(packed[4:], sys.byteorder) == 0x1FFFFFFF | CAN_EFF_FLAG
+
+
+# ---------------------------------------------------------------------------
+# iter_frames
+# ---------------------------------------------------------------------------
+
+class TestIterFrames:
+    def test_decodes_id_and_data(self):
+        buf = bytearray(pack_frame(ARBIT_SET_REPLY, [1, 7, 1]))
+        frames = list(iter_frames(buf, len(buf)))
+        assert len(frames) == 1
+        arbitration_id, data = frames[0]
+        assert arbitration_id == ARBIT_SET_REPLY
+        assert bytes(data) == bytes([1, 7, 1])
+
+    def test_decodes_multiple_frames_in_order(self):
+        buf = bytearray(pack_frame(ARBIT_GET_REQUEST, [1, 0]) + pack_frame(ARBIT_GET_REPLY, [1]))
+        ids = [arbitration_id for arbitration_id, _ in iter_frames(buf, len(buf))]
+        assert ids == [ARBIT_GET_REQUEST, ARBIT_GET_REPLY]
+
+    def test_data_is_a_view_not_a_copy(self):
+        buf = bytearray(pack_frame(ARBIT_SET_REPLY, [1, 7, 1]))
+        _, data = next(iter_frames(buf, len(buf)))
+        assert isinstance(data, memoryview)
+        buf[8] = 9
+        assert data[0] == 9
+
+    def test_respects_nbytes(self):
+        buf = bytearray(pack_frame(ARBIT_SET_REPLY, [1, 7, 1]) * 3)
+        assert len(list(iter_frames(buf, CAN_FRAME_SIZE * 2))) == 2
+
+    def test_ignores_trailing_partial_frame(self):
+        buf = bytearray(pack_frame(ARBIT_SET_REPLY, [1, 7, 1]) + b"\x00" * 5)
+        assert len(list(iter_frames(buf, len(buf)))) == 1
+
+    def test_skips_rtr_and_error_frames(self):
+        buf = bytearray(
+            pack_frame(ARBIT_SET_REPLY | CAN_RTR_FLAG, [])
+            + pack_frame(CAN_ERR_FLAG, [0] * 8)
+            + pack_frame(ARBIT_GET_REPLY, [1])
+        )
+        ids = [arbitration_id for arbitration_id, _ in iter_frames(buf, len(buf))]
+        assert ids == [ARBIT_GET_REPLY]
+
+    def test_frames_feed_dispatch(self):
+        buf = bytearray(
+            pack_frame(ARBIT_GET_REQUEST, [1, 7])
+            + pack_frame(ARBIT_GET_REPLY, [1])
+            + pack_frame(ARBIT_SET_REPLY, [1, 0, 0])
+        )
+        relays = RelayTable(CAN_TO_MQTT)
+        client = MagicMock()
+        pending = deque()
+        for arbitration_id, data in iter_frames(buf, len(buf)):
+            dispatch_can_frame(arbitration_id, data, relays, client, pending)
+        assert client.publish.call_args_list[0][0] == ("dobiss/light/0107/state", "ON")
+        assert client.publish.call_args_list[1][0] == ("dobiss/light/0100/state", "OFF")
+        assert relays.states[0x0107] == 1
+        assert len(pending) == 0
+
+
+# ---------------------------------------------------------------------------
+# RawCanBus over a socketpair
+# ---------------------------------------------------------------------------
+
+class TestRawCanBus:
+    def test_recv_batch_single_frame(self, socket_pair):
+        sender, bus = socket_pair
+        sender.send(pack_frame(ARBIT_SET_REPLY, [1, 0, 1]))
+        batch = bus.recv_batch(timeout=1.0)
+        assert [(arbitration_id, bytes(data)) for arbitration_id, data in batch] == [
+            (ARBIT_SET_REPLY, bytes([1, 0, 1]))
+        ]
+
+    def test_recv_batch_drains_queued_frames(self, socket_pair):
+        sender, bus = socket_pair
+        for relay in range(5):
+            sender.send(pack_frame(ARBIT_SET_REPLY, [1, relay, 1]))
+        batch = bus.recv_batch(timeout=1.0)
+        assert [data[1] for _, data in batch] == [0, 1, 2, 3, 4]
+
+    def test_batch_limited_to_batch_size(self, socket_pair):
+        sender, bus = socket_pair
+        for relay in range(10):
+            sender.send(pack_frame(ARBIT_SET_REPLY, [1, relay, 1]))
+        assert len(bus.recv_batch(timeout=1.0)) == 8
+        assert [data[1] for _, data in bus.recv_batch(timeout=1.0)] == [8, 9]
+
+    def test_timeout_returns_empty_batch(self, socket_pair):
+        _, bus = socket_pair
+        assert bus.recv_batch(timeout=0.05) == []
+
+    def test_send_writes_can_frame(self, socket_pair):
+        sender, bus = socket_pair
+        bus.send(can.Message(arbitration_id=0x01FC0102, data=[1, 0, 1, 0xFF, 0xFF], is_extended_id=True))
+        buf = bytearray(sender.recv(CAN_FRAME_SIZE))
+        arbitration_id, data = next(iter_frames(buf, len(buf)))
+        assert arbitration_id == 0x01FC0102
+        assert bytes(data) == bytes([1, 0, 1, 0xFF, 0xFF])
@@ -0,0 +1,113 @@
+"""Tests for shmring.py (shared-memory SPSC ring buffer)."""
+import multiprocessing
+import os
+import struct
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shmring import ShmRing
+
+RECORD = struct.Struct("=IB3x")
+
+
+@pytest.fixture()
+def ring():
+    ring = ShmRing.create(RECORD.size, capacity=4)
+    yield ring
+    ring.close()
+
+
+def _produce(name, count):
+    ring = ShmRing.attach(name)
+    sent = 0
+    while sent < count:
+        if ring.push(RECORD, sent, sent & 0xFF):
+            sent += 1
+    ring.close()
+
+
+class TestShmRing:
+    def test_pop_empty_returns_none(self, ring):
+        assert ring.pop(RECORD) is None
+
+    def test_push_then_pop(self, ring):
+        assert ring.push(RECORD, 0x0002FF01, 3)
+        assert ring.pop(RECORD) == (0x0002FF01, 3)
+
+    def test_fifo_order(self, ring):
+        for i in range(3):
+            ring.push(RECORD, i, 0)
+        assert [ring.pop(RECORD)[0] for _ in range(3)] == [0, 1, 2]
+
+    def test_len_tracks_queued_records(self, ring):
+        ring.push(RECORD, 1, 0)
+        ring.push(RECORD, 2, 0)
+        assert len(ring) == 2
+        ring.pop(RECORD)
+        assert len(ring) == 1
+
+    def test_full_ring_rejects_and_counts_drops(self, ring):
+        for i in range(4):
+            assert ring.push(RECORD, i, 0)
+        assert not ring.push(RECORD, 99, 0)
+        assert ring.dropped == 1
+        assert [ring.pop(RECORD)[0] for _ in range(4)] == [0, 1, 2, 3]
+
+    def test_counters_are_native_aligned_words(self, ring):
+        ring.push(RECORD, 1, 0)
+        ring.push(RECORD, 2, 0)
+        ring.pop(RECORD)
+        words = ring._buf.cast("Q")
+        assert (words[64 // 8], words[128 // 8]) == (2, 1)
+
+    def test_wraps_around(self, ring):
+        for i in range(10):
+            ring.push(RECORD, i, 0)
+            assert ring.pop(RECORD) == (i, 0)
+
+    def test_capacity_must_be_power_of_two(self):
+        with pytest.raises(ValueError):
+            ShmRing.create(RECORD.size, capacity=6)
+
+    def test_attach_shares_positions(self, ring):
+        ring.push(RECORD, 7, 0)
+        other = ShmRing.attach(ring.name)
+        try:
+            assert other.record_size == RECORD.size
+            assert other.capacity == 4
+            assert other.pop(RECORD) == (7, 0)
+            assert len(ring) == 0
+        finally:
+            other.close()
+
+    def test_reattached_consumer_resumes_after_last_pop(self, ring):
+        for i in range(3):
+            ring.push(RECORD, i, 0)
+        first = ShmRing.attach(ring.name)
+        first.pop(RECORD)
+        first.close()  # consumer "crashes" after one record
+        second = ShmRing.attach(ring.name)
+        try:
+            assert second.pop(RECORD) == (1, 0)
+        finally:
+            second.close()
+
+    def test_cross_process_producer(self):
+        ring = ShmRing.create(RECORD.size, capacity=64)
+        try:
+            producer = multiprocessing.Process(target=_produce, args=(ring.name, 1000))
+            producer.start()
+            received = []
+            deadline = time.monotonic() + 10
+            while len(received) < 1000 and time.monotonic() < deadline:
+                record = ring.pop(RECORD)
+                if record is not None:
+                    received.append(record[0])
+            producer.join(timeout=5)
+            assert received == list(range(1000))
+        finally:
+            ring.close()
@@ -0,0 +1,91 @@
+"""Tests for shmstate.py (shared-memory relay state export)."""
+import multiprocessing
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from can2mqtt import ARBIT_SET_REPLY, RelayTable, build_lookup_tables, dispatch_can_frame, start_state_export
+from shmstate import SLOTS, UNKNOWN, StateExport, StateReader
+
+CAN_TO_MQTT, _ = build_lookup_tables([{"name": "Kitchen Spots", "address": "0107"}])
+
+
+@pytest.fixture()
+def export():
+    export = StateExport.create()
+    yield export
+    export.close()
+
+
+def _read_in_child(name, key, results):
+    reader = StateReader.attach(name)
+    results.put(reader.state(key))
+    reader.close()
+
+
+class TestStateExport:
+    def test_starts_unknown(self, export):
+        reader = StateReader.attach(export.name)
+        try:
+            assert reader.state(0x0107) == UNKNOWN
+            assert reader.seq == 0
+        finally:
+            reader.close()
+
+    def test_set_visible_to_reader_and_bumps_seq(self, export):
+        reader = StateReader.attach(export.name)
+        try:
+            export.set(0x0107, 1)
+            assert reader.state(0x0107) == 1
+            assert reader.seq == 2
+        finally:
+            reader.close()
+
+    def test_seq_is_a_native_aligned_word(self, export):
+        export.set(0x0107, 1)
+        export.set(0x0107, 0)
+        assert export._buf[:128].cast("Q")[64 // 8] == 4
+
+    def test_load_copies_table(self, export):
+        states = bytearray([UNKNOWN]) * SLOTS
+        states[0x0100] = 0
+        states[0x0200] = 1
+        export.load(states)
+        reader = StateReader.attach(export.name)
+        try:
+            assert reader.read([0x0100, 0x0200, 0x0300]) == [0, 1, UNKNOWN]
+            assert reader.snapshot() == bytes(states)
+        finally:
+            reader.close()
+
+    def test_reader_rejects_foreign_block(self):
+        from multiprocessing import shared_memory
+        shm = shared_memory.SharedMemory(create=True, size=256)
+        try:
+            with pytest.raises(ValueError):
+                StateReader.attach(shm.name)
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def test_cross_process_reader(self, export):
+        export.set(0x0107, 1)
+        results = multiprocessing.Queue()
+        child = multiprocessing.Process(target=_read_in_child, args=(export.name, 0x0107, results))
+        child.start()
+        assert results.get(timeout=10) == 1
+        child.join(timeout=5)
+
+    def test_bridge_mirrors_can_transitions(self):
+        relays = RelayTable(CAN_TO_MQTT)
+        export = start_state_export(relays, name=None)
+        try:
+            dispatch_can_frame(ARBIT_SET_REPLY, bytes([1, 7, 1]), relays, type("C", (), {"publish": lambda *a, **k: None})())
+            reader = StateReader.attach(export.name)
+            assert reader.state(0x0107) == 1
+            reader.close()
+        finally:
+            export.close()
@@ -0,0 +1,44 @@
+"""Short run of the soak harness (tests/soak.py) plus its drift check.
+
+The real soak runs for hours from the command line; this keeps the harness
+itself working and catches gross leaks in a few seconds.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tests.soak import THRESHOLDS, check_drift, run_soak
+
+
+def _samples(values, metric="pending_gets"):
+    base = {name: 0 for name in THRESHOLDS}
+    return [dict(base, **{metric: value}) for value in values]
+
+
+class TestCheckDrift:
+    def test_flat_series_passes(self):
+        assert check_drift(_samples([5] * 20)) == []
+
+    def test_noise_within_threshold_passes(self):
+        assert check_drift(_samples([5, 7, 4, 6] * 5)) == []
+
+    def test_steady_growth_fails(self):
+        failures = check_drift(_samples(range(0, 200, 10)))
+        assert len(failures) == 1
+        assert failures[0].startswith("pending_gets grew")
+
+    def test_warmup_growth_ignored(self):
+        assert check_drift(_samples([0, 500, 1000, 1000] + [1000] * 16, metric="rss_kib")) == []
+
+    def test_too_few_samples(self):
+        assert check_drift(_samples([1, 100])) == []
+
+
+class TestShortSoak:
+    def test_no_drift_under_mixed_load(self):
+        result = run_soak(duration=6.0, rate=50.0, interval=0.5, report=lambda line: None,
+                          sim_log_limit=32)
+        assert len(result.samples) >= 10
+        assert sum(sample["commands"] for sample in result.samples) > 100
+        assert result.ok, result.failures
@@ -0,0 +1,86 @@
+"""Tests for timerwheel.py (hierarchical timing wheel)."""
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from timerwheel import TimerWheel
+
+
+class TestTimerWheel:
+    def test_fires_at_expiry(self):
+        wheel = TimerWheel(now=0)
+        wheel.schedule(0x0100, 5, "OFF")
+        assert wheel.advance(4) == []
+        assert wheel.advance(5) == [(0x0100, "OFF")]
+        assert len(wheel) == 0
+
+    def test_fires_once(self):
+        wheel = TimerWheel(now=0)
+        wheel.schedule(0x0100, 2, "OFF")
+        wheel.advance(2)
+        assert wheel.advance(1000) == []
+
+    def test_reschedule_replaces_timer(self):
+        wheel = TimerWheel(now=0)
+        wheel.schedule(0x0100, 5, "OFF")
+        wheel.schedule(0x0100, 10, "ON")
+        assert wheel.advance(9) == []
+        assert wheel.advance(10) == [(0x0100, "ON")]
+
+    def test_cancel(self):
+        wheel = TimerWheel(now=0)
+        wheel.schedule(0x0100, 5, "OFF")
+        assert wheel.cancel(0x0100) == (5, "OFF")
+        assert 0x0100 not in wheel
+        assert wheel.advance(10) == []
+        assert wheel.cancel(0x0100) is None
+
+    def test_overdue_fires_next_tick(self):
+        wheel = TimerWheel(now=100)
+        wheel.schedule(0x0100, 50, "OFF")
+        assert wheel.timers[0x0100] == (101, "OFF")
+        assert wheel.advance(101) == [(0x0100, "OFF")]
+
+    def test_far_timer_cascades_to_exact_tick(self):
+        wheel = TimerWheel(now=0, slots=4, levels=3)
+        wheel.schedule(0x0100, 37, "OFF")
+        assert wheel.advance(36) == []
+        assert wheel.advance(37) == [(0x0100, "OFF")]
+
+    def test_beyond_top_level_range(self):
+        wheel = TimerWheel(now=0, slots=4, levels=2)
+        wheel.schedule(0x0100, 100, "OFF")
+        assert wheel.advance(99) == []
+        assert wheel.advance(100) == [(0x0100, "OFF")]
+
+    def test_slots_must_be_power_of_two(self):
+        with pytest.raises(ValueError):
+            TimerWheel(slots=6)
+
+    @pytest.mark.parametrize("seed", range(5))
+    def test_matches_reference(self, seed):
+        rng = random.Random(seed)
+        wheel = TimerWheel(now=rng.randrange(1000), slots=8, levels=3)
+        expected = {}
+        now = wheel.now
+        for _ in range(300):
+            key = rng.randrange(20)
+            op = rng.random()
+            if op < 0.5:
+                expires = now + rng.randrange(-5, 700)
+                wheel.schedule(key, expires, key)
+                expected[key] = max(expires, now + 1)
+            elif op < 0.6:
+                wheel.cancel(key)
+                expected.pop(key, None)
+            else:
+                now += rng.randrange(30)
+                fired = sorted(k for k, _ in wheel.advance(now))
+                due = sorted(k for k, t in expected.items() if t <= now)
+                assert fired == due
+                for k in due:
+                    del expected[k]
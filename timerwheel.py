@@ -0,0 +1,98 @@
+"""Hierarchical timing wheel keyed by relay.
+
+Holds at most one timer per key (scheduling a key again replaces its timer)
+and fires them in O(1) amortised work per tick, however many are pending.
+Time is measured in integer ticks; the caller decides how long a tick is
+and calls advance() with the current tick.
+
+Level L has `slots` buckets, each covering slots**L ticks. A timer sits in
+the lowest level whose range still contains its expiry; when the lower
+levels roll over, the next bucket of the level above is cascaded down.
+Cancelled and rescheduled timers are dropped lazily when their bucket
+comes up.
+"""
+
+
+class TimerWheel:
+    """One-shot timers, one per key, on a hierarchical timing wheel.
+
+    Usage::
+
+        wheel = TimerWheel(now=current_tick)
+        wheel.schedule(0x0105, current_tick + 3000, "OFF")
+        ...
+        for key, action in wheel.advance(current_tick):
+            ...
+    """
+
+    def __init__(self, now=0, slots=256, levels=3):
+        if slots & (slots - 1):
+            raise ValueError("slots must be a power of two")
+        self.now = now
+        self.levels = levels
+        self._bits = slots.bit_length() - 1
+        self._mask = slots - 1
+        self._wheels = [[[] for _ in range(slots)] for _ in range(levels)]
+        # key -> (expires, action) for every pending timer
+        self.timers = {}
+
+    def __len__(self):
+        return len(self.timers)
+
+    def __contains__(self, key):
+        return key in self.timers
+
+    def schedule(self, key, expires, action):
+        """Fire action for key at tick expires, replacing any pending timer for key.
+
+        Overdue timers fire on the next tick.
+        """
+        expires = max(expires, self.now + 1)
+        self.timers[key] = (expires, action)
+        self._place(key, expires)
+
+    def cancel(self, key):
+        """Drop the pending timer for key; returns its (expires, action) or None."""
+        return self.timers.pop(key, None)
+
+    def _place(self, key, expires):
+        bits = self._bits
+        level = 0
+        while level < self.levels - 1 and (expires >> (bits * (level + 1))) != (self.now >> (bits * (level + 1))):
+            level += 1
+        self._wheels[level][(expires >> (bits * level)) & self._mask].append((key, expires))
+
+    def advance(self, now):
+        """Move the wheel to tick now and return the (key, action) pairs that expired."""
+        fired = []
+        bits = self._bits
+        mask = self._mask
+        timers = self.timers
+        while self.now < now:
+            self.now += 1
+            tick = self.now
+            # Cascade every level whose lower levels just rolled over, top first.
+            top = 0
+            while top < self.levels - 1 and not tick & ((1 << (bits * (top + 1))) - 1):
+                top += 1
+            for level in range(top, 0, -1):
+                bucket = self._wheels[level]
+                index = (tick >> (bits * level)) & mask
+                entries, bucket[index] = bucket[index], []
+                for key, expires in entries:
+                    current = timers.get(key)
+                    if current is not None and current[0] == expires:
+                        self._place(key, expires)
+            bucket = self._wheels[0]
+            index = tick & mask
+            entries, bucket[index] = bucket[index], []
+            for key, expires in entries:
+                current = timers.get(key)
+                if current is None or current[0] != expires:
+                    continue
+                if expires <= tick:
+                    del timers[key]
+                    fired.append((key, current[1]))
+                else:
+                    self._place(key, expires)
+        return fired